@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -46,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'coupons.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -87,6 +89,11 @@ DATABASES = {
 }
 
 
+# Coupon reads of cart evaluation and of the coupon list and detail endpoints
+# may go to the read replicas in COUPON_READ_REPLICAS (see coupons/routers.py)
+DATABASE_ROUTERS = ['coupons.routers.ReplicaRouter']
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -137,3 +144,119 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10,
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
 }
+
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'coupon-results': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'coupon-results',
+        # Evict the single least recently used entry once the cache is full
+        'OPTIONS': {'MAX_ENTRIES': 10000, 'CULL_FREQUENCY': 10000},
+    },
+    # Shared by every worker process, so retries reaching another worker are
+    # replayed; create its table with `python manage.py createcachetable`
+    'coupon-idempotency': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'coupon_idempotency',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+# Coupon evaluation settings
+# Engine used for discount math: 'decimal' or 'cents' (integer minor units)
+COUPON_ENGINE = 'decimal'
+# Evaluate carts with NumPy once the active catalog reaches this many coupons
+# (None disables it; ignored when NumPy is not installed)
+COUPON_VECTORIZE_THRESHOLD = 50000
+# Validate carts and render responses of the cart endpoints with functions
+# compiled from the serializers (False always uses the DRF serializers)
+COUPON_FAST_PATH = True
+# Rows created per transaction by the bulk coupon import
+COUPON_IMPORT_CHUNK_SIZE = 1000
+# Coupons loaded per query by the streaming export
+COUPON_EXPORT_CHUNK_SIZE = 1000
+# Coupons changed per statement by the bulk operations endpoint
+COUPON_BULK_CHUNK_SIZE = 1000
+# Coupons created per transaction when generating codes from a template, and
+# the most codes one request may generate
+COUPON_CODEGEN_CHUNK_SIZE = 5000
+COUPON_CODEGEN_MAX_COUNT = 5000000
+# Maximum number of carts accepted by the batch applicable-coupons endpoint
+COUPON_BATCH_MAX_CARTS = 1000
+# Upper bound on the search nodes explored when combining stackable coupons
+COUPON_STACKING_MAX_NODES = 10000
+# Counter rows the total redemption limit of a coupon is split across; fixed
+# per coupon on its first redemption, so changes only affect new coupons
+COUPON_REDEMPTION_SHARDS = 8
+# Seconds a coupon reservation is held unless confirmed, and the reservations
+# released per transaction by the expire_reservations command
+COUPON_RESERVATION_TTL = 900
+COUPON_RESERVATION_SWEEP_BATCH_SIZE = 1000
+# Split catalogs of at least COUPON_SHARD_THRESHOLD coupons across this many
+# forked worker processes (None disables sharded evaluation)
+COUPON_SHARD_COUNT = None
+COUPON_SHARD_THRESHOLD = 200000
+# Keep only the best N coupons of each shard and of the merged result (None keeps all)
+COUPON_SHARD_TOP_N = None
+# Seconds to wait for the workers before evaluating the cart in-process
+COUPON_SHARD_TIMEOUT = 30
+# Cache alias holding the catalog version; use a cache shared by all worker
+# processes (e.g. Redis) so that coupon writes reach every process. With the
+# default local-memory cache, a coupon written through one worker process is
+# only seen by the others once their snapshot is COUPON_SNAPSHOT_MAX_AGE
+# seconds old: until then they keep applying a deactivated or deleted coupon
+COUPON_VERSION_CACHE = 'default'
+# Seconds a coupon snapshot, and the results cached from it, are used at most
+# before the coupons are reloaded (None only reloads after a write, which is
+# enough with a shared COUPON_VERSION_CACHE). The old snapshot is served while
+# a background thread reloads it; keep this well above the reload time
+COUPON_SNAPSHOT_MAX_AGE = 30
+# Cache alias for applicable-coupons and apply-coupon results (None disables it)
+COUPON_RESULT_CACHE = 'coupon-results'
+# Seconds a cached result is kept at most
+COUPON_RESULT_CACHE_TIMEOUT = 300
+# Let identical carts evaluated concurrently in a process share one evaluation
+COUPON_SINGLE_FLIGHT = True
+# Cache alias storing the responses of apply-coupon requests by Idempotency-Key
+# (None ignores the header); it must be shared by all worker processes, so
+# local-memory caches are refused
+COUPON_IDEMPOTENCY_CACHE = 'coupon-idempotency'
+# Seconds the response of an idempotent request is kept for retries
+COUPON_IDEMPOTENCY_TIMEOUT = 86400
+# Seconds the key of a running request stays claimed once its worker stops
+# refreshing the claim (e.g. because it died); retries get a 409 meanwhile
+COUPON_IDEMPOTENCY_CLAIM_TIMEOUT = 60
+# Aliases of DATABASES that are read replicas of the default database; coupon
+# evaluation and the coupon list and detail endpoints read from them
+COUPON_READ_REPLICAS = ()
+# Seconds a replica may lag before reads skip it; for that long after a coupon
+# write, snapshot loads (and the coupon endpoints, with
+# COUPON_REPLICA_READ_YOUR_WRITES) read from the primary
+COUPON_REPLICA_MAX_LAG = 5
+COUPON_REPLICA_READ_YOUR_WRITES = True
+# Seconds between two health and lag checks of a replica, and the SQL returning
+# the lag in seconds for databases without a built-in query (only PostgreSQL has one)
+COUPON_REPLICA_CHECK_INTERVAL = 5
+COUPON_REPLICA_LAG_QUERY = None
+# Try replica routing locally with a copy of db.sqlite3 as the replica:
+#   cp db.sqlite3 replica.sqlite3 && COUPON_REPLICA_DB=replica.sqlite3 python manage.py runserver
+if os.environ.get('COUPON_REPLICA_DB'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['COUPON_REPLICA_DB'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    COUPON_READ_REPLICAS = ('replica',)
+# Collect Prometheus-style metrics, exposed at /metrics
+COUPON_METRICS_ENABLED = True
+# Directory where each worker process writes its metrics so that a scrape of
+# any worker reports all of them (needed with multi-worker gunicorn). Files of
+# exited workers are removed by pid, so the directory must be local to the host
+COUPON_METRICS_DIR = os.environ.get('COUPON_METRICS_DIR')
+# Seconds between two writes of a worker's metrics file, by a background thread
+COUPON_METRICS_FLUSH_INTERVAL = 1.0
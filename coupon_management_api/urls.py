@@ -20,6 +20,8 @@ from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 
+from coupons.views import MetricsView
+
 schema_view = get_schema_view(
     openapi.Info(
         title="Coupon Management API",
@@ -36,6 +38,7 @@ schema_view = get_schema_view(
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('coupons.urls')),
+    path('metrics', MetricsView.as_view(), name='metrics'),
     
     # Swagger Documentation URLs
     path('', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
@@ -41,8 +41,8 @@ class BxGyCouponInline(admin.StackedInline):
 
 @admin.register(Coupon)
 class CouponAdmin(admin.ModelAdmin):
-    list_display = ('name', 'code', 'type', 'is_active', 'expires_at')
-    list_filter = ('type', 'is_active')
+    list_display = ('name', 'code', 'type', 'is_active', 'is_stackable', 'expires_at')
+    list_filter = ('type', 'is_active', 'is_stackable')
     search_fields = ('name', 'code')
     
     def get_inlines(self, request, obj=None):
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class CouponsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'coupons'
+    
+    def ready(self):
+        # Keep the in-memory coupon snapshot in sync with coupon writes
+        from . import signals  # noqa: F401
@@ -0,0 +1,313 @@
+"""
+Synthetic-load benchmarks for coupon evaluation.
+
+Generates seeded coupon catalogs and carts, times the services and the API
+views, and compares a run against a stored baseline. Used by the
+``benchmark_coupons`` management command.
+"""
+import asyncio
+import json
+import math
+import platform
+import random
+import time
+import uuid
+from collections import Counter
+from datetime import timedelta
+from decimal import Decimal
+
+import django
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .models import (
+    Coupon,
+    CartWiseCoupon,
+    ProductWiseCoupon,
+    BxGyCoupon,
+    BxGyCouponBuyProduct,
+    BxGyCouponGetProduct
+)
+
+
+PRODUCT_COUNT = 5000
+CATEGORIES = [f'category-{n}' for n in range(50)]
+BRANDS = [f'brand-{n}' for n in range(50)]
+
+# Share of each coupon type in a generated catalog
+TYPE_WEIGHTS = (('cart-wise', 4), ('product-wise', 4), ('bxgy', 2))
+
+BULK_BATCH_SIZE = 2000
+
+
+def _money(rng, low, high):
+    return Decimal(rng.randint(low * 100, high * 100)).scaleb(-2)
+
+
+def generate_catalog(size, seed=0, max_bxgy_products=20):
+    """
+    Create a synthetic catalog of coupons of all three types.
+    
+    BxGy coupons get up to ``max_bxgy_products`` buy and get products each,
+    about 5% of the coupons are expired and 5% are inactive. Rows are written
+    with ``bulk_create``, so no signals fire; callers must invalidate the
+    snapshot themselves.
+    
+    Args:
+        size: Number of coupons to create
+        seed: Seed of the random generator
+        max_bxgy_products: Largest number of buy and get products of a BxGy coupon
+        
+    Returns:
+        list: The IDs of the created coupons
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    types = [coupon_type for coupon_type, weight in TYPE_WEIGHTS for _ in range(weight)]
+    prefix = uuid.uuid4().hex[:8].upper()
+    
+    coupons = []
+    cart_wise = []
+    product_wise = []
+    bxgy = []
+    bxgy_products = []
+    
+    for n in range(size):
+        coupon_type = rng.choice(types)
+        roll = rng.random()
+        coupon = Coupon(
+            type=coupon_type,
+            code=f'BENCH-{prefix}-{n:06d}',
+            name=f'Benchmark coupon {n}',
+            is_active=roll >= 0.05,
+            expires_at=now - timedelta(days=1) if roll >= 0.95 else None,
+        )
+        coupons.append(coupon)
+        
+        if coupon_type == 'cart-wise':
+            discount_type = rng.choice(['percentage', 'fixed', 'shipping'])
+            cart_wise.append(CartWiseCoupon(
+                coupon=coupon,
+                discount_type=discount_type,
+                threshold=_money(rng, 0, 2000),
+                discount_value=_money(rng, 1, 50) if discount_type == 'percentage' else _money(rng, 1, 200)
+            ))
+        elif coupon_type == 'product-wise':
+            discount_type = rng.choice(['percentage', 'fixed'])
+            target = rng.choice(['product_id', 'category', 'brand'])
+            product_wise.append(ProductWiseCoupon(
+                coupon=coupon,
+                discount_type=discount_type,
+                product_id=rng.randint(1, PRODUCT_COUNT) if target == 'product_id' else None,
+                category=rng.choice(CATEGORIES) if target == 'category' else None,
+                brand=rng.choice(BRANDS) if target == 'brand' else None,
+                discount_value=_money(rng, 1, 50) if discount_type == 'percentage' else _money(rng, 1, 100)
+            ))
+        else:
+            details = BxGyCoupon(coupon=coupon, repetition_limit=rng.randint(1, 5))
+            bxgy.append(details)
+            for model in (BxGyCouponBuyProduct, BxGyCouponGetProduct):
+                count = rng.randint(1, max_bxgy_products)
+                for product_id in rng.sample(range(1, PRODUCT_COUNT + 1), count):
+                    bxgy_products.append((model, details, product_id, rng.randint(1, 3)))
+                    
+    Coupon.objects.bulk_create(coupons, batch_size=BULK_BATCH_SIZE)
+    CartWiseCoupon.objects.bulk_create(cart_wise, batch_size=BULK_BATCH_SIZE)
+    ProductWiseCoupon.objects.bulk_create(product_wise, batch_size=BULK_BATCH_SIZE)
+    BxGyCoupon.objects.bulk_create(bxgy, batch_size=BULK_BATCH_SIZE)
+    
+    # BxGy details only get their primary keys from bulk_create, so products come last
+    for model in (BxGyCouponBuyProduct, BxGyCouponGetProduct):
+        model.objects.bulk_create(
+            [
+                model(bxgy_coupon=details, product_id=product_id, quantity=quantity)
+                for product_model, details, product_id, quantity in bxgy_products
+                if product_model is model
+            ],
+            batch_size=BULK_BATCH_SIZE
+        )
+        
+    return [coupon.id for coupon in coupons]
+
+
+def generate_cart(lines, rng):
+    """
+    Create a synthetic cart with JSON-ready values.
+    
+    Args:
+        lines: Number of cart items
+        rng: A random.Random instance
+        
+    Returns:
+        dict: A cart as accepted by the API
+    """
+    return {'items': [
+        {
+            'product_id': rng.randint(1, PRODUCT_COUNT),
+            'quantity': rng.randint(1, 5),
+            'price': f'{rng.randint(100, 50000) / 100:.2f}',
+            'category': rng.choice(CATEGORIES),
+            'brand': rng.choice(BRANDS),
+        }
+        for _ in range(lines)
+    ]}
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def measure(name, func, iterations, **labels):
+    """
+    Time repeated calls of a function.
+    
+    Args:
+        name: Name of the benchmark
+        func: A callable taking the iteration number
+        iterations: Number of timed calls
+        **labels: Extra fields identifying the benchmark (catalog size, cart lines)
+        
+    Returns:
+        dict: Latency percentiles in milliseconds, throughput and queries per call
+    """
+    durations = []
+    
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        for n in range(iterations):
+            call_started = time.perf_counter()
+            func(n)
+            durations.append(time.perf_counter() - call_started)
+        elapsed = time.perf_counter() - started
+        
+    return summarize(name, durations, elapsed, labels, queries_per_call=round(len(queries) / iterations, 2))
+
+
+def load_test(name, request, requests, concurrency, **labels):
+    """
+    Send requests concurrently from one event loop.
+    
+    Args:
+        name: Name of the benchmark
+        request: A coroutine function taking the request number and
+            returning its response
+        requests: Total number of requests
+        concurrency: Largest number of requests in flight at once
+        **labels: Extra fields identifying the benchmark
+        
+    Returns:
+        dict: Latency percentiles in milliseconds, throughput and the number
+            of responses by status code
+    """
+    status_codes = Counter()
+    
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+        durations = []
+        
+        async def send(n):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await request(n)
+                durations.append(time.perf_counter() - started)
+                status_codes[str(response.status_code)] += 1
+                
+        started = time.perf_counter()
+        await asyncio.gather(*(send(n) for n in range(requests)))
+        return durations, time.perf_counter() - started
+    
+    # Sync views called from the loop run back on this thread, with its connection
+    durations, elapsed = async_to_sync(run)()
+    result = summarize(name, durations, elapsed, {**labels, 'concurrency': concurrency})
+    # Errors are fast; timings only compare if the responses do
+    result['status_codes'] = dict(sorted(status_codes.items()))
+    return result
+
+
+def summarize(name, durations, elapsed, labels, queries_per_call=None):
+    """Build the result of a benchmark from its call durations in seconds"""
+    durations = sorted(durations)
+    return {
+        'name': name,
+        **labels,
+        'iterations': len(durations),
+        'p50_ms': round(percentile(durations, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(durations, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(durations, 0.99) * 1000, 3),
+        'mean_ms': round(sum(durations) / len(durations) * 1000, 3),
+        'throughput_per_s': round(len(durations) / elapsed, 1) if elapsed else None,
+        'queries_per_call': queries_per_call,
+    }
+
+
+def result_key(result):
+    """Identify a benchmark across runs by its name and labels"""
+    return (result['name'], result.get('catalog_size'), result.get('cart_lines'), result.get('concurrency'))
+
+
+def compare(results, baseline, tolerance=0.10):
+    """
+    Compare benchmark results with a baseline run.
+    
+    Args:
+        results: The results of this run
+        baseline: The results of the baseline run
+        tolerance: Relative p95 slowdown reported as a regression
+        
+    Returns:
+        list: One comparison per benchmark present in both runs
+    """
+    baseline_results = {result_key(result): result for result in baseline}
+    comparisons = []
+    
+    for result in results:
+        previous = baseline_results.get(result_key(result))
+        if previous is None:
+            continue
+        
+        queries_delta = None
+        if result['queries_per_call'] is not None and previous['queries_per_call'] is not None:
+            queries_delta = round(result['queries_per_call'] - previous['queries_per_call'], 2)
+            
+        ratios = {
+            metric: round(result[metric] / previous[metric], 3) if previous[metric] else None
+            for metric in ('p50_ms', 'p95_ms', 'p99_ms')
+        }
+        comparisons.append({
+            'name': result['name'],
+            'catalog_size': result.get('catalog_size'),
+            'cart_lines': result.get('cart_lines'),
+            'concurrency': result.get('concurrency'),
+            **{f'{metric}_ratio': ratio for metric, ratio in ratios.items()},
+            'queries_delta': queries_delta,
+            'regression': (
+                ratios['p95_ms'] is not None and ratios['p95_ms'] > 1 + tolerance
+            ) or bool(queries_delta and queries_delta > 0),
+        })
+        
+    return comparisons
+
+
+def environment():
+    """Describe the environment a benchmark ran in"""
+    return {
+        'created_at': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'coupon_engine': getattr(settings, 'COUPON_ENGINE', 'decimal'),
+        'vectorize_threshold': getattr(settings, 'COUPON_VECTORIZE_THRESHOLD', None),
+    }
+
+
+def load_results(path):
+    """Read the results of a previous run from a JSON file"""
+    with open(path) as results_file:
+        return json.load(results_file)
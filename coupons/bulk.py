@@ -0,0 +1,103 @@
+"""
+Set-based bulk operations on the coupons matching a filter.
+
+Coupons are selected by keyset iteration on the primary key, COUPON_BULK_CHUNK_SIZE
+at a time, and each chunk is changed with a single ``UPDATE`` (or one
+``DELETE`` per table for deletions) in its own transaction, instead of
+saving coupons one by one through the serializer. The coupon snapshot and
+the cached results are invalidated once for the whole operation.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Coupon
+from .signals import batched_invalidation, coupon_changed
+
+
+OPERATIONS = ('activate', 'deactivate', 'set_expiry', 'delete')
+
+
+def filter_coupons(ids=None, code_prefix=None, type=None, created_after=None, created_before=None):
+    """
+    Build the queryset of the coupons matching every given criterion.
+    
+    Args:
+        ids: Coupon IDs
+        code_prefix: Start of the coupon codes
+        type: Coupon type
+        created_after: Earliest creation time (inclusive)
+        created_before: Latest creation time (exclusive)
+        
+    Returns:
+        QuerySet: The matching coupons
+    """
+    queryset = Coupon.objects.all()
+    if ids is not None:
+        queryset = queryset.filter(pk__in=ids)
+    if code_prefix:
+        queryset = queryset.filter(code__startswith=code_prefix)
+    if type:
+        queryset = queryset.filter(type=type)
+    if created_after is not None:
+        queryset = queryset.filter(created_at__gte=created_after)
+    if created_before is not None:
+        queryset = queryset.filter(created_at__lt=created_before)
+    return queryset
+
+
+def iter_chunks(queryset, chunk_size):
+    """Yield the primary keys of the coupons in the queryset, one chunk per query"""
+    queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    
+    while True:
+        chunk_queryset = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk_queryset[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1]
+
+
+def _change_chunk(pks, operation, expires_at, now):
+    coupons = Coupon.objects.filter(pk__in=pks)
+    if operation == 'delete':
+        return coupons.delete()[1].get(Coupon._meta.label, 0)
+    if operation == 'set_expiry':
+        return coupons.update(expires_at=expires_at, updated_at=now)
+    return coupons.update(is_active=operation == 'activate', updated_at=now)
+
+
+def run(queryset, operation, expires_at=None, chunk_size=None):
+    """
+    Apply an operation to every coupon of a queryset.
+    
+    Args:
+        queryset: The coupons to change, see filter_coupons
+        operation: 'activate', 'deactivate', 'set_expiry' or 'delete'
+        expires_at: The new expiry time of set_expiry (None removes it)
+        chunk_size: Coupons changed per statement (defaults to COUPON_BULK_CHUNK_SIZE)
+        
+    Returns:
+        dict: The operation, and the number of affected coupons and chunks
+    """
+    if operation not in OPERATIONS:
+        raise ValueError(f'Unknown bulk operation "{operation}"; expected one of {", ".join(OPERATIONS)}')
+    
+    chunk_size = chunk_size or getattr(settings, 'COUPON_BULK_CHUNK_SIZE', 1000)
+    now = timezone.now()
+    report = {'operation': operation, 'affected': 0, 'chunks': 0}
+    
+    # Deletions send a signal per row; updates send none
+    with batched_invalidation():
+        for pks in iter_chunks(queryset, chunk_size):
+            with transaction.atomic():
+                report['affected'] += _change_chunk(pks, operation, expires_at, now)
+            report['chunks'] += 1
+            
+        if report['affected']:
+            coupon_changed(Coupon)
+            
+    return report
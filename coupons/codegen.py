@@ -0,0 +1,218 @@
+"""
+Bulk generation of unique single-use coupon codes from a template coupon.
+
+Codes follow a pattern in which every ``#`` is replaced by a random
+character from an unambiguous alphabet (no 0/O or 1/I), e.g.
+``SUMMER-########``. Codes are generated in chunks of
+COUPON_CODEGEN_CHUNK_SIZE: each chunk is deduplicated in memory and against
+the existing codes with set lookups, then the coupons and a clone of the
+template's details are created with ``bulk_create`` in one transaction.
+Codes of earlier chunks are committed before the next chunk is looked up,
+so no set of all generated codes is kept in memory.
+"""
+import secrets
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .models import (
+    Coupon,
+    CartWiseCoupon,
+    ProductWiseCoupon,
+    BxGyCoupon,
+    BxGyCouponBuyProduct,
+    BxGyCouponGetProduct
+)
+from .snapshot import invalidate_snapshot
+
+
+ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
+PLACEHOLDER = '#'
+DEFAULT_RANDOM_LENGTH = 10
+
+# The generated codes must be a small fraction of the possible codes, so
+# collisions stay rare
+MIN_CAPACITY_RATIO = 10
+# Rounds of a chunk without new unique codes before the pattern is given up
+MAX_STALLED_ROUNDS = 10
+LOOKUP_BATCH_SIZE = 5000
+
+# Maps every byte to an alphabet character; 256 is a multiple of the 32
+# characters, so every character is equally likely
+_TRANSLATION = bytes(ord(ALPHABET[byte % len(ALPHABET)]) for byte in range(256))
+
+
+class CodeGenerationError(Exception):
+    """Raised when codes cannot be generated for a pattern"""
+
+
+def default_pattern(template):
+    """The pattern used when none is given: the template code and random characters"""
+    max_length = Coupon._meta.get_field('code').max_length
+    prefix = template.code[:max_length - DEFAULT_RANDOM_LENGTH - 1]
+    return f'{prefix}-{PLACEHOLDER * DEFAULT_RANDOM_LENGTH}'
+
+
+def check_pattern(pattern, count):
+    """
+    Check that a pattern has room for count codes.
+    
+    Raises:
+        CodeGenerationError: If the codes would be too long or too few are possible
+    """
+    max_length = Coupon._meta.get_field('code').max_length
+    if len(pattern) > max_length:
+        raise CodeGenerationError(f'Codes can have at most {max_length} characters.')
+    
+    random_length = pattern.count(PLACEHOLDER)
+    capacity = len(ALPHABET) ** random_length
+    if capacity < count * MIN_CAPACITY_RATIO:
+        raise CodeGenerationError(
+            f'The pattern has room for {capacity} codes, too few for {count}; '
+            f'add more "{PLACEHOLDER}" characters.'
+        )
+
+
+def random_codes(pattern, count):
+    """
+    Generate random codes; they may collide with each other or existing codes.
+    
+    Args:
+        pattern: The code pattern
+        count: Number of codes
+        
+    Returns:
+        list: The codes
+    """
+    random_length = pattern.count(PLACEHOLDER)
+    characters = secrets.token_bytes(random_length * count).translate(_TRANSLATION).decode('ascii')
+    template = pattern.replace('{', '{{').replace('}', '}}').replace(PLACEHOLDER, '{}')
+    return [
+        template.format(*characters[start:start + random_length])
+        for start in range(0, random_length * count, random_length)
+    ]
+
+
+def _unique_codes(pattern, count):
+    """Generate count codes that are unique and not taken by existing coupons"""
+    codes = set()
+    stalled_rounds = 0
+    while len(codes) < count:
+        found = len(codes)
+        candidates = list(set(random_codes(pattern, count - len(codes))) - codes)
+        for start in range(0, len(candidates), LOOKUP_BATCH_SIZE):
+            batch = candidates[start:start + LOOKUP_BATCH_SIZE]
+            taken = set(Coupon.objects.filter(code__in=batch).values_list('code', flat=True))
+            codes.update(code for code in batch if code not in taken)
+            
+        stalled_rounds = 0 if len(codes) > found else stalled_rounds + 1
+        if stalled_rounds >= MAX_STALLED_ROUNDS:
+            raise CodeGenerationError('No more unique codes can be generated for the pattern.')
+    return list(codes)
+
+
+def _clone_coupons(template, codes):
+    """Create one copy of the template and its details per code"""
+    coupons = [
+        Coupon(
+            type=template.type,
+            code=code,
+            name=template.name,
+            description=template.description,
+            is_active=template.is_active,
+            expires_at=template.expires_at,
+            is_stackable=template.is_stackable,
+            exclusivity_group=template.exclusivity_group,
+            max_redemptions=template.max_redemptions,
+            max_redemptions_per_user=template.max_redemptions_per_user,
+        )
+        for code in codes
+    ]
+    Coupon.objects.bulk_create(coupons)
+    
+    if template.type == 'cart-wise' and hasattr(template, 'cart_wise_details'):
+        details = template.cart_wise_details
+        CartWiseCoupon.objects.bulk_create([
+            CartWiseCoupon(
+                coupon=coupon,
+                discount_type=details.discount_type,
+                threshold=details.threshold,
+                discount_value=details.discount_value
+            )
+            for coupon in coupons
+        ])
+    elif template.type == 'product-wise' and hasattr(template, 'product_wise_details'):
+        details = template.product_wise_details
+        ProductWiseCoupon.objects.bulk_create([
+            ProductWiseCoupon(
+                coupon=coupon,
+                discount_type=details.discount_type,
+                product_id=details.product_id,
+                category=details.category,
+                brand=details.brand,
+                discount_value=details.discount_value
+            )
+            for coupon in coupons
+        ])
+    elif template.type == 'bxgy' and hasattr(template, 'bxgy_details'):
+        details = template.bxgy_details
+        bxgy_coupons = BxGyCoupon.objects.bulk_create([
+            BxGyCoupon(coupon=coupon, repetition_limit=details.repetition_limit)
+            for coupon in coupons
+        ])
+        # BxGy details only get their primary keys from bulk_create, so products come last
+        for model, products in (
+            (BxGyCouponBuyProduct, details.buy_products.all()),
+            (BxGyCouponGetProduct, details.get_products.all()),
+        ):
+            model.objects.bulk_create([
+                model(bxgy_coupon=bxgy_coupon, product_id=product.product_id, quantity=product.quantity)
+                for bxgy_coupon in bxgy_coupons
+                for product in products
+            ])
+
+
+def generate_coupons(template, count, pattern=None, chunk_size=None):
+    """
+    Create count copies of a template coupon with unique random codes.
+    
+    Args:
+        template: The Coupon to copy, with its details
+        count: Number of coupons to create
+        pattern: The code pattern (defaults to the template code followed by
+            random characters)
+        chunk_size: Coupons created per transaction (defaults to COUPON_CODEGEN_CHUNK_SIZE)
+        
+    Yields:
+        list: The codes of each created chunk, as soon as it is committed
+        
+    Raises:
+        CodeGenerationError: If the pattern cannot produce the codes
+    """
+    pattern = pattern or default_pattern(template)
+    check_pattern(pattern, count)
+    chunk_size = chunk_size or getattr(settings, 'COUPON_CODEGEN_CHUNK_SIZE', 5000)
+    template = Coupon.objects.with_details().get(pk=template.pk)
+    
+    created = 0
+    try:
+        while created < count:
+            size = min(chunk_size, count - created)
+            for attempt in range(3):
+                codes = _unique_codes(pattern, size)
+                try:
+                    with transaction.atomic():
+                        _clone_coupons(template, codes)
+                    break
+                except IntegrityError:
+                    # Another writer took one of the codes since the lookup
+                    continue
+            else:
+                raise CodeGenerationError('Generated codes kept colliding with concurrent writes.')
+            created += size
+            yield codes
+    finally:
+        if created:
+            # bulk_create sends no signals, so the snapshot is dropped here
+            invalidate_snapshot()
+            transaction.on_commit(invalidate_snapshot)
@@ -1,4 +1,5 @@
 from decimal import Decimal
+from .context import get_context
 
 
 def is_applicable(coupon, cart):
@@ -6,17 +7,17 @@ def is_applicable(coupon, cart):
     Check if a cart-wise coupon is applicable to the given cart.
     
     Args:
-        coupon: A Coupon object with cart_wise_details
-        cart: A dictionary containing cart items
+        coupon: A compiled CouponRule with cart_wise_details
+        cart: A CartContext or a dictionary containing cart items
         
     Returns:
         bool: True if the coupon is applicable, False otherwise
     """
-    if not hasattr(coupon, 'cart_wise_details'):
+    if coupon.cart_wise_details is None:
         return False
     
     cart_wise_details = coupon.cart_wise_details
-    cart_total = calculate_cart_total(cart)
+    cart_total = get_context(cart).total
     
     # Check if cart total exceeds the threshold
     return cart_total >= cart_wise_details.threshold
@@ -27,17 +28,18 @@ def calculate_discount(coupon, cart):
     Calculate the discount amount for a cart-wise coupon.
     
     Args:
-        coupon: A Coupon object with cart_wise_details
-        cart: A dictionary containing cart items
+        coupon: A compiled CouponRule with cart_wise_details
+        cart: A CartContext or a dictionary containing cart items
         
     Returns:
         Decimal: The discount amount
     """
-    if not is_applicable(coupon, cart):
+    context = get_context(cart)
+    if not is_applicable(coupon, context):
         return Decimal('0.00')
     
     cart_wise_details = coupon.cart_wise_details
-    cart_total = calculate_cart_total(cart)
+    cart_total = context.total
     
     if cart_wise_details.discount_type == 'percentage':
         # Calculate percentage discount
@@ -59,20 +61,21 @@ def apply_discount(coupon, cart):
     Apply the cart-wise coupon discount to the cart.
     
     Args:
-        coupon: A Coupon object with cart_wise_details
-        cart: A dictionary containing cart items
+        coupon: A compiled CouponRule with cart_wise_details
+        cart: A CartContext or a dictionary containing cart items
         
     Returns:
         dict: The updated cart with discounts applied
     """
-    if not is_applicable(coupon, cart):
-        return create_discounted_cart(cart, Decimal('0.00'))
+    context = get_context(cart)
+    if not is_applicable(coupon, context):
+        return create_discounted_cart(context, Decimal('0.00'))
     
     # Calculate the total discount
-    total_discount = calculate_discount(coupon, cart)
+    total_discount = calculate_discount(coupon, context)
     
     # Create a discounted cart
-    return create_discounted_cart(cart, total_discount)
+    return create_discounted_cart(context, total_discount)
 
 
 def calculate_cart_total(cart):
@@ -80,18 +83,12 @@ def calculate_cart_total(cart):
     Calculate the total value of the cart.
     
     Args:
-        cart: A dictionary containing cart items
+        cart: A CartContext or a dictionary containing cart items
         
     Returns:
         Decimal: The total cart value
     """
-    total = Decimal('0.00')
-    
-    for item in cart.get('items', []):
-        item_total = Decimal(str(item['price'])) * item['quantity']
-        total += item_total
-    
-    return total.quantize(Decimal('0.01'))
+    return get_context(cart).total
 
 
 def create_discounted_cart(cart, total_discount):
@@ -99,21 +96,23 @@ def create_discounted_cart(cart, total_discount):
     Create a new cart object with the discount applied.
     
     Args:
-        cart: A dictionary containing cart items
+        cart: A CartContext or a dictionary containing cart items
         total_discount: The total discount to apply
         
     Returns:
         dict: The updated cart with discount applied
     """
+    context = get_context(cart)
+    
     # Calculate cart total
-    total_price = calculate_cart_total(cart)
+    total_price = context.total
     
     # Calculate final price
     final_price = max(Decimal('0.00'), total_price - total_discount)
     
     # Create discounted cart items (cart-wise discount affects only the total, not individual items)
     discounted_items = []
-    for item in cart.get('items', []):
+    for item in context.items:
         discounted_items.append({
             'product_id': item['product_id'],
             'quantity': item['quantity'],
@@ -129,4 +128,4 @@ def create_discounted_cart(cart, total_discount):
         'final_price': final_price
     }
     
-    return discounted_cart 
\ No newline at end of file
+    return discounted_cart
\ No newline at end of file
@@ -0,0 +1,235 @@
+"""
+Integer minor-unit (cents) engine for discount calculation.
+
+Every amount is handled as an integer number of cents, so the hot path does
+no Decimal arithmetic at all. Results are converted back to Decimal only when
+they leave the engine (see ``from_cents`` and ``to_decimal_cart``).
+
+Rounding rules:
+    - Cart prices, thresholds and fixed discount values have two decimal
+      places and convert to cents exactly. Anything finer is rounded half to
+      even when it enters the engine.
+    - Percentage values are kept in hundredths of a percent (12.5% -> 1250),
+      so a percentage discount on an amount of ``c`` cents is the exact ratio
+      ``c * value / 10000``.
+    - Exact ratios are rounded to whole cents half to even, which is what
+      ``Decimal.quantize(Decimal('0.01'))`` does in the default context.
+      Product-wise totals sum the exact per-item ratios and round once, while
+      the per-item discounts of an applied coupon are rounded one by one,
+      matching the Decimal implementation.
+"""
+from decimal import Decimal, ROUND_HALF_EVEN
+
+from . import bxgy, product_wise
+
+
+PERCENT_SCALE = 10000  # cents * hundredths of a percent -> cents
+SHIPPING_COST_CENTS = 500  # Mirrors the placeholder shipping cost of cart_wise
+
+
+def to_cents(amount):
+    """Convert a Decimal (or number) amount to an integer number of cents"""
+    return int(Decimal(str(amount)).scaleb(2).to_integral_value(rounding=ROUND_HALF_EVEN))
+
+
+def from_cents(cents):
+    """Convert an integer number of cents back to a Decimal amount"""
+    return Decimal(cents).scaleb(-2)
+
+
+def round_div(numerator, denominator):
+    """Divide two integers, rounding the result half to even"""
+    sign = -1 if numerator < 0 else 1
+    quotient, remainder = divmod(abs(numerator), denominator)
+    twice_remainder = remainder * 2
+    if twice_remainder > denominator or (twice_remainder == denominator and quotient % 2 == 1):
+        quotient += 1
+    return sign * quotient
+
+
+def is_applicable(coupon, context):
+    """
+    Check if a coupon is applicable to the cart.
+    
+    Args:
+        coupon: A compiled CouponRule
+        context: A CartContext
+        
+    Returns:
+        bool: True if the coupon is applicable, False otherwise
+    """
+    if coupon.type == 'cart-wise':
+        if coupon.cart_wise_details is None:
+            return False
+        return context.cents().total >= coupon.cart_wise_details.threshold_cents
+    elif coupon.type == 'product-wise':
+        return product_wise.is_applicable(coupon, context)
+    elif coupon.type == 'bxgy':
+        return bxgy.is_applicable(coupon, context)
+    
+    return False
+
+
+def calculate_discount(coupon, context):
+    """
+    Calculate the discount amount of a coupon in cents.
+    
+    Args:
+        coupon: A compiled CouponRule
+        context: A CartContext
+        
+    Returns:
+        int: The discount in cents, or None if the coupon is not applicable
+    """
+    if not is_applicable(coupon, context):
+        return None
+    
+    if coupon.type == 'cart-wise':
+        return _cart_wise_discount(coupon.cart_wise_details, context.cents().total)
+    elif coupon.type == 'product-wise':
+        numerators = _product_wise_numerators(coupon.product_wise_details, context)
+        return round_div(sum(numerators.values()), PERCENT_SCALE)
+    elif coupon.type == 'bxgy':
+        return sum(_bxgy_item_discounts(coupon, context).values())
+    
+    return None
+
+
+def apply_discount(coupon, context):
+    """
+    Apply a coupon to the cart.
+    
+    Args:
+        coupon: A compiled CouponRule
+        context: A CartContext
+        
+    Returns:
+        dict: The discounted cart with every amount in cents, or None if the
+            coupon is not applicable
+    """
+    if not is_applicable(coupon, context):
+        return None
+    
+    if coupon.type == 'cart-wise':
+        total_discount = _cart_wise_discount(coupon.cart_wise_details, context.cents().total)
+        return _create_discounted_cart(context, {}, total_discount)
+    elif coupon.type == 'product-wise':
+        numerators = _product_wise_numerators(coupon.product_wise_details, context)
+        item_discounts = {
+            idx: round_div(numerator, PERCENT_SCALE)
+            for idx, numerator in numerators.items()
+        }
+        return _create_discounted_cart(context, item_discounts)
+    elif coupon.type == 'bxgy':
+        return _create_discounted_cart(context, _bxgy_item_discounts(coupon, context))
+    
+    return None
+
+
+def to_decimal_cart(discounted_cart):
+    """
+    Convert a discounted cart produced by this engine to Decimal amounts.
+    
+    Args:
+        discounted_cart: A discounted cart with amounts in cents
+        
+    Returns:
+        dict: The same cart with Decimal amounts
+    """
+    return {
+        'items': [
+            {
+                'product_id': item['product_id'],
+                'quantity': item['quantity'],
+                'price': from_cents(item['price']),
+                'total_discount': from_cents(item['total_discount'])
+            }
+            for item in discounted_cart['items']
+        ],
+        'total_price': from_cents(discounted_cart['total_price']),
+        'total_discount': from_cents(discounted_cart['total_discount']),
+        'final_price': from_cents(discounted_cart['final_price'])
+    }
+
+
+def _cart_wise_discount(cart_wise_details, total_cents):
+    if cart_wise_details.discount_type == 'percentage':
+        return round_div(total_cents * cart_wise_details.discount_value_cents, PERCENT_SCALE)
+    elif cart_wise_details.discount_type == 'fixed':
+        return min(cart_wise_details.discount_value_cents, total_cents)
+    elif cart_wise_details.discount_type == 'shipping':
+        return SHIPPING_COST_CENTS
+    
+    return 0
+
+
+def _product_wise_numerators(product_wise_details, context):
+    """Exact per-item discounts, scaled by PERCENT_SCALE"""
+    price_cents = context.cents().prices
+    value_cents = product_wise_details.discount_value_cents
+    numerators = {}
+    
+    for idx in product_wise.matching_lines(context, product_wise_details):
+        quantity = context.items[idx]['quantity']
+        
+        if product_wise_details.discount_type == 'percentage':
+            numerators[idx] = price_cents[idx] * value_cents * quantity
+        else:  # fixed discount, never more than the item price
+            numerators[idx] = min(value_cents, price_cents[idx]) * quantity * PERCENT_SCALE
+            
+    return numerators
+
+
+def _bxgy_item_discounts(coupon, context):
+    repetition_count = bxgy.calculate_repetition_count(coupon, context)
+    if repetition_count == 0:
+        return {}
+    
+    price_cents = context.cents().prices
+    get_products = coupon.bxgy_details.get_products
+    
+    # Lowest-priced eligible items first, ties in cart order
+    eligible_indexes = sorted(
+        idx
+        for product_id in get_products
+        for idx in context.product_lines.get(product_id, ())
+    )
+    eligible_indexes.sort(key=price_cents.__getitem__)
+    
+    remaining_repetitions = repetition_count
+    item_discounts = {}
+    
+    for idx in eligible_indexes:
+        if remaining_repetitions <= 0:
+            break
+        
+        item = context.items[idx]
+        required_quantity = get_products[item['product_id']]
+        repeats_for_this_product = min(remaining_repetitions, item['quantity'] // required_quantity)
+        
+        if repeats_for_this_product > 0:
+            item_discounts[idx] = repeats_for_this_product * required_quantity * price_cents[idx]
+            remaining_repetitions -= repeats_for_this_product
+            
+    return item_discounts
+
+
+def _create_discounted_cart(context, item_discounts, total_discount=None):
+    cents = context.cents()
+    if total_discount is None:
+        total_discount = sum(item_discounts.values())
+        
+    return {
+        'items': [
+            {
+                'product_id': item['product_id'],
+                'quantity': item['quantity'],
+                'price': cents.prices[idx],
+                'total_discount': item_discounts.get(idx, 0)
+            }
+            for idx, item in enumerate(context.items)
+        ],
+        'total_price': cents.total,
+        'total_discount': total_discount,
+        'final_price': max(0, cents.total - total_discount)
+    }
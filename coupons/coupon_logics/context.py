@@ -0,0 +1,92 @@
+from decimal import Decimal
+from collections import defaultdict
+from typing import NamedTuple
+
+
+class CartCents(NamedTuple):
+    """Cart prices and total in integer cents, used by the cents engine"""
+    prices: list
+    total: int
+
+
+class CartContext:
+    """
+    Precomputed view of a cart shared by all coupon evaluators.
+    
+    The cart is walked once: prices are parsed into Decimals, line totals and
+    the cart total are computed, and item indexes are grouped by product,
+    category and brand so that evaluating a coupon never has to iterate over
+    the cart again.
+    """
+    __slots__ = (
+        'items',
+        'prices',
+        'line_totals',
+        'total',
+        'product_quantities',
+        'product_lines',
+        'category_lines',
+        'brand_lines',
+        '_cents',
+    )
+    
+    def __init__(self, cart):
+        self.items = list(cart.get('items', []))
+        self.prices = []
+        self.line_totals = []
+        
+        total = Decimal('0.00')
+        product_quantities = defaultdict(int)
+        product_lines = defaultdict(list)
+        category_lines = defaultdict(list)
+        brand_lines = defaultdict(list)
+        
+        for idx, item in enumerate(self.items):
+            price = Decimal(str(item['price']))
+            line_total = price * item['quantity']
+            self.prices.append(price)
+            self.line_totals.append(line_total)
+            total += line_total
+            
+            product_quantities[item['product_id']] += item['quantity']
+            product_lines[item['product_id']].append(idx)
+            if item.get('category'):
+                category_lines[item['category']].append(idx)
+            if item.get('brand'):
+                brand_lines[item['brand']].append(idx)
+                
+        self.total = total.quantize(Decimal('0.01'))
+        self.product_quantities = dict(product_quantities)
+        self.product_lines = dict(product_lines)
+        self.category_lines = dict(category_lines)
+        self.brand_lines = dict(brand_lines)
+        self._cents = None
+    
+    def cents(self):
+        """
+        Return the item prices and cart total in integer cents.
+        
+        Only the cents engine needs these, so they are computed on first use.
+        """
+        if self._cents is None:
+            from .cents import to_cents
+            
+            prices = [to_cents(price) for price in self.prices]
+            total = sum(price * item['quantity'] for price, item in zip(prices, self.items))
+            self._cents = CartCents(prices=prices, total=total)
+        return self._cents
+
+
+def get_context(cart):
+    """
+    Return a CartContext for the cart, building one only if needed.
+    
+    Args:
+        cart: A CartContext or a dictionary containing cart items
+        
+    Returns:
+        CartContext: The precomputed cart
+    """
+    if isinstance(cart, CartContext):
+        return cart
+    return CartContext(cart)
@@ -1,4 +1,5 @@
 from decimal import Decimal
+from .context import get_context
 
 
 def is_applicable(coupon, cart):
@@ -6,23 +7,17 @@ def is_applicable(coupon, cart):
     Check if a product-wise coupon is applicable to the given cart.
     
     Args:
-        coupon: A Coupon object with product_wise_details
-        cart: A dictionary containing cart items
+        coupon: A compiled CouponRule with product_wise_details
+        cart: A CartContext or a dictionary containing cart items
         
     Returns:
         bool: True if the coupon is applicable, False otherwise
     """
-    if not hasattr(coupon, 'product_wise_details'):
+    if coupon.product_wise_details is None:
         return False
     
-    product_wise_details = coupon.product_wise_details
-    
     # Check if cart contains product that matches coupon criteria
-    for item in cart.get('items', []):
-        if matches_product_criteria(item, product_wise_details):
-            return True
-    
-    return False
+    return bool(matching_lines(get_context(cart), coupon.product_wise_details))
 
 
 def calculate_discount(coupon, cart):
@@ -30,31 +25,20 @@ def calculate_discount(coupon, cart):
     Calculate the discount amount for a product-wise coupon.
     
     Args:
-        coupon: A Coupon object with product_wise_details
-        cart: A dictionary containing cart items
+        coupon: A compiled CouponRule with product_wise_details
+        cart: A CartContext or a dictionary containing cart items
         
     Returns:
         Decimal: The discount amount
     """
-    if not is_applicable(coupon, cart):
+    context = get_context(cart)
+    if not is_applicable(coupon, context):
         return Decimal('0.00')
     
-    product_wise_details = coupon.product_wise_details
     total_discount = Decimal('0.00')
     
-    for item in cart.get('items', []):
-        if matches_product_criteria(item, product_wise_details):
-            item_price = Decimal(str(item['price']))
-            quantity = item['quantity']
-            
-            if product_wise_details.discount_type == 'percentage':
-                # Calculate percentage discount
-                item_discount = (item_price * product_wise_details.discount_value / 100) * quantity
-            else:  # fixed discount
-                # Apply fixed amount discount per item, but not more than the item price
-                item_discount = min(product_wise_details.discount_value, item_price) * quantity
-            
-            total_discount += item_discount
+    for item_discount in calculate_item_discounts(coupon, context).values():
+        total_discount += item_discount
     
     return total_discount.quantize(Decimal('0.01'))
 
@@ -64,63 +48,85 @@ def apply_discount(coupon, cart):
     Apply the product-wise coupon discount to the cart.
     
     Args:
-        coupon: A Coupon object with product_wise_details
-        cart: A dictionary containing cart items
+        coupon: A compiled CouponRule with product_wise_details
+        cart: A CartContext or a dictionary containing cart items
         
     Returns:
         dict: The updated cart with discounts applied
     """
-    if not is_applicable(coupon, cart):
-        return create_discounted_cart(cart, {})
+    context = get_context(cart)
+    if not is_applicable(coupon, context):
+        return create_discounted_cart(context, {})
+    
+    # Round the discount of each discounted item
+    item_discounts = {
+        idx: item_discount.quantize(Decimal('0.01'))
+        for idx, item_discount in calculate_item_discounts(coupon, context).items()
+    }
+    
+    # Create discounted cart
+    return create_discounted_cart(context, item_discounts)
+
+
+def calculate_item_discounts(coupon, context):
+    """
+    Calculate the unrounded discount for every cart item matching the coupon.
     
+    Args:
+        coupon: A compiled CouponRule with product_wise_details
+        context: A CartContext
+        
+    Returns:
+        dict: Mapping of item index to discount amount
+    """
     product_wise_details = coupon.product_wise_details
-    discounted_items = []
     item_discounts = {}
     
-    # Calculate discounts for each item
-    for idx, item in enumerate(cart.get('items', [])):
-        if matches_product_criteria(item, product_wise_details):
-            item_price = Decimal(str(item['price']))
-            quantity = item['quantity']
+    for idx in matching_lines(context, product_wise_details):
+        item_price = context.prices[idx]
+        quantity = context.items[idx]['quantity']
             
-            if product_wise_details.discount_type == 'percentage':
-                # Calculate percentage discount
-                per_item_discount = item_price * product_wise_details.discount_value / 100
-            else:  # fixed discount
-                # Apply fixed amount discount per item, but not more than the item price
-                per_item_discount = min(product_wise_details.discount_value, item_price)
+        if product_wise_details.discount_type == 'percentage':
+            # Calculate percentage discount
+            per_item_discount = item_price * product_wise_details.discount_value / 100
+        else:  # fixed discount
+            # Apply fixed amount discount per item, but not more than the item price
+            per_item_discount = min(product_wise_details.discount_value, item_price)
             
-            item_discount = per_item_discount * quantity
-            item_discounts[idx] = item_discount.quantize(Decimal('0.01'))
+        item_discounts[idx] = per_item_discount * quantity
     
-    # Create discounted cart
-    return create_discounted_cart(cart, item_discounts)
+    return item_discounts
 
 
-def matches_product_criteria(item, product_wise_details):
+def matching_lines(context, product_wise_details):
     """
-    Check if a cart item matches the product-wise coupon criteria.
+    Find the cart items that match the product-wise coupon criteria.
+    
+    Uses the product, category and brand groupings of the CartContext, so
+    the cart is not iterated.
     
     Args:
-        item: A cart item
+        context: A CartContext
         product_wise_details: Product-wise coupon details
         
     Returns:
-        bool: True if the item matches the criteria, False otherwise
+        list: Sorted indexes of the matching cart items
     """
-    # Check if matches by product_id
-    if product_wise_details.product_id and item['product_id'] == product_wise_details.product_id:
-        return True
+    lines = set()
     
-    # Check if matches by category
-    if product_wise_details.category and 'category' in item and item['category'] == product_wise_details.category:
-        return True
-    
-    # Check if matches by brand
-    if product_wise_details.brand and 'brand' in item and item['brand'] == product_wise_details.brand:
-        return True
-    
-    return False
+    # Match by product_id
+    if product_wise_details.product_id:
+        lines.update(context.product_lines.get(product_wise_details.product_id, ()))
+        
+    # Match by category
+    if product_wise_details.category:
+        lines.update(context.category_lines.get(product_wise_details.category, ()))
+        
+    # Match by brand
+    if product_wise_details.brand:
+        lines.update(context.brand_lines.get(product_wise_details.brand, ()))
+        
+    return sorted(lines)
 
 
 def create_discounted_cart(cart, item_discounts):
@@ -128,42 +134,37 @@ def create_discounted_cart(cart, item_discounts):
     Create a new cart object with the discount applied to specific items.
     
     Args:
-        cart: A dictionary containing cart items
+        cart: A CartContext or a dictionary containing cart items
         item_discounts: Dictionary mapping item index to discount amount
         
     Returns:
         dict: The updated cart with discount applied
     """
+    context = get_context(cart)
     discounted_items = []
-    total_price = Decimal('0.00')
     total_discount = Decimal('0.00')
     
     # Create discounted cart items
-    for idx, item in enumerate(cart.get('items', [])):
-        item_price = Decimal(str(item['price']))
-        quantity = item['quantity']
-        item_total = item_price * quantity
-        total_price += item_total
-        
+    for idx, item in enumerate(context.items):
         item_discount = item_discounts.get(idx, Decimal('0.00'))
         total_discount += item_discount
         
         discounted_items.append({
             'product_id': item['product_id'],
             'quantity': item['quantity'],
-            'price': item_price,
+            'price': context.prices[idx],
             'total_discount': item_discount
         })
     
     # Calculate final price
-    final_price = max(Decimal('0.00'), total_price - total_discount)
+    final_price = max(Decimal('0.00'), context.total - total_discount)
     
     # Create the discounted cart
     discounted_cart = {
         'items': discounted_items,
-        'total_price': total_price.quantize(Decimal('0.01')),
+        'total_price': context.total,
         'total_discount': total_discount.quantize(Decimal('0.01')),
         'final_price': final_price.quantize(Decimal('0.01'))
     }
     
-    return discounted_cart 
\ No newline at end of file
+    return discounted_cart
\ No newline at end of file
@@ -0,0 +1,130 @@
+"""
+Streaming export of coupons as NDJSON or CSV.
+
+Coupons are read by keyset iteration on the primary key, COUPON_EXPORT_CHUNK_SIZE
+at a time, with their details loaded per chunk, so an export runs a constant
+number of queries per chunk and holds at most one chunk in memory, however
+large the table is. NDJSON lines have the shape of the coupon API; CSV rows
+use the columns read by the bulk import, so both formats can be imported back.
+"""
+import csv
+import json
+
+from django.conf import settings
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from .importer import CSV_COLUMNS, DETAIL_COLUMNS, READ_ONLY_COLUMNS
+from .serializers import CouponSerializer
+
+
+EXPORT_CSV_COLUMNS = READ_ONLY_COLUMNS[:1] + CSV_COLUMNS + READ_ONLY_COLUMNS[1:]
+
+
+def iter_coupons(queryset, chunk_size=None):
+    """
+    Iterate over coupons in primary key order, one chunk per query.
+    
+    Args:
+        queryset: The coupons to export
+        chunk_size: Coupons loaded per query (defaults to COUPON_EXPORT_CHUNK_SIZE)
+        
+    Yields:
+        Coupon: Each coupon, with its details loaded
+    """
+    chunk_size = chunk_size or getattr(settings, 'COUPON_EXPORT_CHUNK_SIZE', 1000)
+    queryset = queryset.with_details().order_by('pk')
+    last_pk = None
+    
+    while True:
+        chunk_queryset = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk_queryset[:chunk_size])
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1].pk
+
+
+def iter_representations(queryset, chunk_size=None):
+    """Iterate over the API representation of each coupon"""
+    # One serializer renders every coupon, so its fields are built once
+    serializer = CouponSerializer()
+    for coupon in iter_coupons(queryset, chunk_size):
+        yield serializer.to_representation(coupon)
+
+
+def _format_products(products):
+    return ';'.join(f"{product['product_id']}:{product['quantity']}" for product in products)
+
+
+def csv_row(representation):
+    """
+    Flatten the API representation of a coupon into a CSV row.
+    
+    Returns:
+        list: The values of EXPORT_CSV_COLUMNS
+    """
+    values = dict(representation)
+    if representation['type'] in DETAIL_COLUMNS:
+        details_field, columns = DETAIL_COLUMNS[representation['type']]
+        details = representation.get(details_field) or {}
+        for column in columns:
+            value = details.get(column)
+            if column in ('buy_products', 'get_products'):
+                value = _format_products(value or [])
+            values[column] = value
+    return ['' if values.get(column) is None else values[column] for column in EXPORT_CSV_COLUMNS]
+
+
+class ExportRenderer(BaseRenderer):
+    """
+    Selects an export format by content negotiation (``Accept`` or ``?format=``).
+    
+    Exports are streamed by the view; only error responses are rendered
+    here, as JSON.
+    """
+    charset = 'utf-8'
+    
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data, cls=JSONEncoder).encode(self.charset)
+
+
+class NDJSONRenderer(ExportRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+class CSVRenderer(ExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+RENDERERS = (NDJSONRenderer, CSVRenderer)
+
+
+class _Echo:
+    """A file-like object that returns what is written to it, for csv.writer"""
+    
+    def write(self, value):
+        return value
+
+
+def stream_ndjson(queryset, chunk_size=None):
+    """Render coupons as NDJSON lines"""
+    for representation in iter_representations(queryset, chunk_size):
+        yield json.dumps(representation, cls=JSONEncoder) + '\n'
+
+
+def stream_csv(queryset, chunk_size=None):
+    """Render coupons as CSV lines, starting with the header"""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_CSV_COLUMNS)
+    for representation in iter_representations(queryset, chunk_size):
+        yield writer.writerow(csv_row(representation))
+
+
+def stream(queryset, format, chunk_size=None):
+    """Render coupons in the given format ('ndjson' or 'csv')"""
+    if format == 'csv':
+        return stream_csv(queryset, chunk_size)
+    return stream_ndjson(queryset, chunk_size)
@@ -0,0 +1,345 @@
+"""
+Fast-path validation and rendering for the cart endpoints.
+
+Validating a cart through ``CartSerializer`` runs the whole DRF field
+machinery for every item, and the views used to re-validate their own
+responses through the response serializers before rendering them. For large
+carts this costs more than evaluating the coupons.
+
+The declared fields of a serializer are compiled once into plain functions
+that convert the data exactly like DRF would. Anything the compiled functions
+cannot handle exactly like DRF (an invalid value, a type DRF would coerce, a
+field option that is not supported) makes them give up, and the serializer
+itself is used instead, so responses and error messages are always the same.
+Set COUPON_FAST_PATH to False to always use the serializers.
+"""
+import decimal
+import uuid
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.validators import (
+    MaxLengthValidator,
+    MaxValueValidator,
+    MinLengthValidator,
+    MinValueValidator,
+    ProhibitNullCharactersValidator
+)
+from rest_framework import serializers
+from rest_framework.fields import empty
+from rest_framework.settings import api_settings
+from rest_framework.validators import ProhibitSurrogateCharactersValidator
+
+
+class Irregular(Exception):
+    """Raised for data that must go through the serializer"""
+
+
+class Unsupported(Exception):
+    """Raised while compiling a field that has no fast path"""
+
+
+# Validators implied by the field options handled below
+KNOWN_VALIDATORS = (
+    MaxLengthValidator,
+    MaxValueValidator,
+    MinLengthValidator,
+    MinValueValidator,
+    ProhibitNullCharactersValidator,
+    ProhibitSurrogateCharactersValidator
+)
+
+
+def enabled():
+    """Check if the fast path is used"""
+    return getattr(settings, 'COUPON_FAST_PATH', True)
+
+
+def _check_bounds(value, min_value, max_value):
+    if min_value is not None and value < min_value:
+        raise Irregular
+    if max_value is not None and value > max_value:
+        raise Irregular
+
+
+def _compile_integer(field):
+    min_value, max_value = field.min_value, field.max_value
+    
+    def convert(value):
+        # DRF also accepts strings and floats; those are left to it
+        if type(value) is not int:
+            raise Irregular
+        _check_bounds(value, min_value, max_value)
+        return value
+    
+    return convert, int
+
+
+def _compile_decimal(field):
+    if field.localize or field.max_digits is None or field.decimal_places is None:
+        raise Unsupported
+    
+    max_digits = field.max_digits
+    decimal_places = field.decimal_places
+    max_whole_digits = field.max_whole_digits
+    min_value, max_value = field.min_value, field.max_value
+    exponent = decimal.Decimal('.1') ** decimal_places
+    context = decimal.Context(prec=max_digits, rounding=field.rounding or decimal.getcontext().rounding)
+    
+    def convert(value):
+        if type(value) not in (str, int, float, decimal.Decimal):
+            raise Irregular
+        text = str(value).strip()
+        if len(text) > field.MAX_STRING_LENGTH:
+            raise Irregular
+        try:
+            number = decimal.Decimal(text)
+        except decimal.DecimalException:
+            raise Irregular
+        if not number.is_finite():
+            raise Irregular
+        
+        # The precision rules of DecimalField.validate_precision
+        sign, digit_tuple, number_exponent = number.as_tuple()
+        digits = len(digit_tuple)
+        if number_exponent >= 0:
+            total_digits = whole_digits = digits + number_exponent
+            places = 0
+        elif digits > -number_exponent:
+            total_digits = digits
+            whole_digits = digits + number_exponent
+            places = -number_exponent
+        else:
+            total_digits = places = -number_exponent
+            whole_digits = 0
+        if total_digits > max_digits or places > decimal_places or whole_digits > max_whole_digits:
+            raise Irregular
+        
+        number = number.quantize(exponent, context=context)
+        _check_bounds(number, min_value, max_value)
+        return number
+    
+    if getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING):
+        return convert, '{:f}'.format
+    return convert, lambda number: number
+
+
+def _compile_char(field):
+    allow_blank = field.allow_blank
+    trim_whitespace = field.trim_whitespace
+    max_length, min_length = field.max_length, field.min_length
+    
+    def convert(value):
+        # DRF also coerces numbers to strings; those are left to it
+        if type(value) is not str:
+            raise Irregular
+        if value == '' or (trim_whitespace and value.isspace()):
+            if not allow_blank:
+                raise Irregular
+            return ''
+        if trim_whitespace:
+            value = value.strip()
+        if '\x00' in value or not (value.isascii() or _is_encodable(value)):
+            raise Irregular
+        if max_length is not None and len(value) > max_length:
+            raise Irregular
+        if min_length is not None and len(value) < min_length:
+            raise Irregular
+        return value
+    
+    return convert, str
+
+
+def _is_encodable(value):
+    # Lone surrogates, which ProhibitSurrogateCharactersValidator rejects, cannot be encoded
+    try:
+        value.encode('utf-8')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _compile_uuid(field):
+    if field.uuid_format != 'hex_verbose':
+        raise Unsupported
+    
+    def convert(value):
+        # DRF also parses strings and integers; those are left to it
+        if not isinstance(value, uuid.UUID):
+            raise Irregular
+        return value
+    
+    return convert, str
+
+
+def _compile_list(field):
+    if type(field).to_internal_value is not serializers.ListSerializer.to_internal_value:
+        raise Unsupported
+    
+    convert_child, represent_child = _compile_field(field.child)
+    allow_empty = field.allow_empty
+    max_length, min_length = field.max_length, field.min_length
+    
+    def convert(value):
+        if type(value) is not list:
+            raise Irregular
+        if (not value and not allow_empty) or (max_length is not None and len(value) > max_length):
+            raise Irregular
+        if min_length is not None and len(value) < min_length:
+            raise Irregular
+        return [convert_child(child) for child in value]
+    
+    def represent(value):
+        return [represent_child(child) for child in value]
+    
+    return convert, represent
+
+
+def _compile_serializer(serializer):
+    serializer_class = type(serializer)
+    for method in ('to_internal_value', 'to_representation', 'validate'):
+        if getattr(serializer_class, method) is not getattr(serializers.Serializer, method):
+            raise Unsupported
+    if serializer.validators:
+        raise Unsupported
+    
+    fields = []
+    for name, field in serializer.fields.items():
+        if hasattr(serializer, f'validate_{name}') or field.source != name or field.write_only:
+            raise Unsupported
+        if field.read_only:
+            continue
+        if field.default is not empty:
+            raise Unsupported
+        convert_field, represent_field = _compile_field(field)
+        fields.append((name, field.required, field.allow_null, convert_field, represent_field))
+        
+    def convert(value):
+        # Parsed JSON only; QueryDicts and other mappings are left to DRF
+        if type(value) is not dict:
+            raise Irregular
+        validated = {}
+        for name, required, allow_null, convert_field, represent_field in fields:
+            if name in value:
+                field_value = value[name]
+                if field_value is None:
+                    if not allow_null:
+                        raise Irregular
+                    validated[name] = None
+                else:
+                    validated[name] = convert_field(field_value)
+            elif required:
+                raise Irregular
+        return validated
+    
+    def represent(value):
+        representation = {}
+        for name, required, allow_null, convert_field, represent_field in fields:
+            if name in value:
+                field_value = value[name]
+                representation[name] = None if field_value is None else represent_field(field_value)
+            elif allow_null:
+                representation[name] = None
+        return representation
+    
+    return convert, represent
+
+
+FIELD_COMPILERS = {
+    serializers.IntegerField: _compile_integer,
+    serializers.DecimalField: _compile_decimal,
+    serializers.CharField: _compile_char,
+    serializers.UUIDField: _compile_uuid,
+}
+
+
+def _compile_field(field):
+    """
+    Compile a serializer field.
+    
+    Returns:
+        tuple: A function converting input like the field's validation, and
+            a function rendering converted values like its representation
+    """
+    if isinstance(field, serializers.ListSerializer):
+        return _compile_list(field)
+    if isinstance(field, serializers.Serializer):
+        return _compile_serializer(field)
+    
+    # Subclasses may change the conversion, so only the exact field classes are compiled
+    compiler = FIELD_COMPILERS.get(type(field))
+    if compiler is None:
+        raise Unsupported
+    if any(not isinstance(validator, KNOWN_VALIDATORS) for validator in field.validators):
+        raise Unsupported
+    return compiler(field)
+
+
+@lru_cache(maxsize=None)
+def compile_serializer(serializer_class):
+    """
+    Compile the fields of a serializer class.
+    
+    Args:
+        serializer_class: A Serializer class
+        
+    Returns:
+        tuple: The convert and represent functions, or None if the serializer
+            has no fast path
+    """
+    try:
+        return _compile_serializer(serializer_class())
+    except Unsupported:
+        return None
+
+
+def validate(serializer_class, data):
+    """
+    Validate request data like ``serializer_class(data=data).is_valid()``.
+    
+    Args:
+        serializer_class: The serializer class validating the data
+        data: The parsed request data
+        
+    Returns:
+        tuple: The validated data and None, or None and the serializer errors
+    """
+    compiled = compile_serializer(serializer_class) if enabled() else None
+    if compiled is not None:
+        try:
+            return compiled[0](data), None
+        except Irregular:
+            pass
+        
+    serializer = serializer_class(data=data)
+    if not serializer.is_valid():
+        return None, serializer.errors
+    return serializer.validated_data, None
+
+
+def encode(serializer_class, data):
+    """
+    Render response data built by the services.
+    
+    Gives the same result as building ``serializer_class(data=data)``,
+    calling ``is_valid()`` and reading ``.data``, without validating every
+    field through DRF.
+    
+    Args:
+        serializer_class: The response serializer class
+        data: The response data
+        
+    Returns:
+        dict: The representation of the data
+    """
+    compiled = compile_serializer(serializer_class) if enabled() else None
+    if compiled is not None:
+        convert, represent = compiled
+        try:
+            return represent(convert(data))
+        except Irregular:
+            pass
+        
+    response_serializer = serializer_class(data=data)
+    response_serializer.is_valid()  # Invalid data is rendered from the initial data, like before
+    return response_serializer.data
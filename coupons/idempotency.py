@@ -0,0 +1,271 @@
+"""
+Idempotency keys for apply-coupon requests.
+
+A client that retries a request after a timeout sends the same
+``Idempotency-Key`` header with it. The response of the first request is
+stored under the key, with a fingerprint of the request (the coupon, the
+cart, the redemption mode and the user), and replayed for every retry
+without evaluating the cart again, so a retried redemption is only counted
+once. Reusing a key for a different request is rejected, and so is a retry
+that arrives while the first request is still running.
+
+While a request runs, its key stays claimed: the claim expires after
+COUPON_IDEMPOTENCY_CLAIM_TIMEOUT seconds, so a key is freed if its worker
+dies, and is refreshed several times per timeout while the request is alive,
+so a slow request is never run a second time by a retry. One thread per
+process refreshes the claims of all running requests.
+
+The store is the COUPON_IDEMPOTENCY_CACHE alias of Django's cache framework,
+which bounds the number of stored responses; they are kept for
+COUPON_IDEMPOTENCY_TIMEOUT seconds. Retries may reach any worker process, so
+the store must be shared by all of them (the database cache by default, or
+e.g. Redis); caches local to a process are refused.
+"""
+import hashlib
+import json
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import status
+
+from .result_cache import cart_fingerprint
+from .snapshot import is_local_cache
+
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+# Refreshes of a claim per COUPON_IDEMPOTENCY_CLAIM_TIMEOUT
+CLAIM_REFRESHES = 3
+
+
+class IdempotencyError(Exception):
+    """Raised when a request cannot be run under its idempotency key"""
+    status_code = status.HTTP_400_BAD_REQUEST
+
+
+class KeyReused(IdempotencyError):
+    """Raised when a key is sent again with a different request"""
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+class RequestInProgress(IdempotencyError):
+    """Raised when a key is sent again before the first request finished"""
+    status_code = status.HTTP_409_CONFLICT
+
+
+def get_store():
+    """
+    Return the response store, or None if idempotency keys are ignored.
+    
+    Raises:
+        ImproperlyConfigured: If the cache is local to this process, so
+            retries reaching another worker would run the request again
+    """
+    alias = getattr(settings, 'COUPON_IDEMPOTENCY_CACHE', None)
+    if not alias:
+        return None
+    store = caches[alias]
+    if is_local_cache(store):
+        raise ImproperlyConfigured(
+            f'COUPON_IDEMPOTENCY_CACHE must be a cache shared by all worker processes, not {alias!r}.'
+        )
+    return store
+
+
+def check_key(key):
+    """
+    Check an Idempotency-Key header value.
+    
+    Raises:
+        IdempotencyError: If the key is empty or too long
+    """
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise IdempotencyError(f'The {HEADER} header must have 1 to {MAX_KEY_LENGTH} characters.')
+
+
+def request_fingerprint(coupon_id, cart, data, mode):
+    """
+    Hash what makes up an apply-coupon request.
+    
+    Args:
+        coupon_id: The ID of the coupon
+        cart: The validated cart
+        data: The request data, for the user the coupon is redeemed for
+        mode: The redemption mode of the request (see views.redemption_mode)
+        
+    Returns:
+        str: A hex digest identifying the request
+    """
+    user_id = data.get('user_id') if isinstance(data, dict) else None
+    request = [str(coupon_id), cart_fingerprint(cart, ordered=True), mode, user_id]
+    return hashlib.blake2b(json.dumps(request, default=str).encode(), digest_size=16).hexdigest()
+
+
+def _store_key(key):
+    # Client keys may hold characters or lengths some cache backends reject
+    return f'coupons:idempotency:{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}'
+
+
+def _timeout():
+    return getattr(settings, 'COUPON_IDEMPOTENCY_TIMEOUT', 86400)
+
+
+def claim_timeout():
+    """Seconds a key stays claimed by a request that stopped refreshing it"""
+    return getattr(settings, 'COUPON_IDEMPOTENCY_CLAIM_TIMEOUT', 60)
+
+
+class Claim:
+    """The claim of a running request on its key"""
+    __slots__ = ('store', 'store_key', 'timeout', 'due', 'idle')
+    
+    def __init__(self, store, store_key, timeout):
+        self.store = store
+        self.store_key = store_key
+        self.timeout = timeout
+        self.due = time.monotonic() + timeout / CLAIM_REFRESHES
+        # Cleared while the claim is being refreshed
+        self.idle = threading.Event()
+        self.idle.set()
+            
+        
+class ClaimRefresher:
+    """The thread refreshing the claims of the running requests of this process"""
+    
+    def __init__(self):
+        self.changed = threading.Condition()
+        self.claims = set()
+        self.thread = None
+        
+    def hold(self, store, store_key, timeout):
+        """Start refreshing a claim, returning it for release"""
+        claim = Claim(store, store_key, timeout)
+        with self.changed:
+            self.claims.add(claim)
+            # Threads do not survive a fork
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='coupon-idempotency-claims', daemon=True)
+                self.thread.start()
+            self.changed.notify()
+        return claim
+    
+    def release(self, claim):
+        """
+        Stop refreshing a claim.
+        
+        Returns:
+            threading.Event: Set once no refresh of the claim is running, so
+                the response can be stored without a refresh overwriting its
+                timeout
+        """
+        with self.changed:
+            self.claims.discard(claim)
+        return claim.idle
+    
+    def run(self):
+        while True:
+            with self.changed:
+                now = time.monotonic()
+                due = [claim for claim in self.claims if claim.due <= now]
+                if not due:
+                    next_due = min((claim.due for claim in self.claims), default=None)
+                    self.changed.wait(None if next_due is None else next_due - now)
+                    continue
+                for claim in due:
+                    claim.due = now + claim.timeout / CLAIM_REFRESHES
+                    claim.idle.clear()
+                    
+            for claim in due:
+                try:
+                    claim.store.touch(claim.store_key, claim.timeout)
+                except Exception:
+                    pass  # Retried at the next refresh
+                finally:
+                    claim.idle.set()
+                    
+                    
+refresher = ClaimRefresher()
+        
+        
+def _stored_response(entry, fingerprint):
+    if entry['fingerprint'] != fingerprint:
+        raise KeyReused(f'The {HEADER} was already used for a different request.')
+    if entry['response'] is None:
+        raise RequestInProgress(f'A request with this {HEADER} is still in progress.')
+    return entry['response']
+
+
+def run(store, key, fingerprint, respond):
+    """
+    Run a request once per idempotency key.
+    
+    Args:
+        store: The response store, see get_store
+        key: The Idempotency-Key header value
+        fingerprint: The request fingerprint, see request_fingerprint
+        respond: A callable running the request, returning the response
+            data and status code
+            
+    Returns:
+        tuple: The response data, the status code, and whether the
+            response is a replay of a stored one
+            
+    Raises:
+        IdempotencyError: If the key was reused or its request is in progress
+    """
+    check_key(key)
+    store_key = _store_key(key)
+    while not store.add(store_key, {'fingerprint': fingerprint, 'response': None}, claim_timeout()):
+        entry = store.get(store_key)
+        if entry is not None:
+            return (*_stored_response(entry, fingerprint), True)
+        # The entry expired since the add; claim the key again
+        
+    claim = refresher.hold(store, store_key, claim_timeout())
+    try:
+        data, response_status = respond()
+    except BaseException:
+        refresher.release(claim).wait()
+        store.delete(store_key)
+        raise
+    refresher.release(claim).wait()
+    store.set(store_key, {'fingerprint': fingerprint, 'response': (data, response_status)}, _timeout())
+    return data, response_status, False
+
+
+async def arun(store, key, fingerprint, respond):
+    """
+    Run a request once per idempotency key from async code.
+    
+    Like run, with respond returning an awaitable.
+    """
+    check_key(key)
+    store_key = _store_key(key)
+    timeout = claim_timeout()
+    while not await store.aadd(store_key, {'fingerprint': fingerprint, 'response': None}, timeout):
+        entry = await store.aget(store_key)
+        if entry is not None:
+            return (*_stored_response(entry, fingerprint), True)
+        
+    claim = refresher.hold(store, store_key, timeout)
+    try:
+        data, response_status = await respond()
+    except BaseException:
+        await _arelease(claim)
+        await store.adelete(store_key)
+        raise
+    await _arelease(claim)
+    await store.aset(store_key, {'fingerprint': fingerprint, 'response': (data, response_status)}, _timeout())
+    return data, response_status, False
+
+
+async def _arelease(claim):
+    idle = refresher.release(claim)
+    if not idle.is_set():
+        # A refresh is running; wait for it off the event loop
+        await sync_to_async(idle.wait, thread_sensitive=False)()
@@ -0,0 +1,341 @@
+"""
+Streaming bulk import of coupons from CSV or JSON Lines.
+
+Rows are parsed one at a time and validated like a POST to the coupon API,
+then written with ``bulk_create`` in chunks of COUPON_IMPORT_CHUNK_SIZE rows,
+each in its own transaction. The uniqueness of coupon codes is checked with
+one query per chunk instead of one per row. If the database still rejects a
+chunk (e.g. a code was taken since the check), its rows are written one at a
+time, so only the offending rows fail. Rows that fail are reported with
+their row number and errors, and never stop the import.
+
+JSON Lines rows have the same shape as the coupon API. CSV rows are flat;
+the details of the row's coupon type are read from the detail columns, and
+BxGy products are written as ``product_id:quantity`` pairs separated by
+``;`` (e.g. ``1:2;5:1``, the quantity defaults to 1).
+"""
+import csv
+import json
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from rest_framework.exceptions import ValidationError
+from rest_framework.validators import UniqueValidator
+
+from .models import (
+    Coupon,
+    CartWiseCoupon,
+    ProductWiseCoupon,
+    BxGyCoupon,
+    BxGyCouponBuyProduct,
+    BxGyCouponGetProduct
+)
+from .serializers import CouponSerializer, CouponImportSerializer
+from .snapshot import invalidate_snapshot
+
+
+FORMATS = ('csv', 'jsonl')
+
+COUPON_COLUMNS = (
+    'type', 'code', 'name', 'description', 'is_active', 'expires_at', 'is_stackable', 'exclusivity_group',
+    'max_redemptions', 'max_redemptions_per_user'
+)
+DETAIL_COLUMNS = {
+    'cart-wise': ('cart_wise_details', ('discount_type', 'threshold', 'discount_value')),
+    'product-wise': (
+        'product_wise_details', ('discount_type', 'product_id', 'category', 'brand', 'discount_value')
+    ),
+    'bxgy': ('bxgy_details', ('repetition_limit', 'buy_products', 'get_products')),
+}
+CSV_COLUMNS = tuple(dict.fromkeys(
+    COUPON_COLUMNS + tuple(column for _, columns in DETAIL_COLUMNS.values() for column in columns)
+))
+# Read-only columns written by the export, ignored on import
+READ_ONLY_COLUMNS = ('id', 'created_at', 'updated_at')
+
+
+class CouponImportError(Exception):
+    """Raised when the input cannot be read as the given format"""
+
+
+def format_for_content_type(content_type):
+    """Return the import format of a request content type, or None"""
+    if content_type in ('text/csv', 'application/csv'):
+        return 'csv'
+    if content_type in ('application/x-ndjson', 'application/jsonl', 'application/x-jsonlines'):
+        return 'jsonl'
+    return None
+
+
+@lru_cache(maxsize=None)
+def _duplicate_code_message():
+    # The message of the UniqueValidator the import serializer leaves out
+    for validator in CouponSerializer().fields['code'].validators:
+        if isinstance(validator, UniqueValidator):
+            return validator.message
+    return 'This field must be unique.'
+
+
+def _parse_products(value):
+    products = []
+    for pair in value.split(';'):
+        if pair.strip():
+            product_id, _, quantity = pair.partition(':')
+            product = {'product_id': product_id.strip()}
+            if quantity.strip():
+                product['quantity'] = quantity.strip()
+            products.append(product)
+    return products
+
+
+def csv_row_to_data(row):
+    """
+    Convert a flat CSV row into the nested shape of the coupon API.
+    
+    Args:
+        row: A dictionary of column values, as read by csv.DictReader
+        
+    Returns:
+        dict: The coupon data; empty columns are left out
+    """
+    data = {column: row[column] for column in COUPON_COLUMNS if row.get(column)}
+    if data.get('type') in DETAIL_COLUMNS:
+        details_field, columns = DETAIL_COLUMNS[data['type']]
+        details = {column: row[column] for column in columns if row.get(column)}
+        for products_field in ('buy_products', 'get_products'):
+            if products_field in details:
+                details[products_field] = _parse_products(details[products_field])
+        if details:
+            data[details_field] = details
+    return data
+
+
+def read_csv(lines):
+    """
+    Parse CSV rows lazily.
+    
+    Args:
+        lines: An iterable of text lines, starting with the header
+        
+    Yields:
+        tuple: The row number and the coupon data of each row
+    """
+    reader = csv.DictReader(lines)
+    if reader.fieldnames is None:
+        return
+    unknown = [
+        column for column in reader.fieldnames
+        if column not in CSV_COLUMNS and column not in READ_ONLY_COLUMNS
+    ]
+    if unknown:
+        raise CouponImportError(f'Unknown CSV columns: {", ".join(unknown)}')
+    
+    for row in reader:
+        yield reader.line_num, csv_row_to_data(row)
+
+
+def read_jsonl(lines):
+    """
+    Parse JSON Lines rows lazily; blank lines are skipped.
+    
+    Args:
+        lines: An iterable of text lines
+        
+    Yields:
+        tuple: The row number and the coupon data of each row, or a
+            CouponImportError if the line is not valid JSON
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as exc:
+            yield line_number, CouponImportError(f'Invalid JSON: {exc}')
+
+
+def read_rows(lines, format):
+    """Parse rows of the given format ('csv' or 'jsonl')"""
+    if format == 'csv':
+        return read_csv(lines)
+    if format == 'jsonl':
+        return read_jsonl(lines)
+    raise CouponImportError(f'Unknown import format "{format}"; expected one of {", ".join(FORMATS)}')
+
+
+def decode_lines(stream, encoding='utf-8'):
+    """Read text lines from a binary stream without loading it at once"""
+    for line_number, line in enumerate(iter(stream.readline, b''), start=1):
+        try:
+            yield line.decode(encoding)
+        except UnicodeDecodeError as exc:
+            raise CouponImportError(f'Line {line_number} is not valid {encoding}: {exc}')
+
+
+def import_coupons(rows, chunk_size=None):
+    """
+    Validate and create coupons in transactional chunks.
+    
+    Args:
+        rows: An iterable of (row number, coupon data) pairs, see read_rows
+        chunk_size: Rows written per transaction (defaults to COUPON_IMPORT_CHUNK_SIZE)
+        
+    Returns:
+        dict: The number of created coupons and failed rows, and the errors
+            of each failed row
+    """
+    chunk_size = chunk_size or getattr(settings, 'COUPON_IMPORT_CHUNK_SIZE', 1000)
+    # Building the nested fields costs more than validating a row, so they are built once
+    validator = CouponImportSerializer()
+    report = {'created': 0, 'failed': 0, 'errors': []}
+    chunk = []
+    
+    def fail(row_number, data, errors):
+        report['failed'] += 1
+        report['errors'].append({
+            'row': row_number,
+            'code': data.get('code') if isinstance(data, dict) else None,
+            'errors': errors,
+        })
+        
+    for row_number, data in rows:
+        if isinstance(data, CouponImportError):
+            fail(row_number, None, {'non_field_errors': [str(data)]})
+            continue
+        
+        validated_data, errors = _validate_row(validator, data)
+        if errors is not None:
+            fail(row_number, data, errors)
+            continue
+        
+        chunk.append((row_number, validated_data))
+        if len(chunk) >= chunk_size:
+            _write_chunk(chunk, report, fail)
+            chunk = []
+            
+    if chunk:
+        _write_chunk(chunk, report, fail)
+        
+    # Rows failing validation are reported before those of their chunk
+    report['errors'].sort(key=lambda error: error['row'])
+    
+    if report['created']:
+        # bulk_create sends no signals, so the snapshot is dropped here
+        invalidate_snapshot()
+        transaction.on_commit(invalidate_snapshot)
+        
+    return report
+
+
+def _validate_row(validator, data):
+    """
+    Validate one row like ``CouponImportSerializer(data=data).is_valid()``.
+    
+    Returns:
+        tuple: The validated data and None, or None and the errors
+    """
+    if not isinstance(data, dict):
+        # Always invalid; the serializer words the error
+        serializer = CouponImportSerializer(data=data)
+        serializer.is_valid()
+        return None, serializer.errors
+    try:
+        return validator.run_validation(data), None
+    except ValidationError as exc:
+        return None, exc.detail
+
+
+def _taken_codes(codes):
+    return set(Coupon.objects.filter(code__in=codes).values_list('code', flat=True))
+
+
+def _write_chunk(chunk, report, fail):
+    """Create the coupons of one chunk of validated rows in one transaction"""
+    existing_codes = _taken_codes([validated_data['code'] for _, validated_data in chunk])
+    duplicate_message = _duplicate_code_message()
+    
+    rows = []
+    seen_codes = set()
+    for row_number, validated_data in chunk:
+        code = validated_data['code']
+        if code in existing_codes or code in seen_codes:
+            fail(row_number, validated_data, {'code': [duplicate_message]})
+            continue
+        seen_codes.add(code)
+        rows.append((row_number, validated_data))
+        
+    try:
+        with transaction.atomic():
+            _bulk_create(validated_data for _, validated_data in rows)
+    except DatabaseError:
+        # Written one row at a time, so only the offending rows fail
+        for row_number, validated_data in rows:
+            try:
+                with transaction.atomic():
+                    _bulk_create([validated_data])
+            except DatabaseError as exc:
+                if _taken_codes([validated_data['code']]):
+                    fail(row_number, validated_data, {'code': [duplicate_message]})
+                else:
+                    fail(row_number, validated_data, {'non_field_errors': [f'The row was not saved: {exc}']})
+            else:
+                report['created'] += 1
+        return
+    
+    report['created'] += len(rows)
+
+
+def _bulk_create(coupons_data):
+    """Create coupons and their details from validated data, a few queries per model"""
+    coupons = []
+    cart_wise = []
+    product_wise = []
+    bxgy = []
+    bxgy_products = []
+    
+    for validated_data in coupons_data:
+        validated_data = dict(validated_data)
+        cart_wise_data = validated_data.pop('cart_wise_details', None)
+        product_wise_data = validated_data.pop('product_wise_details', None)
+        bxgy_data = validated_data.pop('bxgy_details', None)
+        
+        coupon = Coupon(**validated_data)
+        coupons.append(coupon)
+        
+        # Like CouponSerializer.create, only the details of the coupon's type are kept
+        if coupon.type == 'cart-wise' and cart_wise_data:
+            cart_wise.append(CartWiseCoupon(coupon=coupon, **cart_wise_data))
+        elif coupon.type == 'product-wise' and product_wise_data:
+            product_wise.append(ProductWiseCoupon(coupon=coupon, **product_wise_data))
+        elif coupon.type == 'bxgy' and bxgy_data:
+            bxgy_data = dict(bxgy_data)
+            buy_products_data = bxgy_data.pop('buy_products', [])
+            get_products_data = bxgy_data.pop('get_products', [])
+            details = BxGyCoupon(coupon=coupon, **bxgy_data)
+            bxgy.append(details)
+            bxgy_products.extend(
+                BxGyCouponBuyProduct(bxgy_coupon=details, **product_data) for product_data in buy_products_data
+            )
+            bxgy_products.extend(
+                BxGyCouponGetProduct(bxgy_coupon=details, **product_data) for product_data in get_products_data
+            )
+            
+    Coupon.objects.bulk_create(coupons)
+    CartWiseCoupon.objects.bulk_create(cart_wise)
+    ProductWiseCoupon.objects.bulk_create(product_wise)
+    BxGyCoupon.objects.bulk_create(bxgy)
+    
+    if bxgy_products:
+        # Not every database returns the primary keys of bulk inserts (e.g. MySQL)
+        ids = dict(
+            BxGyCoupon.objects.filter(coupon__in=[details.coupon_id for details in bxgy])
+            .values_list('coupon_id', 'id')
+        )
+        for details in bxgy:
+            details.pk = ids[details.coupon_id]
+            
+    for model in (BxGyCouponBuyProduct, BxGyCouponGetProduct):
+        model.objects.bulk_create([
+            product for product in bxgy_products if isinstance(product, model)
+        ])
@@ -0,0 +1,213 @@
+import json
+import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import AsyncClient, Client, override_settings
+
+from coupons import benchmark
+from coupons.services import get_applicable_coupons, apply_coupon
+from coupons.snapshot import get_snapshot, invalidate_snapshot
+
+
+# Distinct carts generated per cart size; iterations cycle through them
+CART_VARIANTS = 10
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark coupon evaluation on synthetic catalogs and carts. '
+        'Generated coupons are created in a transaction that is rolled back.'
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--catalog-sizes', nargs='+', type=int, default=[1000, 10000, 100000],
+            help='Number of coupons in each generated catalog'
+        )
+        parser.add_argument(
+            '--cart-lines', nargs='+', type=int, default=[1, 10, 100, 1000, 10000],
+            help='Number of items in the generated carts'
+        )
+        parser.add_argument('--iterations', type=int, default=50, help='Timed calls per benchmark')
+        parser.add_argument(
+            '--concurrency', nargs='+', type=int, default=[1, 100, 1000],
+            help='Requests in flight in the load test comparing the sync and async views'
+        )
+        parser.add_argument(
+            '--load-requests', type=int, default=2000, help='Requests sent per load test'
+        )
+        parser.add_argument(
+            '--load-cart-lines', type=int, default=10, help='Number of items in the load test carts'
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the generated data')
+        parser.add_argument(
+            '--result-cache', action='store_true',
+            help='Keep the result cache enabled, so repeated carts are served from it'
+        )
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Compare the results with a previous JSON output')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.10,
+            help='Relative p95 slowdown against the baseline reported as a regression'
+        )
+        parser.add_argument(
+            '--fail-on-regression', action='store_true',
+            help='Exit with an error if any benchmark regressed against the baseline'
+        )
+        
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be at least 1')
+        
+        results = []
+        overrides = {
+            # The test client talks to the views in-process as "testserver"
+            'ALLOWED_HOSTS': [*settings.ALLOWED_HOSTS, 'testserver'],
+        }
+        if not options['result_cache']:
+            # Iterations cycle through a few carts; measure evaluation, not cache hits
+            overrides['COUPON_RESULT_CACHE'] = None
+            
+        with override_settings(**overrides):
+            for catalog_size in options['catalog_sizes']:
+                self.stdout.write(f'Generating a catalog of {catalog_size} coupons...')
+                with transaction.atomic():
+                    try:
+                        results.extend(self.run_catalog(catalog_size, options))
+                    finally:
+                        transaction.set_rollback(True)
+                        invalidate_snapshot()
+                        
+        report = {'environment': benchmark.environment(), 'results': results}
+        
+        if options['baseline']:
+            baseline = benchmark.load_results(options['baseline'])
+            report['comparison'] = benchmark.compare(results, baseline['results'], options['tolerance'])
+            self.write_comparison(report['comparison'])
+            
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(report, output_file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+            
+        if options['fail_on_regression'] and any(
+            comparison['regression'] for comparison in report.get('comparison', [])
+        ):
+            raise CommandError('Benchmarks regressed against the baseline')
+        
+    def run_catalog(self, catalog_size, options):
+        """Run every benchmark against one generated catalog"""
+        iterations = options['iterations']
+        rng = random.Random(options['seed'])
+        coupon_ids = benchmark.generate_catalog(catalog_size, seed=options['seed'])
+        invalidate_snapshot()
+        client = Client()
+        results = []
+        
+        def rebuild_snapshot(n):
+            invalidate_snapshot()
+            get_snapshot()
+            
+        result = benchmark.measure(
+            'snapshot.build', rebuild_snapshot, min(iterations, 5), catalog_size=catalog_size
+        )
+        # Inactive, expired and incomplete coupons are filtered out by the query
+        result['rows_loaded'] = len(get_snapshot())
+        results.append(self.report(result))
+        
+        for cart_lines in options['cart_lines']:
+            carts = [benchmark.generate_cart(cart_lines, rng) for _ in range(CART_VARIANTS)]
+            payloads = [json.dumps(cart) for cart in carts]
+            
+            apply_ids = self.coupons_to_apply(carts, coupon_ids, rng)
+                
+            labels = {'catalog_size': catalog_size, 'cart_lines': cart_lines}
+            for name, func in (
+                ('services.get_applicable_coupons', lambda n: get_applicable_coupons(carts[n % CART_VARIANTS])),
+                ('services.apply_coupon', lambda n: apply_coupon(apply_ids[n % CART_VARIANTS], carts[n % CART_VARIANTS])),
+                ('view.applicable_coupons', lambda n: client.post(
+                    '/api/applicable-coupons/', payloads[n % CART_VARIANTS], content_type='application/json'
+                )),
+                ('view.apply_coupon', lambda n: client.post(
+                    f'/api/apply-coupon/{apply_ids[n % CART_VARIANTS]}/',
+                    payloads[n % CART_VARIANTS],
+                    content_type='application/json'
+                )),
+            ):
+                results.append(self.report(benchmark.measure(name, func, iterations, **labels)))
+                
+        for name, func in (
+            ('view.coupon_list', lambda n: client.get('/api/coupons/')),
+            ('view.coupon_detail', lambda n: client.get(f'/api/coupons/{coupon_ids[n % len(coupon_ids)]}/')),
+        ):
+            results.append(self.report(benchmark.measure(name, func, iterations, catalog_size=catalog_size)))
+            
+        results.extend(self.run_load_tests(catalog_size, coupon_ids, rng, options))
+        return results
+    
+    def run_load_tests(self, catalog_size, coupon_ids, rng, options):
+        """Compare the sync and async views under concurrent requests"""
+        cart_lines = options['load_cart_lines']
+        carts = [benchmark.generate_cart(cart_lines, rng) for _ in range(CART_VARIANTS)]
+        payloads = [json.dumps(cart) for cart in carts]
+        get_snapshot()
+        apply_ids = self.coupons_to_apply(carts, coupon_ids, rng)
+        client = AsyncClient()
+        results = []
+        
+        for concurrency in options['concurrency']:
+            for flavour, prefix in (('sync', '/api/'), ('async', '/api/async/')):
+                for name, request in (
+                    ('applicable_coupons', lambda n: client.post(
+                        f'{prefix}applicable-coupons/', payloads[n % CART_VARIANTS], content_type='application/json'
+                    )),
+                    ('apply_coupon', lambda n: client.post(
+                        f'{prefix}apply-coupon/{apply_ids[n % CART_VARIANTS]}/',
+                        payloads[n % CART_VARIANTS],
+                        content_type='application/json'
+                    )),
+                ):
+                    results.append(self.report(benchmark.load_test(
+                        f'load.{flavour}.{name}', request, options['load_requests'], concurrency,
+                        catalog_size=catalog_size, cart_lines=cart_lines
+                    )))
+                    
+        return results
+    
+    def coupons_to_apply(self, carts, coupon_ids, rng):
+        """Pick the best coupon of each cart, or any coupon if none applies"""
+        apply_ids = []
+        for cart in carts:
+            applicable = get_applicable_coupons(cart)
+            apply_ids.append(applicable[0]['coupon_id'] if applicable else rng.choice(coupon_ids))
+        return apply_ids
+    
+    def report(self, result):
+        self.stdout.write(
+            f"  {result['name']:<34} coupons={result['catalog_size']:<7} "
+            f"lines={result.get('cart_lines') or '-':<6} "
+            f"p50={result['p50_ms']:.3f}ms p95={result['p95_ms']:.3f}ms p99={result['p99_ms']:.3f}ms "
+            f"{result['throughput_per_s']}/s queries={result['queries_per_call']}"
+            + (f" concurrency={result['concurrency']}" if 'concurrency' in result else '')
+            + (f" rows_loaded={result['rows_loaded']}" if 'rows_loaded' in result else '')
+            + (
+                ' statuses=' + ','.join(f'{code}:{count}' for code, count in result['status_codes'].items())
+                if 'status_codes' in result else ''
+            )
+        )
+        return result
+    
+    def write_comparison(self, comparisons):
+        self.stdout.write('Comparison with the baseline (ratios of this run to the baseline):')
+        for comparison in comparisons:
+            line = (
+                f"  {comparison['name']:<34} coupons={comparison['catalog_size']:<7} "
+                f"lines={comparison.get('cart_lines') or '-':<6} "
+                f"p50x{comparison['p50_ms_ratio']} p95x{comparison['p95_ms_ratio']} "
+                f"p99x{comparison['p99_ms_ratio']}"
+                + (f" queries{comparison['queries_delta']:+}" if comparison['queries_delta'] is not None else '')
+                + (f" concurrency={comparison['concurrency']}" if comparison['concurrency'] else '')
+            )
+            self.stdout.write(self.style.ERROR(line) if comparison['regression'] else line)
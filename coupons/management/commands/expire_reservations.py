@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from coupons import redemptions
+
+
+class Command(BaseCommand):
+    help = (
+        'Release the coupon reservations that expired without being confirmed, '
+        'giving their uses back to the coupon limits. Run it every minute or so.'
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Reservations released per transaction')
+        
+    def handle(self, *args, **options):
+        if options['batch_size'] is not None and options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        
+        released = redemptions.sweep_expired(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Released {released} expired reservations'))
@@ -0,0 +1,63 @@
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from coupons import codegen
+from coupons.models import Coupon
+
+
+class Command(BaseCommand):
+    help = (
+        'Create copies of a template coupon with unique random codes, '
+        'in transactional chunks created with bulk_create.'
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument('template', help='ID or code of the template coupon')
+        parser.add_argument('--count', type=int, required=True, help='Number of coupons to create')
+        parser.add_argument(
+            '--pattern',
+            help='Code pattern; each "#" becomes a random character (defaults to the template code and 10 characters)'
+        )
+        parser.add_argument('--chunk-size', type=int, help='Coupons created per transaction')
+        parser.add_argument('--output', help='Write the generated codes to this file, one per line')
+        
+    def handle(self, *args, **options):
+        count = options['count']
+        if count < 1:
+            raise CommandError('--count must be at least 1')
+        if options['chunk_size'] is not None and options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+        
+        template = self.get_template(options['template'])
+        pattern = options['pattern'] or codegen.default_pattern(template)
+        try:
+            codegen.check_pattern(pattern, count)
+        except codegen.CodeGenerationError as exc:
+            raise CommandError(str(exc))
+        
+        output_file = open(options['output'], 'w') if options['output'] else None
+        created = 0
+        try:
+            for codes in codegen.generate_coupons(template, count, pattern, options['chunk_size']):
+                created += len(codes)
+                if output_file is not None:
+                    output_file.writelines(f'{code}\n' for code in codes)
+                self.stdout.write(f'Created {created}/{count} coupons')
+        except codegen.CodeGenerationError as exc:
+            raise CommandError(f'Stopped after {created} coupons: {exc}')
+        finally:
+            if output_file is not None:
+                output_file.close()
+                
+        self.stdout.write(self.style.SUCCESS(f'Created {created} coupons from {template.code}'))
+        
+    def get_template(self, reference):
+        try:
+            lookup = {'pk': uuid.UUID(reference)}
+        except ValueError:
+            lookup = {'code': reference}
+        try:
+            return Coupon.objects.get(**lookup)
+        except Coupon.DoesNotExist:
+            raise CommandError(f'Coupon "{reference}" does not exist')
@@ -0,0 +1,55 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from coupons import importer
+
+
+class Command(BaseCommand):
+    help = (
+        'Import coupons from a CSV or JSON Lines file. Rows are validated like the coupon API '
+        'and created in transactional chunks; invalid rows are reported and skipped.'
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, or - to read standard input')
+        parser.add_argument(
+            '--format', choices=importer.FORMATS,
+            help='Format of the file (defaults to its extension: .csv, .jsonl or .ndjson)'
+        )
+        parser.add_argument('--chunk-size', type=int, help='Rows created per transaction')
+        parser.add_argument('--errors', help='Write the errors of failed rows to this JSON Lines file')
+        
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or self.guess_format(path)
+        if options['chunk_size'] is not None and options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+        
+        input_file = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            report = importer.import_coupons(importer.read_rows(input_file, format), options['chunk_size'])
+        except (importer.CouponImportError, UnicodeDecodeError) as exc:
+            raise CommandError(f'Import stopped: {exc}')
+        finally:
+            if input_file is not sys.stdin:
+                input_file.close()
+                
+        if options['errors']:
+            with open(options['errors'], 'w') as errors_file:
+                for error in report['errors']:
+                    errors_file.write(json.dumps(error) + '\n')
+        else:
+            for error in report['errors']:
+                self.stderr.write(f"Row {error['row']}: {json.dumps(error['errors'])}")
+                
+        message = f"Imported {report['created']} coupons, {report['failed']} rows failed"
+        self.stdout.write(self.style.WARNING(message) if report['failed'] else self.style.SUCCESS(message))
+        
+    def guess_format(self, path):
+        if path.endswith('.csv'):
+            return 'csv'
+        if path.endswith(('.jsonl', '.ndjson')):
+            return 'jsonl'
+        raise CommandError('Cannot tell the format from the file name; pass --format')
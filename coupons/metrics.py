@@ -0,0 +1,424 @@
+"""
+Prometheus-style metrics for the coupon API.
+
+Counters and histograms are kept in memory per process and rendered in the
+Prometheus text exposition format at ``/metrics``. Under a multi-worker
+server (e.g. gunicorn) every worker only sees its own requests, so when
+COUPON_METRICS_DIR is set each process writes its values to a file in that
+directory every COUPON_METRICS_FLUSH_INTERVAL seconds, from a background
+thread rather than on requests, and a scrape merges the files of all
+processes.
+A scrape removes the files of workers that have exited, so the directory
+must be local to the host; the counters of an exited worker are dropped,
+which Prometheus treats as a counter reset.
+
+The queries of a request are counted on every connection they run on, the
+threads of async ORM calls (``sync_to_async``) included.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+EVALUATION_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+CART_LINES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# The QueryStats of the request being handled; copied into the threads of
+# sync_to_async, so async ORM calls count towards their request
+_query_stats = ContextVar('coupons_query_stats', default=None)
+
+
+def enabled():
+    """Check if metrics are collected"""
+    return getattr(settings, 'COUPON_METRICS_ENABLED', True)
+
+
+class Registry:
+    """The metric values of this process"""
+    
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.flusher = None
+        self._reset_process()
+        
+    def _reset_process(self):
+        # A forked worker starts from zero instead of the values of its parent
+        self.values = {}
+        self.pid = os.getpid()
+        self.process_id = f'{self.pid}-{uuid.uuid4().hex[:8]}'
+        
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+    
+    def reset(self):
+        """Drop every recorded value of this process"""
+        with self.lock:
+            self.values = {}
+            
+    def update(self, name, labels, size, changes):
+        """Add (position, amount) changes to the values of one labelled series"""
+        with self.lock:
+            if self.pid != os.getpid():
+                self._reset_process()
+            series = self.values.setdefault(name, {})
+            values = series.get(labels)
+            if values is None:
+                values = series[labels] = [0] * size
+            for position, amount in changes:
+                values[position] += amount
+                
+    def dump(self):
+        """Return the values of this process in a JSON-serializable form"""
+        with self.lock:
+            return {
+                name: [[list(labels), list(values)] for labels, values in series.items()]
+                for name, series in self.values.items()
+            }
+            
+    def _path(self, directory):
+        return os.path.join(directory, f'metrics-{self.process_id}.json')
+    
+    def _is_dead_worker_file(self, filename):
+        # Files are named metrics-<pid>-<suffix>.json
+        pid = filename.split('-')[1] if filename.count('-') >= 2 else ''
+        if not pid.isdigit():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass  # The process exists but belongs to another user
+        return False
+    
+    def start_flushing(self):
+        """Start the thread writing the values of this process to COUPON_METRICS_DIR, unless it runs"""
+        directory = getattr(settings, 'COUPON_METRICS_DIR', None)
+        # Threads do not survive a fork
+        if not directory or (self.flusher is not None and self.flusher.is_alive()):
+            return
+        with self.lock:
+            if self.flusher is not None and self.flusher.is_alive():
+                return
+            os.makedirs(directory, exist_ok=True)
+            self.flusher = threading.Thread(target=self._flush_periodically, name='coupon-metrics-flush', daemon=True)
+            self.flusher.start()
+            
+    def _flush_periodically(self):
+        # Stops once COUPON_METRICS_DIR is unset
+        while getattr(settings, 'COUPON_METRICS_DIR', None):
+            time.sleep(getattr(settings, 'COUPON_METRICS_FLUSH_INTERVAL', 1.0))
+            try:
+                self.flush()
+            except OSError:
+                pass  # Written again at the next interval
+            
+    def flush(self):
+        """Write the values of this process to COUPON_METRICS_DIR"""
+        directory = getattr(settings, 'COUPON_METRICS_DIR', None)
+        # Not recreated once removed
+        if not directory or not os.path.isdir(directory):
+            return
+        
+        path = self._path(directory)
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'w') as metrics_file:
+            json.dump(self.dump(), metrics_file)
+        os.replace(temporary_path, path)
+        
+    def collect(self):
+        """
+        Merge the values of every process.
+        
+        Returns:
+            dict: Mapping of metric name to {labels: values}
+        """
+        merged = {}
+        dumps = [self.dump()]
+        
+        directory = getattr(settings, 'COUPON_METRICS_DIR', None)
+        if directory and os.path.isdir(directory):
+            own_path = self._path(directory)
+            for filename in sorted(os.listdir(directory)):
+                path = os.path.join(directory, filename)
+                if not filename.endswith('.json') or path == own_path:
+                    continue
+                if self._is_dead_worker_file(filename):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass  # Removed by another scrape
+                    continue
+                try:
+                    with open(path) as metrics_file:
+                        dumps.append(json.load(metrics_file))
+                except (OSError, ValueError):
+                    continue  # A worker is rewriting its file
+                
+        for dump in dumps:
+            for name, series in dump.items():
+                merged_series = merged.setdefault(name, {})
+                for labels, values in series:
+                    labels = tuple(labels)
+                    current = merged_series.get(labels)
+                    if current is None or len(current) != len(values):
+                        merged_series[labels] = list(values)
+                    else:
+                        merged_series[labels] = [a + b for a, b in zip(current, values)]
+                        
+        return merged
+    
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        merged = self.collect()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for labels, values in sorted(merged.get(name, {}).items()):
+                lines.extend(metric.render(labels, values))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """A monotonically increasing count"""
+    kind = 'counter'
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+        
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[labelname]) for labelname in self.labelnames)
+        registry.update(self.name, key, 1, ((0, amount),))
+        
+    def render(self, labels, values):
+        return [f'{self.name}{_format_labels(list(zip(self.labelnames, labels)))} {_format_value(values[0])}']
+
+
+class Histogram:
+    """Observations counted in buckets, with their sum and count"""
+    kind = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        registry.register(self)
+        
+    def observe(self, value, **labels):
+        key = tuple(str(labels[labelname]) for labelname in self.labelnames)
+        # Values are [bucket counts..., +Inf count, sum]
+        bucket = bisect_left(self.buckets, value)
+        registry.update(
+            self.name, key, len(self.buckets) + 2,
+            ((bucket, 1), (len(self.buckets) + 1, value))
+        )
+        
+    def render(self, labels, values):
+        label_pairs = list(zip(self.labelnames, labels))
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + ('+Inf',), values):
+            cumulative += count
+            le = upper_bound if upper_bound == '+Inf' else _format_value(float(upper_bound))
+            lines.append(f'{self.name}_bucket{_format_labels(label_pairs + [("le", le)])} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(label_pairs)} {_format_value(values[-1])}')
+        lines.append(f'{self.name}_count{_format_labels(label_pairs)} {cumulative}')
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    'coupon_request_duration_seconds', 'Request latency by view and method', ('view', 'method')
+)
+REQUEST_DB_QUERIES = Histogram(
+    'coupon_request_db_queries', 'Database queries per request', ('view', 'method'), QUERY_COUNT_BUCKETS
+)
+REQUEST_DB_DURATION = Histogram(
+    'coupon_request_db_duration_seconds', 'Database time per request', ('view', 'method')
+)
+APPLICABLE_DURATION = Histogram(
+    'coupon_applicable_duration_seconds',
+    'Time to find the applicable coupons of one cart, by evaluation path',
+    ('path',)
+)
+EVALUATION_DURATION = Histogram(
+    'coupon_evaluation_duration_seconds',
+    'Time spent evaluating the candidate coupons of one type for one cart',
+    ('coupon_type',),
+    EVALUATION_BUCKETS
+)
+EVALUATIONS = Counter(
+    'coupon_evaluations_total', 'Candidate coupons evaluated', ('coupon_type',)
+)
+EVALUATION_HITS = Counter(
+    'coupon_evaluation_hits_total', 'Evaluated coupons that gave a discount', ('coupon_type',)
+)
+CART_LINES = Histogram(
+    'coupon_cart_lines', 'Number of items in evaluated carts', (), CART_LINES_BUCKETS
+)
+
+
+class EvaluationStats:
+    """Per-type evaluation time and hits of one cart, recorded in one go"""
+    __slots__ = ('durations', 'evaluations', 'hits')
+    
+    def __init__(self):
+        self.durations = {}
+        self.evaluations = {}
+        self.hits = {}
+        
+    def add(self, coupon_type, duration, hit):
+        self.durations[coupon_type] = self.durations.get(coupon_type, 0.0) + duration
+        self.evaluations[coupon_type] = self.evaluations.get(coupon_type, 0) + 1
+        if hit:
+            self.hits[coupon_type] = self.hits.get(coupon_type, 0) + 1
+            
+    def record(self):
+        for coupon_type, duration in self.durations.items():
+            EVALUATION_DURATION.observe(duration, coupon_type=coupon_type)
+            EVALUATIONS.inc(self.evaluations[coupon_type], coupon_type=coupon_type)
+            EVALUATION_HITS.inc(self.hits.get(coupon_type, 0), coupon_type=coupon_type)
+
+
+class QueryStats:
+    """The number and duration of the queries of a request"""
+    
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        
+        
+def count_queries(execute, sql, params, many, context):
+    """Database execute wrapper adding queries to the QueryStats of their request"""
+    query_stats = _query_stats.get()
+    if query_stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        query_stats.duration += time.perf_counter() - started
+        query_stats.count += 1
+        
+        
+def install_query_counter(connection, **kwargs):
+    """Add count_queries to the execute wrappers of a connection, once"""
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+        
+        
+# Connections are per thread; every one opened from now on counts queries
+connection_created.connect(install_query_counter, dispatch_uid='coupons.metrics.install_query_counter')
+
+
+def view_label(request):
+    """Name of the coupon API view that handled a request, or None"""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return None
+    view_class = getattr(match.func, 'cls', None) or getattr(match.func, 'view_class', None)
+    if view_class is None or not view_class.__module__.startswith('coupons.'):
+        return None
+    return view_class.__name__
+
+
+class MetricsMiddleware:
+    """
+    Record the latency and database usage of every coupon API request.
+    
+    The middleware supports both sync and async requests, so it does not
+    force async views onto a thread under ASGI.
+    """
+    sync_capable = True
+    async_capable = True
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not enabled():
+            return self.get_response(request)
+        
+        query_stats = QueryStats()
+        token = self.start(query_stats)
+        try:
+            started = time.perf_counter()
+            response = self.get_response(request)
+            duration = time.perf_counter() - started
+        finally:
+            _query_stats.reset(token)
+            
+        self.record(request, duration, query_stats)
+        return response
+    
+    async def __acall__(self, request):
+        if not enabled():
+            return await self.get_response(request)
+        
+        query_stats = QueryStats()
+        token = self.start(query_stats)
+        try:
+            started = time.perf_counter()
+            response = await self.get_response(request)
+            duration = time.perf_counter() - started
+        finally:
+            _query_stats.reset(token)
+            
+        self.record(request, duration, query_stats)
+        return response
+    
+    def start(self, query_stats):
+        # Connections opened before this module was imported miss the signal
+        for connection in connections.all(initialized_only=True):
+            install_query_counter(connection)
+        return _query_stats.set(query_stats)
+    
+    def record(self, request, duration, query_stats):
+        view = view_label(request)
+        if view is not None and view != 'MetricsView':
+            labels = {'view': view, 'method': request.method}
+            REQUEST_DURATION.observe(duration, **labels)
+            REQUEST_DB_QUERIES.observe(query_stats.count, **labels)
+            REQUEST_DB_DURATION.observe(query_stats.duration, **labels)
+            registry.start_flushing()
+            
\ No newline at end of file
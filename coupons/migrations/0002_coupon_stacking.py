@@ -0,0 +1,23 @@
+# Generated by Django 4.2.8 on 2026-10-17 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coupons', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='exclusivity_group',
+            field=models.CharField(blank=True, help_text='At most one coupon from the same group can be combined', max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='is_stackable',
+            field=models.BooleanField(default=False, help_text='Whether the coupon can be combined with other stackable coupons'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.8 on 2026-10-17 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('coupons', '0002_coupon_stacking'),
+    ]
+    
+    operations = [
+        migrations.AddIndex(
+            model_name='coupon',
+            index=models.Index(fields=['-created_at', '-id'], name='coupon_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.8 on 2026-10-17 14:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('coupons', '0003_coupon_created_id_idx'),
+    ]
+    
+    operations = [
+        migrations.AlterField(
+            model_name='bxgycouponbuyproduct',
+            name='product_id',
+            field=models.IntegerField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='productwisecoupon',
+            name='brand',
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+        migrations.AlterField(
+            model_name='productwisecoupon',
+            name='category',
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+        migrations.AlterField(
+            model_name='productwisecoupon',
+            name='product_id',
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='coupon',
+            index=models.Index(fields=['is_active', 'expires_at', 'type'], name='coupon_valid_idx'),
+        ),
+    ]
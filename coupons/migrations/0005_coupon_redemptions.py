@@ -0,0 +1,62 @@
+# Generated by Django 4.2.8 on 2026-10-17 14:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('coupons', '0004_coupon_lookup_indexes'),
+    ]
+    
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='max_redemptions',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of times the coupon can be redeemed in total (unlimited if empty)', null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_redemptions_per_user',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of times one user can redeem the coupon (unlimited if empty)', null=True),
+        ),
+        migrations.CreateModel(
+            name='UserRedemptionCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.CharField(max_length=100)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_redemption_counters', to='coupons.coupon')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RedemptionCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='redemption_counters', to='coupons.coupon')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Redemption',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('user_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('shard', models.PositiveSmallIntegerField(blank=True, help_text='The counter shard the redemption was counted in, if the coupon has a total limit', null=True)),
+                ('discount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='redemptions', to='coupons.coupon')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='userredemptioncounter',
+            constraint=models.UniqueConstraint(fields=('coupon', 'user_id'), name='user_redemption_counter_unique_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='redemptioncounter',
+            constraint=models.UniqueConstraint(fields=('coupon', 'shard'), name='redemption_counter_unique_shard'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.8 on 2026-10-17 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('coupons', '0005_coupon_redemptions'),
+    ]
+    
+    operations = [
+        migrations.AddField(
+            model_name='redemption',
+            name='counts_per_user',
+            field=models.BooleanField(default=False, help_text='Whether the redemption was counted against the per-user limit'),
+        ),
+        migrations.AddField(
+            model_name='redemption',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, help_text='When a reservation is released unless confirmed', null=True),
+        ),
+        migrations.AddField(
+            model_name='redemption',
+            name='status',
+            field=models.CharField(choices=[('confirmed', 'Confirmed'), ('reserved', 'Reserved'), ('released', 'Released'), ('expired', 'Expired')], default='confirmed', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='redemption',
+            index=models.Index(fields=['status', 'expires_at'], name='redemption_status_exp_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.8 on 2026-10-17 15:01
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def set_redemption_shards(apps, schema_editor):
+    # Coupons redeemed before keep the shards their counters were created with
+    Coupon = apps.get_model('coupons', 'Coupon')
+    RedemptionCounter = apps.get_model('coupons', 'RedemptionCounter')
+    shards = RedemptionCounter.objects.values('coupon').annotate(shards=Count('id')).values_list('coupon', 'shards')
+    for coupon_id, count in shards:
+        Coupon.objects.filter(pk=coupon_id).update(redemption_shards=count)
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('coupons', '0006_redemption_reservations'),
+    ]
+    
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='redemption_shards',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, help_text='Number of counter rows the total limit is split across, fixed on the first redemption', null=True),
+        ),
+        migrations.RunPython(set_redemption_shards, migrations.RunPython.noop),
+    ]
@@ -3,6 +3,37 @@ from django.utils import timezone
 from decimal import Decimal
 import uuid
 
+
+class CouponQuerySet(models.QuerySet):
+    """QuerySet helpers for filtering coupons and loading them together with their details"""
+    
+    def with_details(self):
+        """Fetch the type-specific details and BxGy products alongside each coupon"""
+        return self.select_related(
+            'cart_wise_details',
+            'product_wise_details',
+            'bxgy_details',
+        ).prefetch_related(
+            'bxgy_details__buy_products',
+            'bxgy_details__get_products',
+        )
+    
+    def valid(self, now=None):
+        """Filter the coupons that are active and not expired, like Coupon.is_valid"""
+        now = now or timezone.now()
+        return self.filter(is_active=True).filter(
+            models.Q(expires_at__isnull=True) | models.Q(expires_at__gte=now)
+        )
+    
+    def with_type_details(self):
+        """Filter the coupons that have the details of their type; the others never apply"""
+        return self.filter(
+            models.Q(type='cart-wise', cart_wise_details__isnull=False)
+            | models.Q(type='product-wise', product_wise_details__isnull=False)
+            | models.Q(type='bxgy', bxgy_details__isnull=False)
+        )
+
+
 class Coupon(models.Model):
     """Base coupon model that holds common information for all coupon types"""
     COUPON_TYPE_CHOICES = (
@@ -20,6 +51,42 @@ class Coupon(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     expires_at = models.DateTimeField(blank=True, null=True)
+    is_stackable = models.BooleanField(
+        default=False,
+        help_text='Whether the coupon can be combined with other stackable coupons'
+    )
+    exclusivity_group = models.CharField(
+        max_length=50,
+        blank=True,
+        null=True,
+        help_text='At most one coupon from the same group can be combined'
+    )
+    max_redemptions = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text='Number of times the coupon can be redeemed in total (unlimited if empty)'
+    )
+    max_redemptions_per_user = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text='Number of times one user can redeem the coupon (unlimited if empty)'
+    )
+    redemption_shards = models.PositiveSmallIntegerField(
+        blank=True,
+        null=True,
+        editable=False,
+        help_text='Number of counter rows the total limit is split across, fixed on the first redemption'
+    )
+    
+    objects = CouponQuerySet.as_manager()
+    
+    class Meta:
+        indexes = [
+            # The order of the coupon list and the key of its cursor pagination
+            models.Index(fields=['-created_at', '-id'], name='coupon_created_id_idx'),
+            # The filter of CouponQuerySet.valid, which loads the coupon snapshot
+            models.Index(fields=['is_active', 'expires_at', 'type'], name='coupon_valid_idx'),
+        ]
     
     def __str__(self):
         return f"{self.name} ({self.code})"
@@ -78,9 +145,9 @@ class ProductWiseCoupon(models.Model):
         ),
         default='percentage'
     )
-    product_id = models.IntegerField(null=True, blank=True)
-    category = models.CharField(max_length=100, null=True, blank=True)
-    brand = models.CharField(max_length=100, null=True, blank=True)
+    product_id = models.IntegerField(null=True, blank=True, db_index=True)
+    category = models.CharField(max_length=100, null=True, blank=True, db_index=True)
+    brand = models.CharField(max_length=100, null=True, blank=True, db_index=True)
     discount_value = models.DecimalField(max_digits=10, decimal_places=2)
     
     def __str__(self):
@@ -128,7 +195,7 @@ class BxGyCouponBuyProduct(models.Model):
         on_delete=models.CASCADE, 
         related_name='buy_products'
     )
-    product_id = models.IntegerField()
+    product_id = models.IntegerField(db_index=True)
     quantity = models.PositiveIntegerField(default=1)
     
     def __str__(self):
@@ -147,3 +214,97 @@ class BxGyCouponGetProduct(models.Model):
     
     def __str__(self):
         return f"Get {self.quantity} of Product #{self.product_id} free"
+
+
+class RedemptionCounter(models.Model):
+    """
+    One shard of the redemption count of a coupon.
+    
+    The total limit of a coupon is split across its shards, and each
+    redemption takes one unit from any shard with room left, so concurrent
+    checkouts of a hot coupon update different rows.
+    """
+    coupon = models.ForeignKey(
+        Coupon,
+        on_delete=models.CASCADE,
+        related_name='redemption_counters'
+    )
+    shard = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['coupon', 'shard'], name='redemption_counter_unique_shard'),
+        ]
+        
+    def __str__(self):
+        return f"{self.coupon.code} shard {self.shard}: {self.count}"
+
+
+class UserRedemptionCounter(models.Model):
+    """Number of redemptions of a coupon by one user"""
+    coupon = models.ForeignKey(
+        Coupon,
+        on_delete=models.CASCADE,
+        related_name='user_redemption_counters'
+    )
+    user_id = models.CharField(max_length=100)
+    count = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['coupon', 'user_id'], name='user_redemption_counter_unique_user'),
+        ]
+        
+    def __str__(self):
+        return f"{self.coupon.code} by {self.user_id}: {self.count}"
+
+
+class Redemption(models.Model):
+    """A use of a coupon, either confirmed or held by a reservation"""
+    CONFIRMED = 'confirmed'
+    RESERVED = 'reserved'
+    RELEASED = 'released'
+    EXPIRED = 'expired'
+    STATUS_CHOICES = (
+        (CONFIRMED, 'Confirmed'),
+        (RESERVED, 'Reserved'),
+        (RELEASED, 'Released'),
+        (EXPIRED, 'Expired'),
+    )
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    coupon = models.ForeignKey(
+        Coupon,
+        on_delete=models.CASCADE,
+        related_name='redemptions'
+    )
+    user_id = models.CharField(max_length=100, blank=True, null=True)
+    shard = models.PositiveSmallIntegerField(
+        blank=True,
+        null=True,
+        help_text='The counter shard the redemption was counted in, if the coupon has a total limit'
+    )
+    counts_per_user = models.BooleanField(
+        default=False,
+        help_text='Whether the redemption was counted against the per-user limit'
+    )
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=CONFIRMED)
+    discount = models.DecimalField(max_digits=10, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text='When a reservation is released unless confirmed'
+    )
+    
+    class Meta:
+        indexes = [
+            # The sweep of expired reservations
+            models.Index(fields=['status', 'expires_at'], name='redemption_status_exp_idx'),
+        ]
+    
+    def __str__(self):
+        if self.status == self.CONFIRMED:
+            return f"{self.coupon.code} redeemed for ${self.discount}"
+        return f"{self.coupon.code} {self.status} for ${self.discount}"
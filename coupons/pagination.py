@@ -0,0 +1,50 @@
+"""
+Pagination of the coupon list.
+
+Page numbers stay the default, but every page costs a ``COUNT(*)`` and an
+OFFSET scan over the pages before it. Clients can opt in to cursor (keyset)
+pagination with ``?pagination=cursor``: pages are then read with
+``WHERE created_at < <last coupon of the previous page>`` on the
+``(created_at, id)`` index, so a deep page costs the same as the first.
+"""
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+
+class CouponCursorPagination(CursorPagination):
+    """Keyset pagination on the creation time, newest first"""
+    ordering = ('-created_at', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class CouponPagination(PageNumberPagination):
+    """
+    Page number pagination, or cursor pagination when a request opts in.
+    
+    A request uses cursor pagination if it has ``pagination=cursor`` or a
+    ``cursor`` parameter; the next and previous links keep both. Either way
+    ``page_size`` sets the number of coupons per page.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    pagination_query_param = 'pagination'
+    cursor_class = CouponCursorPagination
+    
+    def uses_cursor(self, request):
+        """Check if a request opted in to cursor pagination"""
+        return (
+            request.query_params.get(self.pagination_query_param) == 'cursor'
+            or self.cursor_class.cursor_query_param in request.query_params
+        )
+        
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.uses_cursor(request):
+            self.cursor_paginator = self.cursor_class()
+            return self.cursor_paginator.paginate_queryset(queryset, request, view)
+        self.cursor_paginator = None
+        return super().paginate_queryset(queryset, request, view)
+    
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -0,0 +1,358 @@
+"""
+Coupon redemptions and reservations with total and per-user limits.
+
+Limits are enforced with conditional updates (``UPDATE ... SET count =
+count + 1 WHERE count < limit``), never by reading a count and writing it
+back, so no amount of concurrency can oversell a coupon.
+
+A single counter row per coupon would make every checkout of a hot coupon
+wait for the row lock of the previous one until it commits. The total
+limit is therefore split across COUPON_REDEMPTION_SHARDS counter rows, and
+a redemption takes one unit from a randomly chosen shard that has room
+left, so concurrent checkouts mostly update different rows. The shards of
+a coupon are created on its first redemption, and their number is stored on
+the coupon, so changing COUPON_REDEMPTION_SHARDS only affects coupons that
+were never redeemed.
+
+A reservation holds a use of a coupon while the customer pays: it is
+counted like a redemption, and confirming it later is a single conditional
+update of its row. Releasing it, or letting it expire, decrements the
+counters it was counted in. Expired reservations are released in batches by
+``sweep_expired`` (the ``expire_reservations`` command), not on requests.
+"""
+import random
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Coupon, Redemption, RedemptionCounter, UserRedemptionCounter
+
+
+class RedemptionError(Exception):
+    """Raised when a coupon cannot be redeemed"""
+
+
+class RedemptionLimitReached(RedemptionError):
+    """Raised when a coupon has no redemptions left, in total or for the user"""
+
+
+class ReservationError(RedemptionError):
+    """Raised when a reservation can no longer be confirmed or released"""
+
+
+def shard_count():
+    """Number of counter shards the total limit of a coupon not redeemed yet is split across"""
+    return max(1, getattr(settings, 'COUPON_REDEMPTION_SHARDS', 8))
+
+
+def shard_capacity(limit, shard, shards):
+    """
+    Return the part of a total limit held by one shard.
+    
+    The capacities of all shards add up to the limit.
+    """
+    return limit // shards + (1 if shard < limit % shards else 0)
+
+
+def _take_from_shards(coupon, shards):
+    """Take one unit from a shard with room left; return the shard, or None if all are full"""
+    start = random.randrange(shards)
+    for offset in range(shards):
+        shard = (start + offset) % shards
+        capacity = shard_capacity(coupon.max_redemptions, shard, shards)
+        if capacity and RedemptionCounter.objects.filter(
+            coupon=coupon, shard=shard, count__lt=capacity
+        ).update(count=F('count') + 1):
+            return shard
+    return None
+
+
+def count_redemption(coupon):
+    """
+    Count a redemption against the total limit of a coupon.
+    
+    Must run inside a transaction, so the count is undone if the redemption fails.
+    
+    Args:
+        coupon: The Coupon being redeemed
+        
+    Returns:
+        int: The shard the redemption was counted in, or None if the coupon has no total limit
+        
+    Raises:
+        RedemptionLimitReached: If the limit is reached
+    """
+    if coupon.max_redemptions is None:
+        return None
+    
+    shards = coupon.redemption_shards or _create_shards(coupon)
+    shard = _take_from_shards(coupon, shards)
+    if shard is None:
+        raise RedemptionLimitReached('The coupon has no redemptions left.')
+    return shard
+
+
+def _create_shards(coupon):
+    """Create the counters of a coupon on its first redemption, returning their number"""
+    shards = shard_count()
+    if not Coupon.objects.filter(pk=coupon.pk, redemption_shards__isnull=True).update(redemption_shards=shards):
+        # Fixed by a concurrent first redemption
+        shards = Coupon.objects.values_list('redemption_shards', flat=True).get(pk=coupon.pk)
+    # Concurrent first redemptions create the same rows
+    RedemptionCounter.objects.bulk_create(
+        [RedemptionCounter(coupon=coupon, shard=shard) for shard in range(shards)],
+        ignore_conflicts=True
+    )
+    return shards
+
+
+def count_user_redemption(coupon, user_id):
+    """
+    Count a redemption against the per-user limit of a coupon.
+    
+    Must run inside a transaction, so the count is undone if the redemption fails.
+    
+    Returns:
+        bool: Whether the coupon has a per-user limit the redemption was counted against
+        
+    Raises:
+        RedemptionError: If the coupon has a per-user limit and no user is given
+        RedemptionLimitReached: If the user has reached the limit
+    """
+    limit = coupon.max_redemptions_per_user
+    if limit is None:
+        return False
+    if not user_id:
+        raise RedemptionError('A user_id is required to redeem this coupon.')
+    
+    counters = UserRedemptionCounter.objects.filter(coupon=coupon, user_id=user_id, count__lt=limit)
+    if counters.update(count=F('count') + 1):
+        return True
+    
+    UserRedemptionCounter.objects.bulk_create(
+        [UserRedemptionCounter(coupon=coupon, user_id=user_id)], ignore_conflicts=True
+    )
+    if not counters.update(count=F('count') + 1):
+        raise RedemptionLimitReached('The coupon has no redemptions left for this user.')
+    return True
+
+
+def redeem(coupon_id, discounted_cart, user_id=None):
+    """
+    Record a redemption of a coupon applied to a cart.
+    
+    The per-user and total counts and the redemption are written in one
+    transaction; if any limit is reached, nothing is written.
+    
+    Args:
+        coupon_id: The ID of the applied coupon
+        discounted_cart: The result of applying the coupon (see services.apply_coupon)
+        user_id: The user redeeming the coupon, required by per-user limits
+        
+    Returns:
+        Redemption: The recorded redemption
+        
+    Raises:
+        Coupon.DoesNotExist: If the coupon was deleted
+        RedemptionError: If the coupon is inactive or expired, or cannot be redeemed
+    """
+    return _record(coupon_id, discounted_cart, user_id, Redemption.CONFIRMED)
+
+
+def reserve(coupon_id, discounted_cart, user_id=None, ttl=None):
+    """
+    Hold a redemption of a coupon until it is confirmed or released.
+    
+    A reservation is counted against the limits like a redemption, so the
+    coupon cannot be oversold while the customer pays, and no lock is held
+    in the meantime. Unless confirmed, it is released after ttl seconds by
+    sweep_expired.
+    
+    Args:
+        coupon_id: The ID of the applied coupon
+        discounted_cart: The result of applying the coupon (see services.apply_coupon)
+        user_id: The user redeeming the coupon, required by per-user limits
+        ttl: Seconds the reservation is held (defaults to COUPON_RESERVATION_TTL)
+        
+    Returns:
+        Redemption: The reservation
+        
+    Raises:
+        Coupon.DoesNotExist: If the coupon was deleted
+        RedemptionError: If the coupon is inactive or expired, or cannot be redeemed
+    """
+    ttl = ttl or getattr(settings, 'COUPON_RESERVATION_TTL', 900)
+    return _record(
+        coupon_id, discounted_cart, user_id, Redemption.RESERVED,
+        expires_at=timezone.now() + timedelta(seconds=ttl)
+    )
+
+
+def _record(coupon_id, discounted_cart, user_id, status, expires_at=None):
+    with transaction.atomic():
+        coupon = Coupon.objects.only(
+            'is_active', 'expires_at', 'max_redemptions', 'max_redemptions_per_user', 'redemption_shards'
+        ).get(pk=coupon_id)
+        # The snapshot the cart was evaluated against may predate the change
+        if not coupon.is_active:
+            raise RedemptionError('The coupon is no longer active.')
+        if coupon.expires_at is not None and coupon.expires_at <= timezone.now():
+            raise RedemptionError('The coupon has expired.')
+        counts_per_user = count_user_redemption(coupon, user_id)
+        shard = count_redemption(coupon)
+        return Redemption.objects.create(
+            coupon=coupon,
+            user_id=user_id or None,
+            shard=shard,
+            counts_per_user=counts_per_user,
+            status=status,
+            discount=discounted_cart['total_discount'],
+            expires_at=expires_at
+        )
+
+
+def confirm(redemption_id, now=None):
+    """
+    Turn a reservation into a redemption.
+    
+    A single conditional update, whatever the number of reservations.
+    
+    Args:
+        redemption_id: The ID of the reservation
+        now: The time checked against the expiry of the reservation (defaults to now)
+        
+    Returns:
+        Redemption: The confirmed redemption
+        
+    Raises:
+        Redemption.DoesNotExist: If there is no such reservation
+        ReservationError: If the reservation expired or was released
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        if Redemption.objects.filter(
+            pk=redemption_id, status=Redemption.RESERVED, expires_at__gt=now
+        ).update(status=Redemption.CONFIRMED, expires_at=None):
+            return Redemption.objects.get(pk=redemption_id)
+        
+        redemption = Redemption.objects.select_for_update().get(pk=redemption_id)
+        if redemption.status == Redemption.RESERVED:
+            # Expired, but not swept yet
+            if reclaim([redemption], Redemption.EXPIRED):
+                redemption.status = Redemption.EXPIRED
+            else:
+                redemption.refresh_from_db(fields=['status'])
+            
+    # Raised once the expired reservation is released
+    if redemption.status != Redemption.CONFIRMED:
+        raise ReservationError(f'The reservation is {redemption.status}.')
+    return redemption
+
+
+def release(redemption_id):
+    """
+    Cancel a reservation, giving its use back to the coupon's limits.
+    
+    Args:
+        redemption_id: The ID of the reservation
+        
+    Returns:
+        Redemption: The released reservation
+        
+    Raises:
+        Redemption.DoesNotExist: If there is no such reservation
+        ReservationError: If the reservation was already confirmed or released
+    """
+    with transaction.atomic():
+        redemption = Redemption.objects.select_for_update().get(pk=redemption_id)
+        if redemption.status == Redemption.RESERVED:
+            if reclaim([redemption], Redemption.RELEASED):
+                redemption.status = Redemption.RELEASED
+                return redemption
+            # Ended since it was read
+            redemption.refresh_from_db(fields=['status'])
+    raise ReservationError(f'The reservation is {redemption.status}.')
+
+
+def reclaim(reservations, status):
+    """
+    End reservations and give their uses back to the counters.
+    
+    Must run inside a transaction, with the reservations locked. Only the
+    reservations still RESERVED are ended and given back, so one ended
+    concurrently (where the database cannot lock rows) is never given back
+    twice. Counters are decremented once per shard or user, not once per
+    reservation.
+    
+    Args:
+        reservations: Redemptions read with the RESERVED status
+        status: The status they end with (RELEASED or EXPIRED)
+        
+    Returns:
+        int: The number of reservations ended
+    """
+    # Reservations counted in the same counters are ended by one update
+    groups = defaultdict(list)
+    for reservation in reservations:
+        user_id = reservation.user_id if reservation.counts_per_user else None
+        groups[(reservation.coupon_id, reservation.shard, user_id)].append(reservation.pk)
+    
+    ended = 0
+    shards = Counter()
+    users = Counter()
+    for (coupon_id, shard, user_id), pks in groups.items():
+        count = Redemption.objects.filter(pk__in=pks, status=Redemption.RESERVED).update(status=status)
+        ended += count
+        if count and shard is not None:
+            shards[(coupon_id, shard)] += count
+        if count and user_id is not None:
+            users[(coupon_id, user_id)] += count
+            
+    for (coupon_id, shard), count in shards.items():
+        RedemptionCounter.objects.filter(coupon_id=coupon_id, shard=shard).update(count=F('count') - count)
+    for (coupon_id, user_id), count in users.items():
+        UserRedemptionCounter.objects.filter(coupon_id=coupon_id, user_id=user_id).update(count=F('count') - count)
+    return ended
+
+
+def sweep_expired(batch_size=None, now=None):
+    """
+    Release the expired reservations, a batch per transaction.
+    
+    Batches are read in expiry order from the (status, expires_at) index;
+    reservations locked by a concurrent confirm or release are skipped
+    where the database supports it.
+    
+    Args:
+        batch_size: Reservations released per transaction (defaults to COUPON_RESERVATION_SWEEP_BATCH_SIZE)
+        now: The time reservations must have expired by (defaults to now)
+        
+    Returns:
+        int: The number of released reservations
+    """
+    batch_size = batch_size or getattr(settings, 'COUPON_RESERVATION_SWEEP_BATCH_SIZE', 1000)
+    now = now or timezone.now()
+    expired = Redemption.objects.select_for_update(
+        skip_locked=connection.features.has_select_for_update_skip_locked
+    ).filter(
+        status=Redemption.RESERVED, expires_at__lte=now
+    ).order_by('expires_at').only('coupon', 'user_id', 'shard', 'counts_per_user')
+    
+    swept = 0
+    while True:
+        with transaction.atomic():
+            batch = list(expired[:batch_size])
+            if batch:
+                swept += reclaim(batch, Redemption.EXPIRED)
+        if len(batch) < batch_size:
+            return swept
+
+
+def redemption_count(coupon):
+    """Return the uses counted against the total limit of a coupon, reservations included"""
+    counts = RedemptionCounter.objects.filter(coupon=coupon).values_list('count', flat=True)
+    return sum(counts)
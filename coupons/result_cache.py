@@ -0,0 +1,267 @@
+"""
+Response cache for applicable-coupons and apply-coupon results.
+
+Results are cached under a fingerprint of the validated cart and the catalog
+version of the snapshot that produced them. Any coupon write bumps the
+catalog version (see snapshot.invalidate_snapshot), so entries computed from
+an older catalog are never read again and simply age out of the cache.
+Entries also expire no later than the next coupon expiry, since an expiring
+coupon changes the results without a write, nor than the snapshot they were
+computed from (see COUPON_SNAPSHOT_MAX_AGE).
+
+The cache is the COUPON_RESULT_CACHE alias of Django's cache framework.
+Lookups are counted in the ``coupon_result_cache_requests_total`` metric.
+
+On a miss, identical concurrent requests wait for a single evaluation of
+the cart instead of each evaluating it (see singleflight); that also holds
+when the result cache is disabled.
+"""
+import hashlib
+import json
+import math
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from . import metrics, services, singleflight
+from .snapshot import get_snapshot, aget_snapshot, is_local_cache, remaining_age as snapshot_remaining_age
+
+
+RESULT_CACHE_LOOKUPS = metrics.Counter(
+    'coupon_result_cache_requests_total',
+    'Result cache lookups by endpoint and outcome (hit or miss)',
+    ('endpoint', 'result')
+)
+
+_MISSING = object()
+
+
+def get_cache():
+    """Return the result cache, or None if result caching is disabled"""
+    alias = getattr(settings, 'COUPON_RESULT_CACHE', None)
+    if not alias:
+        return None
+    return caches[alias]
+
+
+def _normalize_price(price):
+    # 30, 30.0 and 30.00 are the same price
+    return format(Decimal(str(price)).normalize(), 'f')
+
+
+def cart_fingerprint(cart, ordered=False):
+    """
+    Hash a cart into a canonical cache key component.
+    
+    Args:
+        cart: A validated cart
+        ordered: Keep the item order. Every evaluation result depends on
+            it: BxGy coupons break ties between equally priced free items by
+            their position in the cart
+            
+    Returns:
+        str: A hex digest identifying the cart
+    """
+    items = [
+        (
+            item['product_id'],
+            item['quantity'],
+            _normalize_price(item['price']),
+            item.get('category') or '',
+            item.get('brand') or '',
+        )
+        for item in cart.get('items', [])
+    ]
+    if not ordered:
+        items.sort()
+    return hashlib.blake2b(json.dumps(items).encode(), digest_size=16).hexdigest()
+
+
+def result_timeout(snapshot, now):
+    """
+    Seconds a result computed now may be cached.
+    
+    Returns:
+        int: The timeout, or 0 if the result should not be cached
+    """
+    timeout = getattr(settings, 'COUPON_RESULT_CACHE_TIMEOUT', 300)
+    next_expiry = snapshot.next_expiry(now)
+    if next_expiry is not None:
+        timeout = min(timeout, math.floor((next_expiry - now).total_seconds()))
+    # Writes made through other processes only show once the snapshot is reloaded
+    remaining_age = snapshot_remaining_age(snapshot)
+    if remaining_age is not None:
+        timeout = min(timeout, math.floor(remaining_age))
+    return max(timeout, 0)
+
+
+def _applicable_key(snapshot, cart):
+    return f'coupons:applicable:{snapshot.version}:{cart_fingerprint(cart, ordered=True)}'
+
+
+def _apply_key(snapshot, coupon_id, cart):
+    return f'coupons:apply:{snapshot.version}:{coupon_id}:{cart_fingerprint(cart, ordered=True)}'
+
+
+def _record(endpoint, hit):
+    if metrics.enabled():
+        RESULT_CACHE_LOOKUPS.inc(endpoint=endpoint, result='hit' if hit else 'miss')
+
+
+def get_applicable_coupons(cart):
+    """
+    Get all applicable coupons for the given cart, using the result cache.
+    
+    Identical carts evaluated concurrently share one evaluation (see singleflight).
+    
+    Args:
+        cart: A validated cart
+        
+    Returns:
+        list: A list of applicable coupons with their discount amounts
+    """
+    cache = get_cache()
+    if cache is None and not singleflight.enabled():
+        return services.get_applicable_coupons(cart)
+    
+    snapshot = get_snapshot()
+    key = _applicable_key(snapshot, cart)
+    if cache is not None:
+        applicable_coupons = cache.get(key, _MISSING)
+        _record('applicable-coupons', applicable_coupons is not _MISSING)
+        if applicable_coupons is not _MISSING:
+            return applicable_coupons
+    
+    def evaluate():
+        now = timezone.now()
+        result = services.get_applicable_coupons(cart, snapshot=snapshot, now=now)
+        return _store(cache, key, snapshot, now, result)
+    
+    return singleflight.do(key, evaluate, 'applicable-coupons')
+
+
+def apply_coupon(coupon_id, cart):
+    """
+    Apply a specific coupon to the cart, using the result cache.
+    
+    Identical requests applied concurrently share one evaluation (see singleflight).
+    
+    Args:
+        coupon_id: The ID of the coupon to apply
+        cart: A validated cart
+        
+    Returns:
+        dict: The updated cart with discounts applied, or None if coupon is not applicable
+    """
+    cache = get_cache()
+    if cache is None and not singleflight.enabled():
+        return services.apply_coupon(coupon_id, cart)
+    
+    snapshot = get_snapshot()
+    key = _apply_key(snapshot, coupon_id, cart)
+    if cache is not None:
+        discounted_cart = cache.get(key, _MISSING)
+        _record('apply-coupon', discounted_cart is not _MISSING)
+        if discounted_cart is not _MISSING:
+            return discounted_cart
+    
+    def evaluate():
+        now = timezone.now()
+        result = services.apply_coupon(coupon_id, cart, snapshot=snapshot, now=now)
+        return _store(cache, key, snapshot, now, result)
+    
+    return singleflight.do(key, evaluate, 'apply-coupon')
+
+
+async def aget_applicable_coupons(cart):
+    """
+    Get all applicable coupons for the given cart from async code, using the result cache.
+    
+    Args:
+        cart: A validated cart
+        
+    Returns:
+        list: A list of applicable coupons with their discount amounts
+    """
+    cache = get_cache()
+    if cache is None and not singleflight.enabled():
+        return await services.aget_applicable_coupons(cart)
+    
+    snapshot = await aget_snapshot()
+    key = _applicable_key(snapshot, cart)
+    if cache is not None:
+        applicable_coupons = await _aget(cache, key)
+        _record('applicable-coupons', applicable_coupons is not _MISSING)
+        if applicable_coupons is not _MISSING:
+            return applicable_coupons
+    
+    async def evaluate():
+        now = timezone.now()
+        result = services.get_applicable_coupons(cart, snapshot=snapshot, now=now)
+        return await _astore(cache, key, snapshot, now, result)
+    
+    return await singleflight.ado(key, evaluate, 'applicable-coupons')
+
+
+async def aapply_coupon(coupon_id, cart):
+    """
+    Apply a specific coupon to the cart from async code, using the result cache.
+    
+    Args:
+        coupon_id: The ID of the coupon to apply
+        cart: A validated cart
+        
+    Returns:
+        dict: The updated cart with discounts applied, or None if coupon is not applicable
+    """
+    cache = get_cache()
+    if cache is None and not singleflight.enabled():
+        return await services.aapply_coupon(coupon_id, cart)
+    
+    snapshot = await aget_snapshot()
+    key = _apply_key(snapshot, coupon_id, cart)
+    if cache is not None:
+        discounted_cart = await _aget(cache, key)
+        _record('apply-coupon', discounted_cart is not _MISSING)
+        if discounted_cart is not _MISSING:
+            return discounted_cart
+    
+    async def evaluate():
+        now = timezone.now()
+        result = services.apply_coupon(coupon_id, cart, snapshot=snapshot, now=now)
+        return await _astore(cache, key, snapshot, now, result)
+    
+    return await singleflight.ado(key, evaluate, 'apply-coupon')
+
+
+def _store(cache, key, snapshot, now, result):
+    # Results are not cached when the cache is disabled, but still coalesced
+    if cache is not None:
+        timeout = result_timeout(snapshot, now)
+        if timeout:
+            cache.set(key, result, timeout)
+    return result
+
+
+async def _astore(cache, key, snapshot, now, result):
+    if cache is not None:
+        timeout = result_timeout(snapshot, now)
+        if timeout:
+            await _aset(cache, key, result, timeout)
+    return result
+
+
+async def _aget(cache, key):
+    # Local-memory lookups never block, so they skip the thread hop of cache.aget
+    if is_local_cache(cache):
+        return cache.get(key, _MISSING)
+    return await cache.aget(key, _MISSING)
+
+
+async def _aset(cache, key, value, timeout):
+    if is_local_cache(cache):
+        cache.set(key, value, timeout)
+    else:
+        await cache.aset(key, value, timeout)
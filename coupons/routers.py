@@ -0,0 +1,193 @@
+"""
+Read replica routing of coupon reads.
+
+The read-only coupon queries of cart evaluation (the loads of the coupon
+snapshot that services evaluates carts against) and of the coupon list and
+detail endpoints run inside ``replica_reads``, which sends them to one of the
+COUPON_READ_REPLICAS database aliases. Every other query, and every write,
+goes to the ``default`` database.
+
+A replica is only used while it is healthy: its lag is measured at most
+every COUPON_REPLICA_CHECK_INTERVAL seconds, and a replica that cannot be
+reached or lags more than COUPON_REPLICA_MAX_LAG seconds is skipped until the
+next check. Reads fall back to the primary when no replica is healthy, and
+inside a transaction of the primary, which a replica cannot see.
+
+Coupon writes are timestamped in the COUPON_VERSION_CACHE cache. For
+COUPON_REPLICA_MAX_LAG seconds after a write, which a healthy replica may
+not have yet, sticky reads go to the primary. Snapshot loads are always
+sticky, since a snapshot is kept until the next write; the list and detail
+endpoints are sticky if COUPON_REPLICA_READ_YOUR_WRITES is set.
+
+Replicas are filled by replication, never by migrations. Locally, a copy of
+the SQLite database can act as a replica (see COUPON_REPLICA_DB in settings).
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+
+# Seconds a replica is behind its primary, by database vendor; other vendors
+# are only checked to be reachable unless COUPON_REPLICA_LAG_QUERY is set
+LAG_QUERIES = {
+    'postgresql': 'SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)',
+}
+LAST_WRITE_KEY = 'coupons:last-write'
+
+_read_alias = ContextVar('coupons_read_alias', default=None)
+# The last health check of each replica: (checked at, healthy). Races only
+# repeat a check, so the dictionary is not locked.
+_health = {}
+
+
+def replicas():
+    """The database aliases coupon reads may be sent to"""
+    return tuple(getattr(settings, 'COUPON_READ_REPLICAS', ()))
+
+
+def max_lag():
+    """Seconds a replica may be behind the primary"""
+    return getattr(settings, 'COUPON_REPLICA_MAX_LAG', 5)
+
+
+def read_your_writes():
+    """Check if the coupon endpoints read from the primary after a coupon write"""
+    return getattr(settings, 'COUPON_REPLICA_READ_YOUR_WRITES', True)
+
+
+def _write_cache():
+    return caches[getattr(settings, 'COUPON_VERSION_CACHE', 'default')]
+
+
+def record_write():
+    """Remember the time of a coupon write, for sticky reads"""
+    if replicas():
+        _write_cache().set(LAST_WRITE_KEY, time.time(), timeout=None)
+
+
+def written_recently(now=None):
+    """Check if coupons were written too recently for a healthy replica to have the write"""
+    last_write = _write_cache().get(LAST_WRITE_KEY)
+    return last_write is not None and (now or time.time()) - last_write < max_lag()
+
+
+def replica_lag(alias):
+    """
+    Measure how far a replica is behind the primary.
+    
+    Returns:
+        float: The lag in seconds
+        
+    Raises:
+        DatabaseError: If the replica cannot be queried
+    """
+    connection = connections[alias]
+    query = getattr(settings, 'COUPON_REPLICA_LAG_QUERY', None) or LAG_QUERIES.get(connection.vendor)
+    if query is None:
+        connection.ensure_connection()
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        row = cursor.fetchone()
+    return float(row[0] or 0) if row else 0.0
+
+
+def is_healthy(alias, now=None):
+    """Check if a replica is reachable and within COUPON_REPLICA_MAX_LAG, checking it again if due"""
+    now = now or time.monotonic()
+    checked_at, healthy = _health.get(alias, (None, False))
+    if checked_at is not None and now - checked_at < getattr(settings, 'COUPON_REPLICA_CHECK_INTERVAL', 5):
+        return healthy
+    
+    try:
+        healthy = replica_lag(alias) <= max_lag()
+    except DatabaseError:
+        healthy = False
+    _health[alias] = (now, healthy)
+    return healthy
+
+
+def reset_health():
+    """Forget the health checks, so every replica is checked again on its next read"""
+    _health.clear()
+
+
+def read_alias(sticky=True):
+    """
+    Choose the database the coupon reads of a block are sent to.
+    
+    Args:
+        sticky: Read from the primary if coupons were written too recently
+            for the replicas to have the write
+            
+    Returns:
+        str: A healthy replica picked at random, or the default alias
+    """
+    aliases = replicas()
+    if not aliases:
+        return DEFAULT_DB_ALIAS
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    if sticky and written_recently():
+        return DEFAULT_DB_ALIAS
+    
+    healthy = [alias for alias in aliases if is_healthy(alias)]
+    return random.choice(healthy) if healthy else DEFAULT_DB_ALIAS
+
+
+async def aread_alias(sticky=True):
+    """Choose the database for coupon reads from async code, see read_alias"""
+    if not replicas():
+        return DEFAULT_DB_ALIAS
+    # Health checks query the replicas
+    return await sync_to_async(read_alias)(sticky)
+
+
+@contextmanager
+def reads_from(alias):
+    """Send the coupon reads of the block, async ORM calls included, to a database"""
+    token = _read_alias.set(alias)
+    try:
+        yield alias
+    finally:
+        _read_alias.reset(token)
+
+
+@contextmanager
+def replica_reads(sticky=True):
+    """Send the coupon reads of the block to a healthy replica, see read_alias"""
+    with reads_from(read_alias(sticky)) as alias:
+        yield alias
+
+
+class ReplicaRouter:
+    """Routes coupon reads inside replica_reads to a replica"""
+    
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'coupons':
+            return None
+        return _read_alias.get()
+    
+    def db_for_write(self, model, **hints):
+        # Not the database of an instance read from a replica
+        if model._meta.app_label != 'coupons':
+            return None
+        return DEFAULT_DB_ALIAS
+    
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+    
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replicas():
+            return False
+        return None
@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import (
     Coupon, 
@@ -5,7 +6,8 @@ from .models import (
     ProductWiseCoupon, 
     BxGyCoupon, 
     BxGyCouponBuyProduct, 
-    BxGyCouponGetProduct
+    BxGyCouponGetProduct,
+    Redemption
 )
 
 
@@ -52,6 +54,8 @@ class CouponSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'type', 'code', 'name', 'description', 
             'is_active', 'created_at', 'updated_at', 'expires_at',
+            'is_stackable', 'exclusivity_group',
+            'max_redemptions', 'max_redemptions_per_user',
             'cart_wise_details', 'product_wise_details', 'bxgy_details'
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
@@ -200,6 +204,61 @@ class CouponSerializer(serializers.ModelSerializer):
         return instance
 
 
+class CouponImportSerializer(CouponSerializer):
+    """
+    CouponSerializer for bulk imports.
+    
+    The uniqueness of codes is checked by the importer with one query per
+    chunk of rows instead of one query per row.
+    """
+    class Meta(CouponSerializer.Meta):
+        extra_kwargs = {'code': {'validators': []}}
+
+
+class RedemptionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Redemption
+        fields = ['id', 'coupon', 'user_id', 'status', 'discount', 'created_at', 'expires_at']
+        read_only_fields = fields
+
+
+class CodeGenerationSerializer(serializers.Serializer):
+    count = serializers.IntegerField(min_value=1, max_value=settings.COUPON_CODEGEN_MAX_COUNT)
+    pattern = serializers.CharField(required=False, help_text='Code pattern; each "#" becomes a random character')
+
+
+class BulkCouponFilterSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.UUIDField(), required=False, allow_empty=False)
+    code_prefix = serializers.CharField(required=False)
+    type = serializers.ChoiceField(choices=Coupon.COUPON_TYPE_CHOICES, required=False)
+    created_after = serializers.DateTimeField(required=False, help_text='Earliest creation time (inclusive)')
+    created_before = serializers.DateTimeField(required=False, help_text='Latest creation time (exclusive)')
+    
+    def validate(self, data):
+        """
+        Require at least one criterion, so that no request changes every coupon by accident
+        """
+        if not data:
+            raise serializers.ValidationError("At least one filter criterion is required")
+        return data
+
+
+class BulkOperationSerializer(serializers.Serializer):
+    filter = BulkCouponFilterSerializer()
+    operation = serializers.ChoiceField(choices=['activate', 'deactivate', 'set_expiry', 'delete'])
+    expires_at = serializers.DateTimeField(
+        required=False, allow_null=True, help_text='The new expiry time of set_expiry (null removes it)'
+    )
+    
+    def validate(self, data):
+        """
+        Require expires_at for set_expiry
+        """
+        if data['operation'] == 'set_expiry' and 'expires_at' not in data:
+            raise serializers.ValidationError({'expires_at': ["This field is required for set_expiry."]})
+        return data
+
+
 # Cart Item and Cart Serializers for API requests
 class CartItemSerializer(serializers.Serializer):
     product_id = serializers.IntegerField()
@@ -215,6 +274,17 @@ class CartSerializer(serializers.Serializer):
     items = CartItemSerializer(many=True)
 
 
+class CartBatchSerializer(serializers.Serializer):
+    carts = CartSerializer(many=True, allow_empty=False, max_length=settings.COUPON_BATCH_MAX_CARTS)
+
+
+class RedemptionRequestSerializer(serializers.Serializer):
+    user_id = serializers.CharField(
+        max_length=100, required=False, allow_null=True, allow_blank=True,
+        help_text='The user redeeming the coupon, required by coupons with a per-user limit'
+    )
+
+
 # Response Serializers
 
 class DiscountedCartItemSerializer(serializers.Serializer):
@@ -231,6 +301,14 @@ class DiscountedCartSerializer(serializers.Serializer):
     final_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
 
 
+class RedeemedCartSerializer(DiscountedCartSerializer):
+    redemption_id = serializers.UUIDField()
+
+
+class ReservedCartSerializer(RedeemedCartSerializer):
+    reserved_until = serializers.DateTimeField()
+
+
 class ApplicableCouponSerializer(serializers.Serializer):
     coupon_id = serializers.UUIDField()
     type = serializers.CharField()
@@ -240,4 +318,15 @@ class ApplicableCouponSerializer(serializers.Serializer):
     
 
 class ApplicableCouponsResponseSerializer(serializers.Serializer):
-    applicable_coupons = ApplicableCouponSerializer(many=True) 
\ No newline at end of file
+    applicable_coupons = ApplicableCouponSerializer(many=True)
+
+
+class BatchApplicableCouponsResponseSerializer(serializers.Serializer):
+    results = ApplicableCouponsResponseSerializer(many=True)
+
+
+class BestCouponsResponseSerializer(serializers.Serializer):
+    coupons = ApplicableCouponSerializer(many=True)
+    total_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
+    total_discount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
+    final_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
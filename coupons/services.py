@@ -1,48 +1,65 @@
+import time
 from decimal import Decimal
+from django.conf import settings
 from django.utils import timezone
-from .models import Coupon
-from .coupon_logics import cart_wise, product_wise, bxgy
+from .snapshot import get_snapshot, aget_snapshot
+from . import metrics, sharding, vectorized
+from .coupon_logics import cart_wise, product_wise, bxgy, cents
+from .coupon_logics.context import CartContext
 
 
-def get_applicable_coupons(cart):
+def get_applicable_coupons(cart, snapshot=None, now=None, use_shards=True):
     """
     Get all applicable coupons for the given cart.
     
     Args:
         cart: A dictionary containing cart items
+        snapshot: The CouponSnapshot to evaluate against (defaults to the current one)
+        now: The time used to skip expired coupons (defaults to now)
+        use_shards: Evaluate huge catalogs on the process pool of sharding
         
     Returns:
         list: A list of applicable coupons with their discount amounts
     """
-    all_coupons = Coupon.objects.filter(is_active=True)
+    snapshot = snapshot or get_snapshot()
+    now = now or timezone.now()
     applicable_coupons = []
+    started = time.perf_counter()
+    stats = metrics.EvaluationStats() if metrics.enabled() else None
     
-    for coupon in all_coupons:
+    # Walk the cart once; every coupon is evaluated against the same context
+    context = CartContext(cart)
+    
+    # Huge catalogs are split across a pool of worker processes
+    if use_shards and sharding.should_shard(snapshot):
+        sharded_coupons = sharding.get_applicable_coupons(snapshot, cart, now)
+        if sharded_coupons is not None:
+            if stats is not None:
+                record_applicable_metrics('sharded', context, started)
+            return sharded_coupons
+    
+    # Very large catalogs are evaluated as columnar arrays when NumPy is available
+    if vectorized.should_vectorize(snapshot):
+        vectorized_coupons = vectorized.get_applicable_coupons(snapshot, context, now)
+        if vectorized_coupons is not None:
+            if stats is not None:
+                record_applicable_metrics('vectorized', context, started)
+            return vectorized_coupons
+    
+    # Only coupons reachable from the cart's items can apply
+    for coupon in snapshot.candidates(context):
         # Skip expired coupons
-        if coupon.is_expired():
+        if coupon.is_expired(now):
             continue
         
-        # Check if coupon is applicable based on type
-        is_applicable = False
-        discount_amount = Decimal('0.00')
-        
-        if coupon.type == 'cart-wise':
-            is_applicable = cart_wise.is_applicable(coupon, cart)
-            if is_applicable:
-                discount_amount = cart_wise.calculate_discount(coupon, cart)
-        
-        elif coupon.type == 'product-wise':
-            is_applicable = product_wise.is_applicable(coupon, cart)
-            if is_applicable:
-                discount_amount = product_wise.calculate_discount(coupon, cart)
-        
-        elif coupon.type == 'bxgy':
-            is_applicable = bxgy.is_applicable(coupon, cart)
-            if is_applicable:
-                discount_amount = bxgy.calculate_discount(coupon, cart)
+        evaluation_started = time.perf_counter()
+        discount_amount = calculate_coupon_discount(coupon, context)
+        is_hit = discount_amount is not None and discount_amount > Decimal('0.00')
+        if stats is not None:
+            stats.add(coupon.type, time.perf_counter() - evaluation_started, is_hit)
         
         # If applicable and provides a discount, add to list
-        if is_applicable and discount_amount > Decimal('0.00'):
+        if is_hit:
             applicable_coupons.append({
                 'coupon_id': coupon.id,
                 'type': coupon.type,
@@ -51,44 +68,175 @@ def get_applicable_coupons(cart):
                 'discount': discount_amount
             })
     
+    if stats is not None:
+        stats.record()
+        record_applicable_metrics('indexed', context, started)
+    
     # Sort by discount amount (highest first)
     applicable_coupons.sort(key=lambda x: x['discount'], reverse=True)
     
     return applicable_coupons
 
 
-def apply_coupon(coupon_id, cart):
+def record_applicable_metrics(path, context, started):
+    """Record the cart size and the evaluation time of one cart"""
+    metrics.CART_LINES.observe(len(context.items))
+    metrics.APPLICABLE_DURATION.observe(time.perf_counter() - started, path=path)
+
+
+def get_applicable_coupons_batch(carts):
+    """
+    Get the applicable coupons for each of several carts.
+    
+    The coupon snapshot and the evaluation time are taken once for the whole
+    batch. Results are yielded one cart at a time so that callers can stream
+    them.
+    
+    Args:
+        carts: An iterable of dictionaries containing cart items
+        
+    Yields:
+        list: The applicable coupons of each cart, in the order of the carts
+    """
+    snapshot = get_snapshot()
+    now = timezone.now()
+    
+    for cart in carts:
+        yield get_applicable_coupons(cart, snapshot=snapshot, now=now)
+
+
+def apply_coupon(coupon_id, cart, snapshot=None, now=None):
     """
     Apply a specific coupon to the cart.
     
     Args:
         coupon_id: The ID of the coupon to apply
         cart: A dictionary containing cart items
+        snapshot: The CouponSnapshot to look the coupon up in (defaults to the current one)
+        now: The time used to check expiry (defaults to now)
         
     Returns:
         dict: The updated cart with discounts applied, or None if coupon is not applicable
     """
-    try:
-        coupon = Coupon.objects.get(id=coupon_id, is_active=True)
-    except Coupon.DoesNotExist:
+    coupon = (snapshot or get_snapshot()).get(coupon_id)
+    if coupon is None:
         return None
     
     # Skip expired coupons
-    if coupon.is_expired():
+    if coupon.is_expired(now):
         return None
     
+    context = CartContext(cart)
+    
+    return apply_coupon_to_context(coupon, context)
+
+
+async def aget_applicable_coupons(cart):
+    """
+    Get all applicable coupons for the given cart from async code.
+    
+    Args:
+        cart: A dictionary containing cart items
+        
+    Returns:
+        list: A list of applicable coupons with their discount amounts
+    """
+    snapshot = await aget_snapshot()
+    now = timezone.now()
+    
+    # Awaits the worker processes instead of blocking the event loop on them
+    if sharding.should_shard(snapshot):
+        started = time.perf_counter()
+        sharded_coupons = await sharding.aget_applicable_coupons(snapshot, cart, now)
+        if sharded_coupons is not None:
+            if metrics.enabled():
+                record_applicable_metrics('sharded', CartContext(cart), started)
+            return sharded_coupons
+        
+    return get_applicable_coupons(cart, snapshot=snapshot, now=now, use_shards=False)
+
+
+async def aapply_coupon(coupon_id, cart):
+    """
+    Apply a specific coupon to the cart from async code.
+    
+    Args:
+        coupon_id: The ID of the coupon to apply
+        cart: A dictionary containing cart items
+        
+    Returns:
+        dict: The updated cart with discounts applied, or None if coupon is not applicable
+    """
+    return apply_coupon(coupon_id, cart, snapshot=await aget_snapshot())
+
+
+def use_cents_engine():
+    """Check if discounts should be calculated with the integer cents engine"""
+    return getattr(settings, 'COUPON_ENGINE', 'decimal') == 'cents'
+
+
+def calculate_coupon_discount(coupon, context):
+    """
+    Calculate the discount a coupon gives on the cart.
+    
+    Args:
+        coupon: A compiled CouponRule
+        context: A CartContext for the cart
+        
+    Returns:
+        Decimal: The discount amount, or None if the coupon is not applicable
+    """
+    if use_cents_engine():
+        discount_cents = cents.calculate_discount(coupon, context)
+        if discount_cents is None:
+            return None
+        return cents.from_cents(discount_cents)
+    
+    # Check if coupon is applicable based on type
+    if coupon.type == 'cart-wise':
+        if cart_wise.is_applicable(coupon, context):
+            return cart_wise.calculate_discount(coupon, context)
+    
+    elif coupon.type == 'product-wise':
+        if product_wise.is_applicable(coupon, context):
+            return product_wise.calculate_discount(coupon, context)
+    
+    elif coupon.type == 'bxgy':
+        if bxgy.is_applicable(coupon, context):
+            return bxgy.calculate_discount(coupon, context)
+    
+    return None
+
+
+def apply_coupon_to_context(coupon, context):
+    """
+    Apply a compiled coupon to the cart.
+    
+    Args:
+        coupon: A compiled CouponRule
+        context: A CartContext for the cart
+        
+    Returns:
+        dict: The updated cart with discounts applied, or None if coupon is not applicable
+    """
+    if use_cents_engine():
+        discounted_cart = cents.apply_discount(coupon, context)
+        if discounted_cart is None:
+            return None
+        return cents.to_decimal_cart(discounted_cart)
+    
     # Apply coupon based on type
     if coupon.type == 'cart-wise':
-        if cart_wise.is_applicable(coupon, cart):
-            return cart_wise.apply_discount(coupon, cart)
+        if cart_wise.is_applicable(coupon, context):
+            return cart_wise.apply_discount(coupon, context)
     
     elif coupon.type == 'product-wise':
-        if product_wise.is_applicable(coupon, cart):
-            return product_wise.apply_discount(coupon, cart)
+        if product_wise.is_applicable(coupon, context):
+            return product_wise.apply_discount(coupon, context)
     
     elif coupon.type == 'bxgy':
-        if bxgy.is_applicable(coupon, cart):
-            return bxgy.apply_discount(coupon, cart)
+        if bxgy.is_applicable(coupon, context):
+            return bxgy.apply_discount(coupon, context)
     
     # Coupon not applicable
-    return None 
\ No newline at end of file
+    return None
\ No newline at end of file
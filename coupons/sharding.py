@@ -0,0 +1,354 @@
+"""
+Sharded evaluation of very large coupon catalogs on a process pool.
+
+Evaluating a cart is CPU-bound once the snapshot is in memory, so a single
+request only ever uses one core. When the active catalog reaches
+COUPON_SHARD_THRESHOLD coupons and COUPON_SHARD_COUNT is set, the snapshot is
+split into that many shards, each with its own candidate indexes, and a
+persistent pool of worker processes is forked. Forking after the snapshot has
+loaded means the workers share the compiled coupons with the parent
+copy-on-write instead of loading or receiving them.
+
+Each worker evaluates one shard per task and returns its best
+COUPON_SHARD_TOP_N coupons (all of them by default); the parent merges the
+shard results by discount. Workers never use the database connections they
+inherit.
+
+Pools are forked by a background thread, never by a request: until the pool
+of the current snapshot is ready, carts are evaluated in the requesting
+process. A pool is only replaced by the pool of a newer snapshot, and the
+replaced pool is closed gracefully once the evaluations running on it have
+finished.
+
+Async callers await the shard results without blocking their event loop.
+"""
+import asyncio
+import atexit
+import heapq
+import itertools
+import multiprocessing
+import threading
+from functools import partial
+
+from django.conf import settings
+
+from . import vectorized
+from .snapshot import CouponSnapshot
+
+
+# Shards of every live pool, by pool number; forked workers inherit them
+_pool_shards = {}
+_pool_numbers = itertools.count()
+_pool = None
+# The snapshot a pool is being forked for, and the last one whose fork failed
+_forking = None
+_failed = None
+_pool_lock = threading.Lock()
+_pool_changed = threading.Condition(_pool_lock)
+_in_worker = False
+
+
+def is_available():
+    """Check if worker processes can be forked on this platform"""
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def should_shard(snapshot):
+    """
+    Check if a snapshot should be evaluated on the process pool.
+    
+    Args:
+        snapshot: A CouponSnapshot
+        
+    Returns:
+        bool: True if sharded evaluation should be used
+    """
+    shard_count = getattr(settings, 'COUPON_SHARD_COUNT', None)
+    if not shard_count or shard_count < 2 or _in_worker or not is_available():
+        return False
+    return len(snapshot) >= getattr(settings, 'COUPON_SHARD_THRESHOLD', 200000)
+
+
+def split_snapshot(snapshot, shard_count):
+    """
+    Split a snapshot into shards of about the same size.
+    
+    Coupons keep their snapshot sequence numbers, so results of different
+    shards can be merged in the same order as the unsharded evaluation.
+    
+    Args:
+        snapshot: A CouponSnapshot
+        shard_count: Number of shards
+        
+    Returns:
+        list: One CouponSnapshot per shard
+    """
+    return [CouponSnapshot(snapshot.rules[index::shard_count]) for index in range(shard_count)]
+
+
+def _init_worker():
+    global _in_worker
+    
+    _in_worker = True
+    # Metrics recorded in a worker would never be scraped
+    settings.COUPON_METRICS_ENABLED = False
+
+
+def _evaluate_shard(pool_number, shard_index, cart, now, top_n):
+    """Evaluate a cart against one shard inside a worker process"""
+    from .services import get_applicable_coupons
+    
+    shard = _pool_shards[pool_number][shard_index]
+    applicable_coupons = get_applicable_coupons(cart, snapshot=shard, now=now)
+    return applicable_coupons[:top_n] if top_n else applicable_coupons
+
+
+class ShardPool:
+    """A pool of forked workers holding the shards of one snapshot"""
+    
+    def __init__(self, snapshot, shard_count):
+        self.snapshot = snapshot
+        self.shard_count = shard_count
+        self.number = next(_pool_numbers)
+        # Evaluations running on the pool, and whether a newer pool replaced it
+        self.users = 0
+        self.retired = False
+        
+        shards = split_snapshot(snapshot, shard_count)
+        # Build lazily created structures before forking so workers inherit them
+        for shard in shards:
+            if vectorized.should_vectorize(shard):
+                vectorized.get_tables(shard)
+        _pool_shards[self.number] = shards
+        
+        context = multiprocessing.get_context('fork')
+        try:
+            self.pool = context.Pool(processes=shard_count, initializer=_init_worker)
+        except BaseException:
+            _pool_shards.pop(self.number, None)
+            raise
+        
+    def evaluate(self, cart, now, top_n=None, timeout=None):
+        """
+        Evaluate a cart on every shard and merge the results.
+        
+        Returns:
+            list: The applicable coupons, highest discount first
+        """
+        tasks = [
+            self.pool.apply_async(_evaluate_shard, (self.number, index, cart, now, top_n))
+            for index in range(self.shard_count)
+        ]
+        return self._merge([task.get(timeout) for task in tasks], top_n)
+        
+    async def aevaluate(self, cart, now, top_n=None, timeout=None):
+        """
+        Evaluate a cart on every shard from async code, see evaluate.
+        
+        Raises:
+            asyncio.TimeoutError: If the workers did not answer within timeout seconds
+        """
+        loop = asyncio.get_running_loop()
+        futures = []
+        for index in range(self.shard_count):
+            future = loop.create_future()
+            # Callbacks run on a thread of the pool, not of the loop
+            self.pool.apply_async(
+                _evaluate_shard, (self.number, index, cart, now, top_n),
+                callback=partial(_resolve, loop, future, None),
+                error_callback=partial(_resolve, loop, future)
+            )
+            futures.append(future)
+        return self._merge(await asyncio.wait_for(asyncio.gather(*futures), timeout), top_n)
+    
+    def _merge(self, shard_results, top_n):
+        by_id = self.snapshot.by_id
+        merged = heapq.merge(
+            *shard_results,
+            key=lambda coupon: (-coupon['discount'], by_id[coupon['coupon_id']].seq)
+        )
+        return list(itertools.islice(merged, top_n)) if top_n else list(merged)
+    
+    def close(self):
+        """Stop the workers once their tasks are done"""
+        self.pool.close()
+        self.pool.join()
+        _pool_shards.pop(self.number, None)
+        
+    def terminate(self):
+        """Stop the workers immediately"""
+        self.pool.terminate()
+        self.pool.join()
+        _pool_shards.pop(self.number, None)
+
+
+def _resolve(loop, future, error, result=None):
+    def settle():
+        if future.done():
+            return  # Timed out
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+            
+    try:
+        loop.call_soon_threadsafe(settle)
+    except RuntimeError:
+        pass  # The loop was closed
+    
+    
+def _is_newer(snapshot, than):
+    if snapshot is than:
+        return False
+    if snapshot.version is None or than.version is None:
+        # Snapshots built outside get_snapshot have no version to compare
+        return True
+    # Reloads after COUPON_SNAPSHOT_MAX_AGE keep the version and the coupons
+    return snapshot.version > than.version
+    
+
+def _serves(pool, snapshot, shard_count):
+    # A pool of a newer snapshot also serves the requests still holding an older one
+    return pool is not None and pool.shard_count == shard_count and not _is_newer(snapshot, pool.snapshot)
+
+
+def _retire(pool):
+    # Called with the lock held
+    pool.retired = True
+    if pool.users == 0:
+        threading.Thread(target=pool.close, name='coupon-shard-pool-close', daemon=True).start()
+        
+        
+def _start_fork(snapshot, shard_count):
+    """Fork the pool of a snapshot in a background thread, unless a fork of it or a newer one runs; lock held"""
+    global _forking
+    
+    if snapshot is _failed or (_forking is not None and not _is_newer(snapshot, _forking)):
+        return
+    _forking = snapshot
+    threading.Thread(
+        target=_fork, args=(snapshot, shard_count), name='coupon-shard-pool-fork', daemon=True
+    ).start()
+    
+    
+def _fork(snapshot, shard_count):
+    global _pool, _forking, _failed
+    
+    try:
+        pool = ShardPool(snapshot, shard_count)
+    except Exception:
+        pool = None
+    
+    with _pool_lock:
+        if _forking is snapshot:
+            _forking = None
+        if pool is None:
+            _failed = snapshot
+        elif _serves(_pool, snapshot, shard_count):
+            # The pool of a newer snapshot was forked meanwhile
+            _retire(pool)
+        else:
+            if _pool is not None:
+                _retire(_pool)
+            _pool = pool
+        _pool_changed.notify_all()
+        
+        
+def acquire_pool(snapshot):
+    """
+    Take a reference to the pool serving a snapshot, starting to fork one if needed.
+    
+    Returns:
+        ShardPool: The pool, to be given back with release_pool, or None if it is
+            not forked yet
+    """
+    shard_count = settings.COUPON_SHARD_COUNT
+    with _pool_lock:
+        if _serves(_pool, snapshot, shard_count):
+            _pool.users += 1
+            return _pool
+        _start_fork(snapshot, shard_count)
+        return None
+    
+    
+def release_pool(pool):
+    """Give back a reference taken by acquire_pool"""
+    with _pool_lock:
+        pool.users -= 1
+        if pool.retired:
+            _retire(pool)
+            
+            
+def get_pool(snapshot, timeout=None):
+    """
+    Return the pool serving a snapshot, waiting for it to be forked.
+    
+    Raises:
+        OSError: If the pool could not be forked
+        multiprocessing.TimeoutError: If it was not forked within timeout seconds
+    """
+    shard_count = settings.COUPON_SHARD_COUNT
+    with _pool_changed:
+        while not _serves(_pool, snapshot, shard_count):
+            if snapshot is _failed:
+                raise OSError('The shard pool could not be forked')
+            _start_fork(snapshot, shard_count)
+            if not _pool_changed.wait(timeout):
+                raise multiprocessing.TimeoutError('The shard pool was not forked in time')
+        return _pool
+
+
+def get_applicable_coupons(snapshot, cart, now):
+    """
+    Get all applicable coupons for a cart using the process pool.
+    
+    Args:
+        snapshot: A CouponSnapshot
+        cart: A dictionary containing cart items
+        now: The time used to skip expired coupons
+        
+    Returns:
+        list: Applicable coupons with their discount amounts, highest first,
+            or None if the pool is not forked yet or failed, and the cart
+            should be evaluated in this process
+    """
+    top_n = getattr(settings, 'COUPON_SHARD_TOP_N', None)
+    timeout = getattr(settings, 'COUPON_SHARD_TIMEOUT', None)
+    pool = acquire_pool(snapshot)
+    if pool is None:
+        return None
+    try:
+        return pool.evaluate(cart, now, top_n=top_n, timeout=timeout)
+    except (multiprocessing.TimeoutError, OSError, ValueError):
+        return None
+    finally:
+        release_pool(pool)
+
+
+async def aget_applicable_coupons(snapshot, cart, now):
+    """Get all applicable coupons for a cart using the process pool from async code, see get_applicable_coupons"""
+    top_n = getattr(settings, 'COUPON_SHARD_TOP_N', None)
+    timeout = getattr(settings, 'COUPON_SHARD_TIMEOUT', None)
+    pool = acquire_pool(snapshot)
+    if pool is None:
+        return None
+    try:
+        return await pool.aevaluate(cart, now, top_n=top_n, timeout=timeout)
+    except (asyncio.TimeoutError, OSError, ValueError):
+        return None
+    finally:
+        release_pool(pool)
+        
+        
+def shutdown():
+    """Terminate the worker processes"""
+    global _pool, _failed
+    
+    with _pool_lock:
+        if _pool is not None:
+            _pool.terminate()
+            _pool = None
+        _failed = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,69 @@
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from .models import (
+    Coupon,
+    CartWiseCoupon,
+    ProductWiseCoupon,
+    BxGyCoupon,
+    BxGyCouponBuyProduct,
+    BxGyCouponGetProduct
+)
+from .snapshot import invalidate_snapshot
+
+
+SNAPSHOT_MODELS = (
+    Coupon,
+    CartWiseCoupon,
+    ProductWiseCoupon,
+    BxGyCoupon,
+    BxGyCouponBuyProduct,
+    BxGyCouponGetProduct,
+)
+
+
+_batch = threading.local()
+
+
+def coupon_changed(sender, **kwargs):
+    """
+    Invalidate the coupon snapshot after any write to the coupon tables.
+    
+    The snapshot is dropped immediately and once more when the surrounding
+    transaction commits, so a rebuild that raced with the write cannot keep
+    serving the pre-commit state. Inside ``batched_invalidation`` this only
+    happens once, when the block ends.
+    """
+    if getattr(_batch, 'depth', 0):
+        _batch.changed = True
+        return
+    invalidate_snapshot()
+    transaction.on_commit(invalidate_snapshot)
+
+
+@contextmanager
+def batched_invalidation():
+    """
+    Invalidate the coupon snapshot once for all writes in the block, instead of once per row.
+    
+    Writes that send no signals (``update``, ``bulk_create``) can call
+    ``coupon_changed`` themselves.
+    """
+    depth = getattr(_batch, 'depth', 0)
+    if depth == 0:
+        _batch.changed = False
+    _batch.depth = depth + 1
+    try:
+        yield
+    finally:
+        _batch.depth = depth
+        if depth == 0 and _batch.changed:
+            coupon_changed(None)
+
+
+for model in SNAPSHOT_MODELS:
+    post_save.connect(coupon_changed, sender=model, dispatch_uid=f'coupon_snapshot_save_{model.__name__}')
+    post_delete.connect(coupon_changed, sender=model, dispatch_uid=f'coupon_snapshot_delete_{model.__name__}')
@@ -0,0 +1,177 @@
+"""
+Single-flight coalescing of identical concurrent cart evaluations.
+
+During a flash sale many requests evaluate the same cart at the same time
+(page refreshes, a popular bundle). When none of them finds the result in the
+result cache, every one of them would evaluate the cart. Instead, the first
+request computes the result, and identical requests arriving while it runs
+wait for it and share its result or its exception. Requests are identical
+when they have the same key, built by result_cache from the catalog version
+and the cart fingerprint.
+
+Threads of the sync views wait on a ``threading.Event``; coroutines of the
+async views await a future of their event loop, so waiting never blocks the
+loop. Coroutines only overlap while the computing one awaits, e.g. while it
+stores its result in a shared cache. Coalescing is per process, and shared
+results must not be modified by the callers.
+
+Calls are counted in the ``coupon_single_flight_requests_total`` metric by
+role: the leader computes a result and followers share it. The time
+followers wait is observed in ``coupon_single_flight_wait_seconds``.
+"""
+import asyncio
+import threading
+import time
+import weakref
+
+from django.conf import settings
+
+from . import metrics
+
+
+SINGLE_FLIGHT_REQUESTS = metrics.Counter(
+    'coupon_single_flight_requests_total',
+    'Evaluations by endpoint and role (leader computed the result, follower shared it)',
+    ('endpoint', 'role')
+)
+SINGLE_FLIGHT_WAIT = metrics.Histogram(
+    'coupon_single_flight_wait_seconds',
+    'Time followers waited for the result of an identical evaluation',
+    ('endpoint',)
+)
+
+
+def enabled():
+    """Check if identical concurrent evaluations are coalesced"""
+    return getattr(settings, 'COUPON_SINGLE_FLIGHT', True)
+
+
+class Call:
+    """An evaluation in flight"""
+    __slots__ = ('done', 'result', 'error', 'followers')
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class Group:
+    """The evaluations in flight in this process, by key"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        # Futures can only be awaited from their own event loop
+        self.async_calls = weakref.WeakKeyDictionary()
+        
+    def do(self, key, fn, endpoint):
+        """
+        Call fn, or wait for the result of an identical call in flight.
+        
+        Args:
+            key: The key identifying identical calls
+            fn: A callable computing the result
+            endpoint: The endpoint label of the metrics
+            
+        Returns:
+            The result of fn
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = Call()
+            else:
+                call.followers += 1
+                
+        if not is_leader:
+            started = time.perf_counter()
+            call.done.wait()
+            _record(endpoint, 'follower', started)
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        _record(endpoint, 'leader')
+        try:
+            call.result = fn()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+    
+    async def ado(self, key, fn, endpoint):
+        """
+        Await fn, or the result of an identical call in flight in the same event loop.
+        
+        Like do, with fn returning an awaitable. If the leader is cancelled,
+        its followers compute the result again.
+        """
+        loop = asyncio.get_running_loop()
+        calls = self.async_calls.get(loop)
+        if calls is None:
+            calls = self.async_calls[loop] = {}
+            
+        started = time.perf_counter()
+        while key in calls:
+            future = calls[key]
+            try:
+                # Shielded, so a cancelled follower does not cancel the leader's future
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    continue
+                raise
+            except BaseException:
+                _record(endpoint, 'follower', started)
+                raise
+            _record(endpoint, 'follower', started)
+            return result
+        
+        future = calls[key] = loop.create_future()
+        _record(endpoint, 'leader')
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Retrieved, so a call without followers does not log it as unhandled
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del calls[key]
+        return result
+
+
+def _record(endpoint, role, started=None):
+    if metrics.enabled():
+        SINGLE_FLIGHT_REQUESTS.inc(endpoint=endpoint, role=role)
+        if started is not None:
+            SINGLE_FLIGHT_WAIT.observe(time.perf_counter() - started, endpoint=endpoint)
+
+
+group = Group()
+
+
+def do(key, fn, endpoint):
+    """Call fn once for identical concurrent calls, see Group.do"""
+    if not enabled():
+        return fn()
+    return group.do(key, fn, endpoint)
+
+
+async def ado(key, fn, endpoint):
+    """Await fn once for identical concurrent calls, see Group.ado"""
+    if not enabled():
+        return await fn()
+    return await group.ado(key, fn, endpoint)
@@ -0,0 +1,522 @@
+"""
+Per-process snapshot of the active coupon catalog.
+
+Active coupons are loaded once and compiled into plain, immutable rule objects
+so that evaluating a cart never has to go back to the database. The snapshot
+is dropped whenever a coupon (or one of its detail rows) is written and is
+rebuilt lazily on the next read.
+
+Writes also bump a catalog version number kept in the Django cache
+(COUPON_VERSION_CACHE). A snapshot remembers the version it was built at and
+is rebuilt once the version moves on, so with a cache shared by all worker
+processes a write in one process reaches the snapshots of the others too.
+With a cache local to each process, a write only reaches the other processes
+once their snapshot is older than COUPON_SNAPSHOT_MAX_AGE seconds and
+reloads; the result cache never keeps a result longer than that either. A
+snapshot that is only too old keeps being served while one background thread
+reloads it, so requests never wait for that reload.
+
+Async code uses ``aget_snapshot``, which loads the coupons with the async ORM
+and lets concurrent coroutines wait for a single rebuild instead of blocking
+the event loop.
+"""
+import asyncio
+import threading
+import time
+import uuid
+import weakref
+from bisect import bisect_right
+from collections import defaultdict
+from operator import attrgetter
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connections
+from django.utils import timezone
+
+from . import routers
+from .models import Coupon
+from .coupon_logics.cents import to_cents
+
+
+class CartWiseRule(NamedTuple):
+    """Compiled cart-wise coupon details (the *_cents fields feed the cents engine)"""
+    discount_type: str
+    threshold: object
+    discount_value: object
+    threshold_cents: int
+    discount_value_cents: int
+
+
+class ProductWiseRule(NamedTuple):
+    """Compiled product-wise coupon details (discount_value_cents feeds the cents engine)"""
+    discount_type: str
+    product_id: Optional[int]
+    category: Optional[str]
+    brand: Optional[str]
+    discount_value: object
+    discount_value_cents: int
+
+
+class BxGyRule(NamedTuple):
+    """Compiled BxGy coupon details (product mappings are product_id -> quantity)"""
+    repetition_limit: int
+    buy_products: MappingProxyType
+    get_products: MappingProxyType
+
+
+class CouponRule(NamedTuple):
+    """A compiled coupon with the details for its type (the others are None)"""
+    id: uuid.UUID
+    type: str
+    name: str
+    code: str
+    expires_at: object
+    seq: int
+    cart_wise_details: Optional[CartWiseRule] = None
+    product_wise_details: Optional[ProductWiseRule] = None
+    bxgy_details: Optional[BxGyRule] = None
+    is_stackable: bool = False
+    exclusivity_group: Optional[str] = None
+    
+    def is_expired(self, now=None):
+        """Check if the coupon is expired at the given time (defaults to now)"""
+        if self.expires_at is None:
+            return False
+        return (now or timezone.now()) > self.expires_at
+
+
+def compile_coupon(coupon, seq=0):
+    """
+    Compile a Coupon model instance into a CouponRule.
+    
+    Args:
+        coupon: A Coupon loaded with its details (see CouponQuerySet.with_details)
+        seq: Position of the coupon in the snapshot, used to keep ordering stable
+        
+    Returns:
+        CouponRule: The compiled coupon
+    """
+    details = {}
+    
+    if coupon.type == 'cart-wise' and hasattr(coupon, 'cart_wise_details'):
+        cart_wise_details = coupon.cart_wise_details
+        details['cart_wise_details'] = CartWiseRule(
+            discount_type=cart_wise_details.discount_type,
+            threshold=cart_wise_details.threshold,
+            discount_value=cart_wise_details.discount_value,
+            threshold_cents=to_cents(cart_wise_details.threshold),
+            discount_value_cents=to_cents(cart_wise_details.discount_value),
+        )
+    elif coupon.type == 'product-wise' and hasattr(coupon, 'product_wise_details'):
+        product_wise_details = coupon.product_wise_details
+        details['product_wise_details'] = ProductWiseRule(
+            discount_type=product_wise_details.discount_type,
+            product_id=product_wise_details.product_id,
+            category=product_wise_details.category,
+            brand=product_wise_details.brand,
+            discount_value=product_wise_details.discount_value,
+            discount_value_cents=to_cents(product_wise_details.discount_value),
+        )
+    elif coupon.type == 'bxgy' and hasattr(coupon, 'bxgy_details'):
+        bxgy_details = coupon.bxgy_details
+        details['bxgy_details'] = BxGyRule(
+            repetition_limit=bxgy_details.repetition_limit,
+            buy_products=MappingProxyType(
+                {bp.product_id: bp.quantity for bp in bxgy_details.buy_products.all()}
+            ),
+            get_products=MappingProxyType(
+                {gp.product_id: gp.quantity for gp in bxgy_details.get_products.all()}
+            ),
+        )
+        
+    return CouponRule(
+        id=coupon.id,
+        type=coupon.type,
+        name=coupon.name,
+        code=coupon.code,
+        expires_at=coupon.expires_at,
+        seq=seq,
+        is_stackable=coupon.is_stackable,
+        exclusivity_group=coupon.exclusivity_group or None,
+        **details
+    )
+
+
+class ThresholdIndex:
+    """
+    Cart-wise rules of a single discount type, sorted by threshold.
+    
+    A cart-wise coupon applies when the cart total reaches its threshold, so
+    the eligible rules for a total are always a prefix of the sorted list and
+    one bisect finds them.
+    """
+    
+    def __init__(self, rules):
+        self.rules = tuple(sorted(rules, key=lambda rule: (rule.cart_wise_details.threshold, rule.seq)))
+        self.thresholds = [rule.cart_wise_details.threshold for rule in self.rules]
+        
+    def eligible(self, cart_total):
+        """Return the rules whose threshold is met by the cart total"""
+        return self.rules[:bisect_right(self.thresholds, cart_total)]
+
+
+def _freeze_index(index):
+    return {key: tuple(rules) for key, rules in index.items()}
+
+
+class CouponSnapshot:
+    """
+    An immutable, compiled view of all active coupons.
+    
+    Besides the flat list of rules, the snapshot keeps indexes so that only
+    coupons that can apply to a cart have to be evaluated: cart-wise coupons
+    are sorted by threshold per discount type, product-wise coupons are
+    indexed by product_id, category and brand, and BxGy coupons by each of
+    their buy product ids.
+    """
+    
+    def __init__(self, rules, version=None):
+        self.rules = tuple(rules)
+        self.version = version
+        self.built_at = time.monotonic()
+        self.by_id = {rule.id: rule for rule in self.rules}
+        self.expiries = sorted(rule.expires_at for rule in self.rules if rule.expires_at is not None)
+        
+        cart_wise_rules = defaultdict(list)
+        product_index = defaultdict(list)
+        category_index = defaultdict(list)
+        brand_index = defaultdict(list)
+        bxgy_index = defaultdict(list)
+        
+        for rule in self.rules:
+            if rule.cart_wise_details is not None:
+                cart_wise_rules[rule.cart_wise_details.discount_type].append(rule)
+            elif rule.product_wise_details is not None:
+                details = rule.product_wise_details
+                # Mirrors product_wise.matching_lines: empty targets never match
+                if details.product_id:
+                    product_index[details.product_id].append(rule)
+                if details.category:
+                    category_index[details.category].append(rule)
+                if details.brand:
+                    brand_index[details.brand].append(rule)
+            elif rule.bxgy_details is not None:
+                for product_id in rule.bxgy_details.buy_products:
+                    bxgy_index[product_id].append(rule)
+                    
+        self.cart_wise_index = {
+            discount_type: ThresholdIndex(type_rules)
+            for discount_type, type_rules in cart_wise_rules.items()
+        }
+        self.product_index = _freeze_index(product_index)
+        self.category_index = _freeze_index(category_index)
+        self.brand_index = _freeze_index(brand_index)
+        self.bxgy_index = _freeze_index(bxgy_index)
+        
+    def __len__(self):
+        return len(self.rules)
+    
+    def get(self, coupon_id):
+        """Return the rule for the given coupon ID, or None if it is not active"""
+        if not isinstance(coupon_id, uuid.UUID):
+            try:
+                coupon_id = uuid.UUID(str(coupon_id))
+            except ValueError:
+                return None
+        return self.by_id.get(coupon_id)
+    
+    def next_expiry(self, now):
+        """Return the earliest expiry time after now, or None if no coupon expires later"""
+        position = bisect_right(self.expiries, now)
+        if position == len(self.expiries):
+            return None
+        return self.expiries[position]
+    
+    def eligible_cart_wise(self, cart_total):
+        """Return the cart-wise rules whose threshold is met by the cart total"""
+        eligible = []
+        for threshold_index in self.cart_wise_index.values():
+            eligible.extend(threshold_index.eligible(cart_total))
+        return eligible
+    
+    def candidates(self, context):
+        """
+        Return the coupons that can possibly apply to the cart.
+        
+        Cart-wise coupons are found by bisecting on the cart total.
+        Product-wise coupons are reached through the items' product_id,
+        category and brand, and a BxGy coupon is only returned when every one of
+        its buy products is in the cart. The rules still need to be checked
+        with the coupon logic, this only prunes the ones that cannot match.
+        
+        Args:
+            context: A CartContext for the cart
+            
+        Returns:
+            list: Candidate rules in snapshot order
+        """
+        candidates = {rule.id: rule for rule in self.eligible_cart_wise(context.total)}
+        
+        for key_lines, index in (
+            (context.product_lines, self.product_index),
+            (context.category_lines, self.category_index),
+            (context.brand_lines, self.brand_index),
+        ):
+            for key in key_lines:
+                for rule in index.get(key, ()):
+                    candidates[rule.id] = rule
+                    
+        for rule in self.bxgy_candidates(context):
+            candidates[rule.id] = rule
+            
+        return sorted(candidates.values(), key=attrgetter('seq'))
+    
+    def bxgy_candidates(self, context):
+        """
+        Return the BxGy coupons whose buy products are all in the cart.
+        
+        Args:
+            context: A CartContext for the cart
+            
+        Returns:
+            list: Candidate BxGy rules, in no particular order
+        """
+        candidates = []
+        
+        # A BxGy coupon is reachable once all of its buy products have been seen
+        buy_hits = defaultdict(int)
+        for product_id in context.product_lines:
+            for rule in self.bxgy_index.get(product_id, ()):
+                buy_hits[rule.id] += 1
+                if buy_hits[rule.id] == len(rule.bxgy_details.buy_products):
+                    candidates.append(rule)
+                    
+        return candidates
+
+
+def active_coupons():
+    """
+    QuerySet of the coupons compiled into the snapshot.
+    
+    Inactive and expired coupons, and coupons without the details of their
+    type, can never apply and are filtered out by the database instead of
+    being loaded and compiled. Coupons that expire later are kept and
+    checked against the evaluation time.
+    """
+    return Coupon.objects.valid().with_type_details().with_details()
+
+
+def build_snapshot(version=None):
+    """Load all valid coupons from the database, or a read replica, and compile them"""
+    # A snapshot is kept until the next write, so it is never loaded from a replica missing the last one
+    with routers.replica_reads(sticky=True):
+        return CouponSnapshot(
+            (compile_coupon(coupon, seq) for seq, coupon in enumerate(active_coupons())),
+            version=version
+        )
+
+
+async def abuild_snapshot(version=None):
+    """Load all valid coupons with the async ORM, from the database or a read replica, and compile them"""
+    rules = []
+    with routers.reads_from(await routers.aread_alias(sticky=True)):
+        async for coupon in active_coupons():
+            rules.append(compile_coupon(coupon, len(rules)))
+    return CouponSnapshot(rules, version=version)
+
+
+CATALOG_VERSION_KEY = 'coupons:catalog-version'
+
+
+def _version_cache():
+    return caches[getattr(settings, 'COUPON_VERSION_CACHE', 'default')]
+
+
+def is_local_cache(cache):
+    """Check if a cache backend can be used from async code without blocking"""
+    return isinstance(cache, (LocMemCache, DummyCache))
+
+
+def catalog_version():
+    """
+    Return the current catalog version.
+    
+    A missing version (first use, or evicted from the cache) starts again
+    from the current time rather than from zero, so it never repeats a
+    version an existing snapshot was built at.
+    """
+    cache = _version_cache()
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+async def acatalog_version():
+    """Return the current catalog version from async code"""
+    cache = _version_cache()
+    if is_local_cache(cache):
+        return catalog_version()
+    
+    version = await cache.aget(CATALOG_VERSION_KEY)
+    if version is None:
+        await cache.aadd(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+        version = await cache.aget(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    """Move the catalog version on, making every snapshot and cached result stale"""
+    cache = _version_cache()
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # The version is missing; a fresh one is newer than any previous one
+        cache.add(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def max_age():
+    """Seconds a snapshot is used before it is reloaded, or None to only reload after writes"""
+    return getattr(settings, 'COUPON_SNAPSHOT_MAX_AGE', 30)
+
+
+def remaining_age(snapshot):
+    """Seconds until a snapshot is too old to be used, or None if it never is"""
+    limit = max_age()
+    if limit is None:
+        return None
+    return limit - (time.monotonic() - snapshot.built_at)
+
+
+def is_usable(snapshot, version):
+    """Check if a snapshot was built at the catalog version, however old it is"""
+    return snapshot is not None and snapshot.version == version
+
+
+def _is_too_old(snapshot):
+    remaining = remaining_age(snapshot)
+    return remaining is not None and remaining <= 0
+
+
+_lock = threading.Lock()
+_async_locks = weakref.WeakKeyDictionary()
+_snapshot = None
+_generation = 0
+# The thread reloading a snapshot that is too old, if any. Guarded by a lock
+# of its own, since _lock is held for whole rebuilds.
+_refresh_lock = threading.Lock()
+_refresher = None
+
+
+def _serve(snapshot):
+    # A snapshot that is only too old is served while it is reloaded
+    if _is_too_old(snapshot):
+        _start_refresh(snapshot)
+    return snapshot
+
+
+def _start_refresh(snapshot):
+    global _refresher
+    
+    with _refresh_lock:
+        if _refresher is not None or _snapshot is not snapshot:
+            return
+        _refresher = threading.Thread(
+            target=_refresh, args=(snapshot, _generation), name='coupon-snapshot-refresh', daemon=True
+        )
+        _refresher.start()
+        
+        
+def _refresh(stale, generation):
+    global _snapshot, _refresher
+    
+    try:
+        snapshot = build_snapshot(stale.version)
+        with _lock:
+            # Unless a write or a rebuild replaced the stale snapshot meanwhile
+            if generation == _generation and _snapshot is stale:
+                _snapshot = snapshot
+    finally:
+        with _refresh_lock:
+            _refresher = None
+        connections.close_all()
+
+
+def get_snapshot():
+    """
+    Return the current coupon snapshot, building it if needed.
+    
+    Returns:
+        CouponSnapshot: The compiled active coupons
+    """
+    global _snapshot
+    
+    snapshot = _snapshot
+    if is_usable(snapshot, catalog_version()):
+        return _serve(snapshot)
+    
+    with _lock:
+        version = catalog_version()
+        if is_usable(_snapshot, version):
+            return _snapshot
+        
+        generation = _generation
+        snapshot = build_snapshot(version)
+        
+        # Only publish the snapshot if no write invalidated it while it was loading
+        if generation == _generation:
+            _snapshot = snapshot
+            
+    return snapshot
+
+
+async def aget_snapshot():
+    """
+    Return the current coupon snapshot from async code, building it if needed.
+    
+    Coroutines of the same event loop wait on one rebuild; reading a loaded
+    snapshot never leaves the event loop.
+    
+    Returns:
+        CouponSnapshot: The compiled active coupons
+    """
+    global _snapshot
+    
+    snapshot = _snapshot
+    if is_usable(snapshot, await acatalog_version()):
+        return _serve(snapshot)
+    
+    loop = asyncio.get_running_loop()
+    lock = _async_locks.get(loop)
+    if lock is None:
+        lock = _async_locks[loop] = asyncio.Lock()
+        
+    async with lock:
+        version = await acatalog_version()
+        if is_usable(_snapshot, version):
+            return _snapshot
+        
+        generation = _generation
+        snapshot = await abuild_snapshot(version)
+        
+        # Only publish the snapshot if no write invalidated it while it was loading
+        if generation == _generation:
+            _snapshot = snapshot
+            
+    return snapshot
+
+
+def invalidate_snapshot():
+    """Drop the current snapshot and bump the catalog version so that the next read rebuilds it"""
+    global _snapshot, _generation
+    
+    _generation += 1
+    _snapshot = None
+    bump_catalog_version()
+    routers.record_write()
@@ -0,0 +1,219 @@
+"""
+Best-combination solver for stacking several coupons on one cart.
+
+Coupons are applied in sequence: product-wise first, then BxGy, then
+cart-wise, so a cart-wise threshold sees the total left after the product
+discounts. A coupon that is not stackable can only be used on its own, and
+at most one coupon of each exclusivity group can be combined. Shipping
+coupons all discount the same shipping, so they form one more, implicit,
+exclusivity group.
+
+The search is a depth-first branch and bound over the stackable coupons,
+taken in application order so that each node only applies its own coupon to
+what the coupons chosen above it left to pay. Applying coupons only ever
+lowers item prices and the cart total, so a coupon never gives more in a
+combination than it gives on its own; the standalone discounts of the
+coupons still to be decided therefore bound what a branch can reach, and
+branches that cannot beat the best combination found so far are pruned.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils import timezone
+
+from .snapshot import get_snapshot
+from .services import calculate_coupon_discount, apply_coupon_to_context
+from .coupon_logics.context import CartContext
+
+
+APPLICATION_ORDER = {'product-wise': 0, 'bxgy': 1, 'cart-wise': 2}
+# Not a string, so it never collides with an exclusivity_group of the coupons
+SHIPPING_GROUP = ('implicit', 'shipping')
+
+
+def application_order(rule):
+    """Sort key giving the order in which stacked coupons are applied"""
+    return (APPLICATION_ORDER.get(rule.type, len(APPLICATION_ORDER)), rule.seq)
+
+
+def apply_in_sequence(rules, cart):
+    """
+    Apply several coupons to a cart one after the other.
+    
+    Product-wise discounts lower the unit price of the discounted items and
+    BxGy discounts split the free units off into zero-priced items, so each
+    coupon is evaluated on what the previous ones left to pay.
+    
+    Args:
+        rules: The compiled CouponRules to apply
+        cart: A dictionary containing cart items
+        
+    Returns:
+        list: (rule, discount) pairs in application order; a coupon that no
+            longer applies after the previous ones has a zero discount
+    """
+    context = CartContext(cart)
+    steps = []
+    
+    for rule in sorted(rules, key=application_order):
+        discount, context = apply_step(rule, context)
+        steps.append((rule, discount))
+            
+    return steps
+
+
+def apply_step(rule, context):
+    """
+    Apply one more coupon to what the previous coupons left to pay.
+    
+    Args:
+        rule: The compiled CouponRule to apply
+        context: A CartContext for the items left to pay
+        
+    Returns:
+        tuple: The coupon's discount (zero if it does not apply) and the
+            CartContext left for the next coupons
+    """
+    discounted_cart = apply_coupon_to_context(rule, context)
+    if discounted_cart is None:
+        return Decimal('0.00'), context
+    
+    discount = discounted_cart['total_discount']
+    # Cart-wise coupons do not change the item prices, so their context is kept
+    if rule.type in ('product-wise', 'bxgy') and discount:
+        context = CartContext({'items': _remaining_items(rule, context, discounted_cart)})
+    return discount, context
+
+
+def _remaining_items(rule, context, discounted_cart):
+    """Rebuild the cart items with what is left to pay after a coupon"""
+    items = []
+    
+    for idx, item in enumerate(context.items):
+        item_discount = discounted_cart['items'][idx]['total_discount']
+        price = context.prices[idx]
+        quantity = item['quantity']
+        
+        if not item_discount:
+            items.append(item)
+        elif rule.type == 'bxgy' and price:
+            # Free units are split off so later coupons cannot discount them again
+            free_units = min(quantity, int((item_discount / price).to_integral_value()))
+            if free_units < quantity:
+                items.append({**item, 'quantity': quantity - free_units})
+            items.append({**item, 'quantity': free_units, 'price': Decimal('0.00')})
+        else:
+            items.append({**item, 'price': max(Decimal('0.00'), price - item_discount / quantity)})
+            
+    return items
+
+
+def exclusivity_groups(rule):
+    """The exclusivity groups of a coupon: its exclusivity_group, and SHIPPING_GROUP for shipping coupons"""
+    groups = set()
+    if rule.exclusivity_group:
+        groups.add(rule.exclusivity_group)
+    if rule.cart_wise_details is not None and rule.cart_wise_details.discount_type == 'shipping':
+        groups.add(SHIPPING_GROUP)
+    return frozenset(groups)
+
+
+def _compatible(rule, chosen_groups):
+    return exclusivity_groups(rule).isdisjoint(chosen_groups)
+
+
+def find_best_combination(cart, snapshot=None, now=None):
+    """
+    Find the combination of coupons giving the largest total discount.
+    
+    Args:
+        cart: A dictionary containing cart items
+        snapshot: The CouponSnapshot to evaluate against (defaults to the current one)
+        now: The time used to skip expired coupons (defaults to now)
+        
+    Returns:
+        dict: The chosen coupons with their discounts in application order,
+            plus the cart total, total discount and final price
+    """
+    snapshot = snapshot or get_snapshot()
+    now = now or timezone.now()
+    context = CartContext(cart)
+    
+    # Standalone discounts are both the single-coupon options and the bounds
+    options = []
+    for rule in snapshot.candidates(context):
+        if rule.is_expired(now):
+            continue
+        discount = calculate_coupon_discount(rule, context)
+        if discount is not None and discount > Decimal('0.00'):
+            options.append((rule, discount))
+            
+    options.sort(key=lambda option: (-option[1], option[0].seq))
+    
+    best_steps = []
+    best_discount = Decimal('0.00')
+    
+    # Any single coupon is a valid choice, stackable or not
+    if options:
+        rule, discount = options[0]
+        best_steps = [(rule, discount)]
+        best_discount = discount
+        
+    # In application order, so a branch only ever applies coupons after the chosen ones
+    stackable = sorted(
+        (option for option in options if option[0].is_stackable),
+        key=lambda option: application_order(option[0])
+    )
+    # remaining_bounds[i] is the sum of the standalone discounts from i on
+    remaining_bounds = [Decimal('0.00')] * (len(stackable) + 1)
+    for i in range(len(stackable) - 1, -1, -1):
+        remaining_bounds[i] = remaining_bounds[i + 1] + stackable[i][1]
+        
+    max_nodes = getattr(settings, 'COUPON_STACKING_MAX_NODES', 10000)
+    visited = 0
+    
+    def search(i, remaining, chosen, chosen_groups, chosen_discount):
+        nonlocal best_steps, best_discount, visited
+        
+        visited += 1
+        if i == len(stackable) or visited > max_nodes:
+            return
+        if chosen_discount + remaining_bounds[i] <= best_discount:
+            return
+        
+        rule, _ = stackable[i]
+        
+        # Branch 1: take the coupon, if its group is still free and it still gives something
+        if _compatible(rule, chosen_groups):
+            step_discount, next_remaining = apply_step(rule, remaining)
+            if step_discount > Decimal('0.00'):
+                steps = chosen + [(rule, step_discount)]
+                discount = chosen_discount + step_discount
+                if discount > best_discount:
+                    best_steps = steps
+                    best_discount = discount
+                
+                search(i + 1, next_remaining, steps, chosen_groups | exclusivity_groups(rule), discount)
+            
+        # Branch 2: leave the coupon out
+        search(i + 1, remaining, chosen, chosen_groups, chosen_discount)
+        
+    search(0, context, [], frozenset(), Decimal('0.00'))
+    
+    total_discount = best_discount.quantize(Decimal('0.01'))
+    return {
+        'coupons': [
+            {
+                'coupon_id': rule.id,
+                'type': rule.type,
+                'name': rule.name,
+                'code': rule.code,
+                'discount': discount
+            }
+            for rule, discount in best_steps
+            if discount > Decimal('0.00')
+        ],
+        'total_price': context.total,
+        'total_discount': total_discount,
+        'final_price': max(Decimal('0.00'), context.total - total_discount)
+    }
@@ -1,3 +1,1775 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from io import StringIO
+from decimal import Decimal
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from .models import (
+    Coupon,
+    CartWiseCoupon,
+    ProductWiseCoupon,
+    BxGyCoupon,
+    BxGyCouponBuyProduct,
+    BxGyCouponGetProduct,
+    Redemption,
+    RedemptionCounter,
+    UserRedemptionCounter
+)
+from .services import get_applicable_coupons, apply_coupon
+from . import (
+    benchmark, codegen, fastpath, idempotency, importer, metrics, redemptions, result_cache, routers, services, sharding,
+    singleflight, snapshot, stacking, vectorized
+)
+from .snapshot import get_snapshot, aget_snapshot, invalidate_snapshot, bump_catalog_version
+from .coupon_logics.context import CartContext
+from .serializers import CartSerializer, DiscountedCartSerializer, ApplicableCouponsResponseSerializer
+from .coupon_logics.cents import round_div, to_cents
+
+
+def create_cart_wise_coupon(code, threshold, discount_value, discount_type='percentage', **kwargs):
+    coupon = Coupon.objects.create(type='cart-wise', code=code, name=code, **kwargs)
+    CartWiseCoupon.objects.create(
+        coupon=coupon,
+        discount_type=discount_type,
+        threshold=Decimal(threshold),
+        discount_value=Decimal(discount_value)
+    )
+    return coupon
+
+
+def create_product_wise_coupon(code, discount_value, discount_type='percentage', coupon_options=None, **targets):
+    coupon = Coupon.objects.create(type='product-wise', code=code, name=code, **(coupon_options or {}))
+    ProductWiseCoupon.objects.create(
+        coupon=coupon,
+        discount_type=discount_type,
+        discount_value=Decimal(discount_value),
+        **targets
+    )
+    return coupon
+
+
+def create_bxgy_coupon(code, buy_products, get_products, repetition_limit=1, **kwargs):
+    coupon = Coupon.objects.create(type='bxgy', code=code, name=code, **kwargs)
+    bxgy_coupon = BxGyCoupon.objects.create(coupon=coupon, repetition_limit=repetition_limit)
+    for product_id, quantity in buy_products.items():
+        BxGyCouponBuyProduct.objects.create(bxgy_coupon=bxgy_coupon, product_id=product_id, quantity=quantity)
+    for product_id, quantity in get_products.items():
+        BxGyCouponGetProduct.objects.create(bxgy_coupon=bxgy_coupon, product_id=product_id, quantity=quantity)
+    return coupon
+
+
+def make_item(product_id, quantity, price, **extra):
+    return {'product_id': product_id, 'quantity': quantity, 'price': Decimal(price), **extra}
+
+
+class CouponSnapshotTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        self.cart_wise = create_cart_wise_coupon('CART10', '100.00', '10.00')
+        self.product_wise = create_product_wise_coupon('PROD20', '20.00', product_id=1)
+        self.bxgy = create_bxgy_coupon('B2G1', {1: 2}, {2: 1}, repetition_limit=2)
+        self.cart = {'items': [make_item(1, 4, '30.00'), make_item(2, 3, '10.00')]}
+
+    def test_evaluation_is_query_free_once_loaded(self):
+        get_snapshot()
+        with self.assertNumQueries(0):
+            applicable = get_applicable_coupons(self.cart)
+            discounted = apply_coupon(self.bxgy.id, self.cart)
+
+        self.assertEqual(
+            [(coupon['code'], coupon['discount']) for coupon in applicable],
+            [('PROD20', Decimal('24.00')), ('B2G1', Decimal('20.00')), ('CART10', Decimal('15.00'))]
+        )
+        self.assertEqual(discounted['total_discount'], Decimal('20.00'))
+
+    def test_snapshot_rebuilds_after_writes(self):
+        self.assertIsNotNone(get_snapshot().get(self.cart_wise.id))
+
+        self.cart_wise.is_active = False
+        self.cart_wise.save()
+        self.assertIsNone(get_snapshot().get(self.cart_wise.id))
+
+        details = self.product_wise.product_wise_details
+        details.discount_value = Decimal('50.00')
+        details.save()
+        self.assertEqual(get_snapshot().get(self.product_wise.id).product_wise_details.discount_value, Decimal('50.00'))
+
+        BxGyCouponBuyProduct.objects.filter(bxgy_coupon__coupon=self.bxgy).delete()
+        self.assertEqual(dict(get_snapshot().get(self.bxgy.id).bxgy_details.buy_products), {})
+        
+    @override_settings(COUPON_SNAPSHOT_MAX_AGE=30)
+    def test_snapshot_is_reloaded_once_too_old(self):
+        loaded = get_snapshot()
+        self.assertIs(get_snapshot(), loaded)
+        
+        # Written through another process, with a version cache local to this one
+        Coupon.objects.filter(pk=self.cart_wise.pk).update(is_active=False)
+        self.assertIsNotNone(get_snapshot().get(self.cart_wise.id))
+        self.assertLessEqual(result_cache.result_timeout(loaded, timezone.now()), 30)
+        
+        loaded.built_at -= 31
+        self.assertEqual(result_cache.result_timeout(loaded, timezone.now()), 0)
+        self.assertIsNone(self.refreshed(get_snapshot).get(self.cart_wise.id))
+        
+        get_snapshot().built_at -= 31
+        self.assertIsNone(self.refreshed(async_to_sync(aget_snapshot)).get(self.cart_wise.id))
+        
+    def refreshed(self, get):
+        # The old snapshot is served while a background thread reloads it
+        stale = snapshot._snapshot
+        # Built here, since the test database is not visible from other threads
+        fresh = snapshot.build_snapshot(stale.version)
+        with mock.patch('coupons.snapshot.build_snapshot', return_value=fresh):
+            self.assertIs(get(), stale)
+            refresher = snapshot._refresher
+            if refresher is not None:
+                refresher.join()
+        self.assertIs(get(), fresh)
+        return fresh
+    
+    @override_settings(COUPON_SNAPSHOT_MAX_AGE=30)
+    def test_only_one_thread_reloads_an_old_snapshot(self):
+        loaded = get_snapshot()
+        loaded.built_at -= 31
+        started = threading.Event()
+        release = threading.Event()
+        
+        def slow_build(version):
+            started.set()
+            release.wait(5)
+            return snapshot.CouponSnapshot([], version=version)
+        
+        with mock.patch('coupons.snapshot.build_snapshot', side_effect=slow_build) as build:
+            self.assertIs(get_snapshot(), loaded)
+            started.wait(5)
+            self.assertIs(get_snapshot(), loaded)
+            self.assertIs(async_to_sync(aget_snapshot)(), loaded)
+            refresher = snapshot._refresher
+            release.set()
+            refresher.join()
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual(len(get_snapshot()), 0)
+
+    def test_expired_coupons_are_skipped(self):
+        self.cart_wise.expires_at = timezone.now() - timedelta(minutes=1)
+        self.cart_wise.save()
+
+        codes = [coupon['code'] for coupon in get_applicable_coupons(self.cart)]
+        self.assertNotIn('CART10', codes)
+        self.assertIsNone(apply_coupon(self.cart_wise.id, self.cart))
+        
+    def test_invalid_coupons_are_filtered_by_the_query(self):
+        now = timezone.now()
+        create_cart_wise_coupon('EXPIRED', '0.00', '5.00', expires_at=now - timedelta(minutes=1))
+        create_cart_wise_coupon('LATER', '0.00', '5.00', expires_at=now + timedelta(days=1))
+        create_cart_wise_coupon('OFF', '0.00', '5.00', is_active=False)
+        Coupon.objects.create(type='cart-wise', code='NODETAILS', name='No details')
+        Coupon.objects.create(type='bxgy', code='WRONGTYPE', name='Wrong type')
+        CartWiseCoupon.objects.create(
+            coupon=Coupon.objects.get(code='WRONGTYPE'),
+            threshold=Decimal('0.00'),
+            discount_value=Decimal('5.00')
+        )
+        
+        self.assertEqual(
+            sorted(Coupon.objects.valid(now).values_list('code', flat=True)),
+            ['B2G1', 'CART10', 'LATER', 'NODETAILS', 'PROD20', 'WRONGTYPE']
+        )
+        invalidate_snapshot()
+        self.assertEqual(
+            sorted(rule.code for rule in get_snapshot().rules),
+            ['B2G1', 'CART10', 'LATER', 'PROD20']
+        )
+        # A coupon expiring after the snapshot was built is still checked at evaluation
+        later = Coupon.objects.get(code='LATER')
+        self.assertIsNone(apply_coupon(later.id, self.cart, now=now + timedelta(days=2)))
+        self.assertIsNotNone(apply_coupon(later.id, self.cart, now=now))
+
+
+class CandidateIndexTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+
+    def test_only_reachable_coupons_are_candidates(self):
+        by_product = create_product_wise_coupon('P1', '10.00', product_id=1)
+        by_category = create_product_wise_coupon('ELEC', '10.00', category='electronics')
+        by_brand = create_product_wise_coupon('NIKE', '10.00', brand='nike')
+        create_product_wise_coupon('P99', '10.00', product_id=99)
+        full_set = create_bxgy_coupon('B12', {1: 1, 2: 1}, {3: 1})
+        create_bxgy_coupon('B19', {1: 1, 9: 1}, {3: 1})
+        cart = {'items': [
+            make_item(1, 1, '10.00', category='electronics'),
+            make_item(2, 1, '10.00', brand='nike'),
+            make_item(3, 1, '10.00', category='', brand=None),
+        ]}
+
+        candidates = get_snapshot().candidates(CartContext(cart))
+
+        self.assertEqual(
+            [rule.id for rule in candidates],
+            [by_product.id, by_category.id, by_brand.id, full_set.id]
+        )
+        self.assertEqual(
+            [coupon['code'] for coupon in get_applicable_coupons(cart)],
+            ['B12', 'P1', 'ELEC', 'NIKE']
+        )
+
+
+class ThresholdIndexTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+
+    def test_bisect_returns_eligible_tiers(self):
+        for threshold, value in [('50.00', '5.00'), ('100.00', '15.00'), ('200.00', '10.00'), ('500.00', '25.00')]:
+            create_cart_wise_coupon(f'PCT{threshold}', threshold, value)
+        create_cart_wise_coupon('FIX30', '150.00', '30.00', discount_type='fixed')
+        snapshot = get_snapshot()
+
+        self.assertEqual(
+            sorted(rule.code for rule in snapshot.eligible_cart_wise(Decimal('200.00'))),
+            ['FIX30', 'PCT100.00', 'PCT200.00', 'PCT50.00']
+        )
+        self.assertEqual(snapshot.eligible_cart_wise(Decimal('49.99')), [])
+
+
+class CartContextTests(TestCase):
+    def test_context_groups_lines(self):
+        context = CartContext({'items': [
+            make_item(1, 2, '10.50', category='books', brand='acme'),
+            make_item(2, 1, '3.25', category='books'),
+            make_item(1, 1, '10.50', brand=''),
+        ]})
+        
+        self.assertEqual(context.total, Decimal('34.75'))
+        self.assertEqual(context.line_totals, [Decimal('21.00'), Decimal('3.25'), Decimal('10.50')])
+        self.assertEqual(context.product_quantities, {1: 3, 2: 1})
+        self.assertEqual(context.product_lines, {1: [0, 2], 2: [1]})
+        self.assertEqual(context.category_lines, {'books': [0, 1]})
+        self.assertEqual(context.brand_lines, {'acme': [0]})
+
+
+class RandomCatalogMixin:
+    """Builds a seeded random catalog of all three coupon types"""
+    
+    def setUp(self):
+        invalidate_snapshot()
+        rng = random.Random(20240501)
+        self.rng = rng
+        self.coupon_ids = []
+        
+        def money(low, high):
+            return f'{rng.randint(low * 100, high * 100) / 100:.2f}'
+        
+        for n in range(15):
+            discount_type = rng.choice(['percentage', 'fixed', 'shipping'])
+            value = money(1, 60) if discount_type == 'percentage' else money(1, 80)
+            self.coupon_ids.append(create_cart_wise_coupon(f'CW{n}', money(0, 400), value, discount_type).id)
+        for n in range(25):
+            target = rng.choice([
+                {'product_id': rng.randint(1, 12)},
+                {'category': rng.choice(['books', 'toys', 'food'])},
+                {'brand': rng.choice(['acme', 'globex'])},
+            ])
+            discount_type = rng.choice(['percentage', 'fixed'])
+            value = money(1, 99) if discount_type == 'percentage' else money(1, 30)
+            self.coupon_ids.append(create_product_wise_coupon(f'PW{n}', value, discount_type, **target).id)
+        for n in range(10):
+            buy = {product_id: rng.randint(1, 3) for product_id in rng.sample(range(1, 13), rng.randint(1, 2))}
+            get = {product_id: rng.randint(1, 2) for product_id in rng.sample(range(1, 13), rng.randint(1, 3))}
+            self.coupon_ids.append(create_bxgy_coupon(f'BX{n}', buy, get, repetition_limit=rng.randint(1, 4)).id)
+    
+    def random_cart(self):
+        rng = self.rng
+        return {'items': [
+            make_item(
+                rng.randint(1, 12),
+                rng.randint(1, 6),
+                f'{rng.randint(1, 20000) / 100:.2f}',
+                category=rng.choice(['books', 'toys', 'food', None]),
+                brand=rng.choice(['acme', 'globex', None]),
+            )
+            for _ in range(self.rng.randint(1, 15))
+        ]}
+    
+
+
+class CentsEngineParityTests(RandomCatalogMixin, TestCase):
+    """The cents engine must give exactly the same results as the Decimal one"""
+    
+    def test_randomized_carts_match_decimal_engine(self):
+        for _ in range(200):
+            cart = self.random_cart()
+            coupon_id = self.rng.choice(self.coupon_ids)
+            
+            with override_settings(COUPON_ENGINE='decimal'):
+                expected = (get_applicable_coupons(cart), apply_coupon(coupon_id, cart))
+            with override_settings(COUPON_ENGINE='cents'):
+                actual = (get_applicable_coupons(cart), apply_coupon(coupon_id, cart))
+            
+            self.assertEqual(actual, expected)
+    
+    def test_rounding_helpers(self):
+        self.assertEqual(to_cents(Decimal('12.345')), 1234)
+        self.assertEqual(to_cents(Decimal('12.355')), 1236)
+        self.assertEqual([round_div(n, 10) for n in (14, 15, 25, 26, -15)], [1, 2, 2, 3, -2])
+
+
+@skipUnless(vectorized.is_available(), 'NumPy is not installed')
+@skipUnless(sharding.is_available(), 'fork is not available')
+class ShardedEvaluationTests(RandomCatalogMixin, TestCase):
+    def tearDown(self):
+        sharding.shutdown()
+        
+    def test_sharded_results_match_regular_path(self):
+        carts = [self.random_cart() for _ in range(50)]
+        expected = [get_applicable_coupons(cart) for cart in carts]
+        
+        with override_settings(COUPON_SHARD_COUNT=3, COUPON_SHARD_THRESHOLD=1):
+            self.assertTrue(sharding.should_shard(get_snapshot()))
+            pool = sharding.get_pool(get_snapshot(), timeout=30)
+            actual = [get_applicable_coupons(cart) for cart in carts]
+            self.assertEqual(pool.evaluate(carts[0], timezone.now()), expected[0])
+            
+            with override_settings(COUPON_SHARD_TOP_N=2):
+                top_two = [get_applicable_coupons(cart) for cart in carts]
+                
+        self.assertEqual(actual, expected)
+        self.assertEqual(top_two, [coupons[:2] for coupons in expected])
+        self.assertEqual(sum(len(shard) for shard in sharding._pool_shards[pool.number]), len(get_snapshot()))
+        
+    def test_async_evaluation_awaits_the_workers(self):
+        carts = [self.random_cart() for _ in range(5)]
+        expected = [get_applicable_coupons(cart) for cart in carts]
+        
+        with override_settings(COUPON_SHARD_COUNT=2, COUPON_SHARD_THRESHOLD=1):
+            sharding.get_pool(get_snapshot(), timeout=30)
+            # The blocking evaluation is never called from the event loop
+            with mock.patch.object(sharding.ShardPool, 'evaluate', side_effect=AssertionError):
+                actual = [async_to_sync(services.aget_applicable_coupons)(cart) for cart in carts]
+                
+        self.assertEqual(actual, expected)
+        
+    def wait_until_closed(self, pool):
+        deadline = time.monotonic() + 30
+        while pool.number in sharding._pool_shards and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertNotIn(pool.number, sharding._pool_shards)
+        
+    def test_pools_are_forked_outside_the_request(self):
+        cart = self.random_cart()
+        with override_settings(COUPON_SHARD_COUNT=2, COUPON_SHARD_THRESHOLD=1):
+            # Evaluated in this process while the pool is forked in the background
+            self.assertIsNone(sharding.get_applicable_coupons(get_snapshot(), cart, timezone.now()))
+            sharding.get_pool(get_snapshot(), timeout=30)
+            self.assertEqual(
+                sharding.get_applicable_coupons(get_snapshot(), cart, timezone.now()), get_applicable_coupons(cart)
+            )
+            
+    def test_only_a_newer_snapshot_replaces_the_pool(self):
+        with override_settings(COUPON_SHARD_COUNT=2, COUPON_SHARD_THRESHOLD=1):
+            old_snapshot = get_snapshot()
+            first_pool = sharding.get_pool(old_snapshot, timeout=30)
+            create_cart_wise_coupon('NEW', '0.00', '1.00')
+            second_pool = sharding.get_pool(get_snapshot(), timeout=30)
+            
+            # Requests still holding the old snapshot do not bring its pool back
+            self.assertIs(sharding.get_pool(old_snapshot), second_pool)
+            # Nor does a reload of the same catalog version after COUPON_SNAPSHOT_MAX_AGE
+            reloaded = snapshot.build_snapshot(get_snapshot().version)
+            self.assertIs(sharding.get_pool(reloaded), second_pool)
+            
+        self.assertIsNot(first_pool, second_pool)
+        self.wait_until_closed(first_pool)
+        
+    def test_replaced_pool_finishes_its_evaluations(self):
+        cart = self.random_cart()
+        expected = get_applicable_coupons(cart)
+        with override_settings(COUPON_SHARD_COUNT=2, COUPON_SHARD_THRESHOLD=1):
+            old_snapshot = get_snapshot()
+            sharding.get_pool(old_snapshot, timeout=30)
+            first_pool = sharding.acquire_pool(old_snapshot)
+            create_cart_wise_coupon('NEW', '0.00', '1.00')
+            sharding.get_pool(get_snapshot(), timeout=30)
+            
+            # Still running for the request that took it
+            self.assertTrue(first_pool.retired)
+            self.assertEqual(first_pool.evaluate(cart, timezone.now(), timeout=30), expected)
+            sharding.release_pool(first_pool)
+            
+        self.wait_until_closed(first_pool)
+
+
+class VectorizedEvaluationTests(RandomCatalogMixin, TestCase):
+    def test_randomized_carts_match_regular_path(self):
+        expired = create_product_wise_coupon('EXPIRED', '50.00', product_id=1)
+        Coupon.objects.filter(id=expired.id).update(expires_at=timezone.now() - timedelta(days=1))
+        invalidate_snapshot()
+        
+        for _ in range(200):
+            cart = self.random_cart()
+            
+            with override_settings(COUPON_VECTORIZE_THRESHOLD=None):
+                expected = get_applicable_coupons(cart)
+            with override_settings(COUPON_VECTORIZE_THRESHOLD=1):
+                actual = get_applicable_coupons(cart)
+            
+            self.assertEqual(actual, expected)
+            self.assertNotIn('EXPIRED', [coupon['code'] for coupon in actual])
+
+
+class BatchApplicableCouponsViewTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        create_cart_wise_coupon('CART10', '100.00', '10.00')
+        create_product_wise_coupon('PROD20', '20.00', product_id=1)
+        self.carts = [
+            {'items': [{'product_id': 1, 'quantity': 5, 'price': '30.00'}]},
+            {'items': [{'product_id': 2, 'quantity': 1, 'price': '10.00'}]},
+        ]
+        
+    def test_batch_matches_single_cart_results(self):
+        response = self.client.post('/api/applicable-coupons/batch/', {'carts': self.carts}, content_type='application/json')
+        
+        self.assertEqual(response.status_code, 200)
+        expected = [
+            self.client.post('/api/applicable-coupons/', cart, content_type='application/json').json()
+            for cart in self.carts
+        ]
+        self.assertEqual(response.json(), {'results': expected})
+        self.assertEqual(
+            [coupon['code'] for coupon in expected[0]['applicable_coupons']],
+            ['PROD20', 'CART10']
+        )
+        
+    def test_streamed_batch_emits_one_line_per_cart(self):
+        response = self.client.post(
+            '/api/applicable-coupons/batch/?stream=true', {'carts': self.carts}, content_type='application/json'
+        )
+        
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([line['index'] for line in lines], [0, 1])
+        self.assertEqual(lines[1]['applicable_coupons'], [])
+        self.assertEqual(lines[0]['applicable_coupons'][0]['discount'], '30.00')
+        
+    def test_invalid_cart_rejects_the_batch(self):
+        response = self.client.post(
+            '/api/applicable-coupons/batch/',
+            {'carts': [self.carts[0], {'items': [{'product_id': 1, 'quantity': 0, 'price': '1.00'}]}]},
+            content_type='application/json'
+        )
+        
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('carts', response.json())
+
+
+class BestCouponsTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        self.cart = {'items': [make_item(1, 4, '30.00'), make_item(2, 3, '10.00')]}
+    
+    def best_codes(self):
+        response = self.client.post('/api/best-coupons/', self.cart, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [(coupon['code'], coupon['discount']) for coupon in data['coupons']], data['total_discount']
+    
+    def test_stackable_coupons_are_applied_in_sequence(self):
+        create_product_wise_coupon('P20', '20.00', product_id=1, coupon_options={'is_stackable': True})
+        create_bxgy_coupon('B2G1', {1: 2}, {2: 1}, repetition_limit=2, is_stackable=True)
+        create_cart_wise_coupon('C10', '100.00', '10.00', is_stackable=True)
+        create_cart_wise_coupon('BIG', '0.00', '50.00', discount_type='fixed')
+        
+        # The cart-wise coupon sees 150 - 24 - 20 = 106
+        self.assertEqual(
+            self.best_codes(),
+            ([('P20', '24.00'), ('B2G1', '20.00'), ('C10', '10.60')], '54.60')
+        )
+    
+    def test_exclusivity_groups_and_post_discount_thresholds(self):
+        group = {'is_stackable': True, 'exclusivity_group': 'product-promo'}
+        create_product_wise_coupon('P20', '20.00', product_id=1, coupon_options=group)
+        create_product_wise_coupon('P25', '25.00', product_id=1, coupon_options=group)
+        create_bxgy_coupon('B2G1', {1: 2}, {2: 1}, repetition_limit=2, is_stackable=True)
+        create_cart_wise_coupon('C10', '100.00', '10.00', is_stackable=True)
+        create_cart_wise_coupon('C120', '120.00', '5.00', discount_type='fixed', is_stackable=True)
+        
+        # After P25 and B2G1 only 100 is left, below the C120 threshold
+        self.assertEqual(
+            self.best_codes(),
+            ([('P25', '30.00'), ('B2G1', '20.00'), ('C10', '10.00')], '60.00')
+        )
+    
+    def test_shipping_is_discounted_once(self):
+        create_cart_wise_coupon('SHIP1', '0.00', '0.00', discount_type='shipping', is_stackable=True)
+        create_cart_wise_coupon('SHIP2', '0.00', '0.00', discount_type='shipping', is_stackable=True)
+        create_cart_wise_coupon('C10', '100.00', '10.00', is_stackable=True)
+        
+        self.assertEqual(self.best_codes(), ([('SHIP1', '5.00'), ('C10', '15.00')], '20.00'))
+    
+    def test_non_stackable_coupon_wins_alone(self):
+        create_product_wise_coupon('P20', '20.00', product_id=1, coupon_options={'is_stackable': True})
+        create_cart_wise_coupon('C10', '100.00', '10.00', is_stackable=True)
+        create_cart_wise_coupon('BIG', '0.00', '50.00', discount_type='fixed')
+        
+        self.assertEqual(self.best_codes(), ([('BIG', '50.00')], '50.00'))
+        
+    def test_each_search_node_applies_only_its_coupon(self):
+        create_product_wise_coupon('P20', '20.00', product_id=1, coupon_options={'is_stackable': True})
+        create_bxgy_coupon('B2G1', {1: 2}, {2: 1}, repetition_limit=2, is_stackable=True)
+        create_cart_wise_coupon('C10', '100.00', '10.00', is_stackable=True)
+        
+        with mock.patch('coupons.stacking.apply_coupon_to_context', wraps=stacking.apply_coupon_to_context) as apply:
+            result = stacking.find_best_combination(self.cart)
+            
+        self.assertEqual(result['total_discount'], Decimal('54.60'))
+        # Each coupon is applied once, to what the coupons chosen above it left
+        self.assertEqual([call.args[0].code for call in apply.call_args_list], ['P20', 'B2G1', 'C10'])
+
+
+class BenchmarkCommandTests(TestCase):
+    def test_percentile_uses_nearest_rank(self):
+        values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+        self.assertEqual(benchmark.percentile(values, 0.50), 5)
+        self.assertEqual(benchmark.percentile(values, 0.95), 10)
+        self.assertEqual(benchmark.percentile([], 0.99), 0.0)
+    
+    def test_load_tests_count_responses_by_status(self):
+        class Response:
+            def __init__(self, status_code):
+                self.status_code = status_code
+                
+        async def request(n):
+            return Response(404 if n % 4 == 0 else 200)
+        
+        result = benchmark.load_test('load.test', request, 8, 2)
+        self.assertEqual(result['status_codes'], {'200': 6, '404': 2})
+        self.assertEqual(result['iterations'], 8)
+        
+    def test_benchmark_writes_results_and_rolls_back(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            call_command(
+                'benchmark_coupons', '--catalog-sizes', '30', '--cart-lines', '1', '5',
+                '--iterations', '2', '--concurrency', '2', '--load-requests', '4',
+                '--output', output, stdout=StringIO()
+            )
+            with open(output) as results_file:
+                report = json.load(results_file)
+                
+            call_command(
+                'benchmark_coupons', '--catalog-sizes', '30', '--cart-lines', '1', '5',
+                '--iterations', '2', '--concurrency', '2', '--load-requests', '4',
+                '--baseline', output, stdout=StringIO()
+            )
+            
+        names = {result['name'] for result in report['results']}
+        self.assertIn('services.get_applicable_coupons', names)
+        self.assertIn('view.apply_coupon', names)
+        self.assertIn('load.async.applicable_coupons', names)
+        self.assertEqual(Coupon.objects.count(), 0)
+        for result in report['results']:
+            if result['name'].startswith('load.'):
+                self.assertEqual(sum(result['status_codes'].values()), 4)
+        
+        comparison = benchmark.compare(report['results'], report['results'])
+        self.assertEqual(len(comparison), len(report['results']))
+        self.assertFalse(any(entry['regression'] for entry in comparison))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        metrics.registry.reset()
+        create_cart_wise_coupon('CART10', '100.00', '10.00')
+        create_product_wise_coupon('PROD20', '20.00', product_id=1)
+        create_product_wise_coupon('PROD30', '30.00', product_id=2)
+        self.cart = {'items': [make_item(1, 4, '30.00'), make_item(3, 1, '5.00')]}
+        
+    def scrape(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        return response.content.decode().splitlines()
+    
+    def test_view_latency_and_queries_are_recorded(self):
+        self.client.post('/api/applicable-coupons/', self.cart, content_type='application/json')
+        self.client.get('/api/coupons/')
+        
+        lines = self.scrape()
+        self.assertIn('coupon_request_duration_seconds_count{view="ApplicableCouponsView",method="POST"} 1', lines)
+        self.assertIn('coupon_request_duration_seconds_count{view="CouponViewSet",method="GET"} 1', lines)
+        self.assertIn('coupon_request_db_queries_bucket{view="CouponViewSet",method="GET",le="+Inf"} 1', lines)
+        self.assertIn('coupon_cart_lines_count 1', lines)
+        # The metrics view does not record itself
+        self.assertFalse(any('MetricsView' in line for line in lines))
+        
+    def test_evaluations_and_hits_per_coupon_type(self):
+        get_applicable_coupons(self.cart)
+        
+        lines = self.scrape()
+        self.assertIn('coupon_evaluations_total{coupon_type="cart-wise"} 1', lines)
+        self.assertIn('coupon_evaluation_hits_total{coupon_type="cart-wise"} 1', lines)
+        # Only PROD20 matches the cart's products
+        self.assertIn('coupon_evaluations_total{coupon_type="product-wise"} 1', lines)
+        self.assertIn('coupon_evaluation_duration_seconds_count{coupon_type="product-wise"} 1', lines)
+        
+    def test_worker_files_are_merged(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(COUPON_METRICS_DIR=directory):
+                metrics.CART_LINES.observe(3)
+                # Another worker process wrote the same series
+                with open(os.path.join(directory, 'metrics-other.json'), 'w') as metrics_file:
+                    json.dump(metrics.registry.dump(), metrics_file)
+                    
+                lines = self.scrape()
+                
+        self.assertIn('coupon_cart_lines_bucket{le="5"} 2', lines)
+        self.assertIn('coupon_cart_lines_count 2', lines)
+        self.assertIn('coupon_cart_lines_sum 6', lines)
+
+        
+    def test_worker_files_are_written_off_the_request_path(self):
+        flushed_by = []
+        flush = metrics.registry.flush
+        
+        def record_flush():
+            flushed_by.append(threading.current_thread().name)
+            flush()
+            
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(COUPON_METRICS_DIR=directory, COUPON_METRICS_FLUSH_INTERVAL=0.05):
+                with mock.patch.object(metrics.registry, 'flush', side_effect=record_flush):
+                    self.client.post('/api/applicable-coupons/', self.cart, content_type='application/json')
+                    deadline = time.monotonic() + 5
+                    files = []
+                    while not files and time.monotonic() < deadline:
+                        time.sleep(0.01)
+                        files = [filename for filename in os.listdir(directory) if filename.endswith('.json')]
+                    
+        self.assertEqual(files, [f'metrics-{metrics.registry.process_id}.json'])
+        self.assertEqual(set(flushed_by), {'coupon-metrics-flush'})
+        metrics.registry.flusher.join(5)
+        
+    def test_files_of_exited_workers_are_removed(self):
+        exited = subprocess.Popen([sys.executable, '-c', ''])
+        exited.wait()
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(COUPON_METRICS_DIR=directory):
+                metrics.CART_LINES.observe(3)
+                for filename in (f'metrics-{exited.pid}-dead.json', f'metrics-{os.getppid()}-alive.json'):
+                    with open(os.path.join(directory, filename), 'w') as metrics_file:
+                        json.dump(metrics.registry.dump(), metrics_file)
+                        
+                lines = self.scrape()
+                remaining = os.listdir(directory)
+                
+        self.assertEqual(remaining, [f'metrics-{os.getppid()}-alive.json'])
+        self.assertIn('coupon_cart_lines_count 2', lines)
+        
+    def test_queries_of_async_orm_threads_are_counted(self):
+        recorded = []
+        
+        async def get_response(request):
+            def query():
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.execute('SELECT 1')
+                finally:
+                    connection.close()
+                    
+            # Runs on a thread of its own, with a connection of its own
+            await sync_to_async(query, thread_sensitive=False)()
+            return None
+        
+        middleware = metrics.MetricsMiddleware(get_response)
+        with mock.patch.object(middleware, 'record', side_effect=lambda request, duration, stats: recorded.append(stats)):
+            async_to_sync(middleware)(mock.Mock())
+        self.assertGreaterEqual(recorded[0].count, 1)
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        create_cart_wise_coupon('CART10', '100.00', '10.00')
+        create_product_wise_coupon('PROD20', '20.00', product_id=1)
+        self.bxgy = create_bxgy_coupon('B2G1', {1: 2}, {2: 1}, repetition_limit=2)
+        self.cart = {'items': [
+            {'product_id': 1, 'quantity': 4, 'price': '30.00'},
+            {'product_id': 2, 'quantity': 3, 'price': '10.00'},
+        ]}
+        
+    def assertSameResponse(self, sync_path, async_path, body, content_type='application/json'):
+        sync_response = self.client.post(sync_path, body, content_type=content_type)
+        async_response = self.client.post(async_path, body, content_type=content_type)
+        self.assertEqual(async_response.status_code, sync_response.status_code)
+        self.assertEqual(async_response.content, sync_response.content)
+        return async_response
+    
+    def test_async_views_match_sync_views(self):
+        response = self.assertSameResponse('/api/applicable-coupons/', '/api/async/applicable-coupons/', self.cart)
+        self.assertEqual(len(response.json()['applicable_coupons']), 3)
+        
+        response = self.assertSameResponse(
+            f'/api/apply-coupon/{self.bxgy.id}/', f'/api/async/apply-coupon/{self.bxgy.id}/', self.cart
+        )
+        self.assertEqual(response.json()['total_discount'], '20.00')
+        
+    def test_async_views_match_sync_errors(self):
+        for body in ({'items': []}, {'items': [{'product_id': 1}]}, '{"items": ', ''):
+            self.assertSameResponse('/api/applicable-coupons/', '/api/async/applicable-coupons/', body)
+            
+        self.assertSameResponse(
+            '/api/applicable-coupons/', '/api/async/applicable-coupons/', 'items', content_type='text/plain'
+        )
+        missing = '00000000-0000-0000-0000-000000000000'
+        response = self.assertSameResponse(
+            f'/api/apply-coupon/{missing}/', f'/api/async/apply-coupon/{missing}/', self.cart
+        )
+        self.assertEqual(response.status_code, 404)
+        
+    def test_concurrent_coroutines_share_one_rebuild(self):
+        async def load_concurrently():
+            return await asyncio.gather(*(aget_snapshot() for _ in range(5)))
+        
+        with mock.patch.object(snapshot, 'abuild_snapshot', wraps=snapshot.abuild_snapshot) as build:
+            snapshots = async_to_sync(load_concurrently)()
+            
+        self.assertEqual(build.call_count, 1)
+        self.assertTrue(all(loaded is snapshots[0] for loaded in snapshots))
+        self.assertEqual(len(snapshots[0]), 3)
+        self.assertIs(get_snapshot(), snapshots[0])
+
+
+class ResultCacheTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        metrics.registry.reset()
+        self.coupon = create_product_wise_coupon('PROD20', '20.00', product_id=1)
+        self.cart = {'items': [
+            {'product_id': 1, 'quantity': 4, 'price': '30.00'},
+            {'product_id': 2, 'quantity': 3, 'price': '10.00'},
+        ]}
+        
+    def post(self, path):
+        response = self.client.post(path, self.cart, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+    
+    def test_fingerprint_is_canonical(self):
+        reordered = {'items': [make_item(2, 3, '10'), make_item(1, 4, '30.0')]}
+        
+        self.assertEqual(result_cache.cart_fingerprint(self.cart), result_cache.cart_fingerprint(reordered))
+        self.assertNotEqual(
+            result_cache.cart_fingerprint(self.cart, ordered=True),
+            result_cache.cart_fingerprint(reordered, ordered=True)
+        )
+        self.assertNotEqual(
+            result_cache.cart_fingerprint(self.cart),
+            result_cache.cart_fingerprint({'items': [make_item(1, 4, '30.01'), make_item(2, 3, '10')]})
+        )
+        
+    def test_results_are_cached_until_a_coupon_write(self):
+        first = self.post('/api/applicable-coupons/')
+        with mock.patch.object(result_cache.services, 'get_applicable_coupons') as evaluate:
+            self.assertEqual(self.post('/api/applicable-coupons/'), first)
+            self.assertEqual(self.post('/api/async/applicable-coupons/'), first)
+        evaluate.assert_not_called()
+        
+        self.post(f'/api/apply-coupon/{self.coupon.id}/')
+        self.post(f'/api/apply-coupon/{self.coupon.id}/')
+        
+        create_cart_wise_coupon('CART10', '100.00', '10.00')
+        self.assertEqual(len(self.post('/api/applicable-coupons/')['applicable_coupons']), 2)
+        
+        lines = self.client.get('/metrics').content.decode().splitlines()
+        self.assertIn('coupon_result_cache_requests_total{endpoint="applicable-coupons",result="hit"} 2', lines)
+        self.assertIn('coupon_result_cache_requests_total{endpoint="applicable-coupons",result="miss"} 2', lines)
+        self.assertIn('coupon_result_cache_requests_total{endpoint="apply-coupon",result="hit"} 1', lines)
+        
+    def test_reordered_carts_are_not_served_each_other_s_results(self):
+        # Free items of the same price are picked in cart order
+        create_bxgy_coupon('B1G', {1: 1}, {2: 1, 3: 2})
+        first = {'items': [make_item(1, 1, '50.00'), make_item(2, 1, '10.00'), make_item(3, 2, '10.00')]}
+        second = {'items': [first['items'][0], first['items'][2], first['items'][1]]}
+        
+        for cart in (first, second):
+            expected = get_applicable_coupons(cart, snapshot=get_snapshot())
+            self.assertEqual(result_cache.get_applicable_coupons(cart), expected)
+            self.assertEqual(result_cache.get_applicable_coupons(cart), expected)
+            
+        discounts = [
+            {coupon['code']: coupon['discount'] for coupon in result_cache.get_applicable_coupons(cart)}['B1G']
+            for cart in (first, second)
+        ]
+        self.assertEqual(discounts, [Decimal('10.00'), Decimal('20.00')])
+        
+    def test_version_bump_from_another_process_rebuilds_the_snapshot(self):
+        loaded = get_snapshot()
+        self.assertIs(get_snapshot(), loaded)
+        
+        # Another worker wrote a coupon: only the shared version moves on
+        bump_catalog_version()
+        self.assertIsNot(get_snapshot(), loaded)
+        
+    def test_timeout_never_outlives_the_next_expiry(self):
+        now = timezone.now()
+        create_cart_wise_coupon('SOON', '0.00', '5.00', expires_at=now + timedelta(seconds=30))
+        
+        with override_settings(COUPON_RESULT_CACHE_TIMEOUT=300, COUPON_SNAPSHOT_MAX_AGE=None):
+            self.assertEqual(result_cache.result_timeout(get_snapshot(), now), 30)
+            self.assertEqual(result_cache.result_timeout(get_snapshot(), now + timedelta(seconds=31)), 300)
+
+
+class SingleFlightTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        metrics.registry.reset()
+        create_product_wise_coupon('PROD20', '20.00', product_id=1)
+        self.cart = {'items': [make_item(1, 4, '30.00'), make_item(2, 3, '10.00')]}
+        
+    def wait_for_followers(self, followers):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            with singleflight.group.lock:
+                if any(call.followers == followers for call in singleflight.group.calls.values()):
+                    return
+            time.sleep(0.001)
+        self.fail(f'{followers} followers never waited')
+        
+    def metric_lines(self):
+        return self.client.get('/metrics').content.decode().splitlines()
+    
+    @override_settings(COUPON_RESULT_CACHE=None)
+    def test_concurrent_identical_carts_share_one_evaluation(self):
+        expected = get_applicable_coupons(self.cart, snapshot=get_snapshot())
+        release = threading.Event()
+        evaluate = services.get_applicable_coupons
+        
+        def slow_evaluate(*args, **kwargs):
+            release.wait(5)
+            return evaluate(*args, **kwargs)
+        
+        with mock.patch.object(services, 'get_applicable_coupons', side_effect=slow_evaluate) as evaluation:
+            with ThreadPoolExecutor(max_workers=5) as executor:
+                futures = [executor.submit(result_cache.get_applicable_coupons, self.cart) for _ in range(5)]
+                self.wait_for_followers(4)
+                release.set()
+                results = [future.result() for future in futures]
+                
+        self.assertEqual(evaluation.call_count, 1)
+        self.assertTrue(all(result == expected for result in results))
+        self.assertFalse(singleflight.group.calls)
+        
+        lines = self.metric_lines()
+        self.assertIn('coupon_single_flight_requests_total{endpoint="applicable-coupons",role="leader"} 1', lines)
+        self.assertIn('coupon_single_flight_requests_total{endpoint="applicable-coupons",role="follower"} 4', lines)
+        self.assertIn('coupon_single_flight_wait_seconds_count{endpoint="applicable-coupons"} 4', lines)
+        
+    def test_followers_share_the_exception_of_the_leader(self):
+        group = singleflight.Group()
+        release = threading.Event()
+        
+        def fail():
+            release.wait(5)
+            raise ValueError('evaluation failed')
+        
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(group.do, 'cart', fail, 'apply-coupon') for _ in range(3)]
+            deadline = time.monotonic() + 5
+            while not (group.calls and group.calls['cart'].followers == 2) and time.monotonic() < deadline:
+                time.sleep(0.001)
+            release.set()
+            for future in futures:
+                with self.assertRaisesMessage(ValueError, 'evaluation failed'):
+                    future.result()
+                    
+        # The key is free again once the call finished
+        self.assertEqual(group.do('cart', lambda: 'result', 'apply-coupon'), 'result')
+        
+    def test_concurrent_coroutines_share_one_evaluation(self):
+        group = singleflight.Group()
+        evaluations = []
+        
+        async def evaluate():
+            evaluations.append(1)
+            await asyncio.sleep(0.01)
+            return {'total_discount': Decimal('20.00')}
+        
+        async def apply_concurrently():
+            return await asyncio.gather(*(group.ado('cart', evaluate, 'apply-coupon') for _ in range(5)))
+        
+        results = async_to_sync(apply_concurrently)()
+        
+        self.assertEqual(len(evaluations), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        lines = self.metric_lines()
+        self.assertIn('coupon_single_flight_requests_total{endpoint="apply-coupon",role="follower"} 4', lines)
+        
+    def test_followers_of_a_cancelled_leader_evaluate_again(self):
+        group = singleflight.Group()
+        evaluations = []
+        
+        async def evaluate():
+            evaluations.append(1)
+            await asyncio.sleep(0.01)
+            return len(evaluations)
+        
+        async def cancel_leader():
+            leader = asyncio.ensure_future(group.ado('cart', evaluate, 'apply-coupon'))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(group.ado('cart', evaluate, 'apply-coupon'))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await follower
+        
+        self.assertEqual(async_to_sync(cancel_leader)(), 2)
+        self.assertEqual(len(evaluations), 2)
+        
+    def test_coroutines_coalesce_while_the_leader_stores_its_result(self):
+        cache = result_cache.get_cache()
+        
+        async def slow_aset(key, value, timeout):
+            await asyncio.sleep(0.01)
+            cache.set(key, value, timeout)
+            
+        async def apply_concurrently():
+            return await asyncio.gather(*(result_cache.aget_applicable_coupons(self.cart) for _ in range(3)))
+        
+        # A shared cache, e.g. Redis, is awaited; every coroutine misses it before the first one stores
+        evaluate = services.get_applicable_coupons
+        with mock.patch.object(result_cache, 'is_local_cache', return_value=False), \
+                mock.patch.object(cache, 'aget', side_effect=lambda key, default: default), \
+                mock.patch.object(cache, 'aset', side_effect=slow_aset), \
+                mock.patch.object(services, 'get_applicable_coupons', wraps=evaluate) as evaluation:
+            results = async_to_sync(apply_concurrently)()
+            
+        self.assertEqual(evaluation.call_count, 1)
+        self.assertEqual(len(results[0]), 1)
+        
+    @override_settings(COUPON_SINGLE_FLIGHT=False)
+    def test_disabled(self):
+        self.assertEqual(singleflight.do('cart', lambda: 'result', 'apply-coupon'), 'result')
+        self.assertFalse(any(line.startswith('coupon_single_flight_requests_total{') for line in self.metric_lines()))
+
+
+class FastPathTests(RandomCatalogMixin, TestCase):
+    def assertSameValidation(self, data):
+        serializer = CartSerializer(data=data)
+        cart, errors = fastpath.validate(CartSerializer, data)
+        if serializer.is_valid():
+            self.assertIsNone(errors)
+            # repr keeps the exponent of each Decimal, so 30.5 and 30.50 differ
+            self.assertEqual(json.dumps(cart, default=repr), json.dumps(serializer.validated_data, default=repr))
+        else:
+            self.assertIsNone(cart)
+            self.assertEqual(errors, serializer.errors)
+            
+    def assertSameEncoding(self, serializer_class, data):
+        serializer = serializer_class(data=data)
+        serializer.is_valid()
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(fastpath.encode(serializer_class, data)), renderer.render(serializer.data))
+        
+    def test_validation_matches_the_serializer(self):
+        values = [
+            1, 0, -1, '7', '7.0', 7.0, True, None, '', '  ', ' acme ', 'a\x00b', '\ud800', 'caf\u00e9',
+            '30.5', '30.555', '-0', '1e2', '123456789', '12345678.99', ' 3.10 ', 'nan', 'inf', 0.1 + 0.2, [], {},
+        ]
+        valid_item = {'product_id': 1, 'quantity': 2, 'price': '30.00', 'category': 'books', 'brand': 'acme'}
+        self.assertSameValidation({'items': [valid_item], 'ignored': True})
+        
+        for data in ({}, {'items': []}, {'items': {}}, {'items': [None]}, [], 'items', None):
+            self.assertSameValidation(data)
+        for field in valid_item:
+            self.assertSameValidation({'items': [{key: value for key, value in valid_item.items() if key != field}]})
+            for value in values:
+                self.assertSameValidation({'items': [valid_item, {**valid_item, field: value}]})
+                
+    def test_responses_match_the_serializer(self):
+        for _ in range(20):
+            cart = self.random_cart()
+            self.assertSameEncoding(
+                ApplicableCouponsResponseSerializer, {'applicable_coupons': get_applicable_coupons(cart)}
+            )
+            for coupon_id in self.coupon_ids[::5]:
+                discounted_cart = apply_coupon(coupon_id, cart)
+                if discounted_cart is not None:
+                    self.assertSameEncoding(DiscountedCartSerializer, discounted_cart)
+                    
+        # Data the response serializers would reject is rendered by them, as before
+        coupon = {'coupon_id': self.coupon_ids[0], 'type': 'cart-wise', 'name': 'CW0', 'code': 'CW0', 'discount': Decimal('1.00')}
+        for irregular in ({'name': ' CW0 '}, {'name': ''}, {'discount': Decimal('0.005')}, {'coupon_id': 'CW0'}):
+            self.assertSameEncoding(ApplicableCouponsResponseSerializer, {'applicable_coupons': [{**coupon, **irregular}]})
+            
+    def test_views_skip_the_serializers_for_regular_carts(self):
+        cart = {'items': [{'product_id': 1, 'quantity': 2, 'price': '30.00'}]}
+        with mock.patch.object(CartSerializer, 'is_valid') as is_valid:
+            response = self.client.post('/api/applicable-coupons/', cart, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        is_valid.assert_not_called()
+        
+        with override_settings(COUPON_FAST_PATH=False):
+            self.assertEqual(
+                self.client.post('/api/applicable-coupons/', cart, content_type='application/json').content,
+                response.content
+            )
+
+
+class CouponImportTests(TestCase):
+    CSV = (
+        'type,code,name,discount_type,threshold,discount_value,product_id,repetition_limit,buy_products,get_products\n'
+        'cart-wise,CART10,Cart ten,percentage,100,10,,,,\n'
+        'product-wise,PROD20,Prod twenty,percentage,,20,1,,,\n'
+        'bxgy,B2G1,Buy two,,,,,2,1:2,2\n'
+        'cart-wise,CART10,Duplicate,fixed,0,5,,,,\n'
+        'product-wise,BAD,Bad,percentage,,abc,1,,,\n'
+    )
+    
+    def setUp(self):
+        invalidate_snapshot()
+        
+    def test_command_imports_csv_in_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'coupons.csv')
+            errors_path = os.path.join(directory, 'errors.jsonl')
+            with open(path, 'w') as csv_file:
+                csv_file.write(self.CSV)
+            out = StringIO()
+            call_command('import_coupons', path, '--chunk-size', '2', '--errors', errors_path, stdout=out)
+            with open(errors_path) as errors_file:
+                errors = [json.loads(line) for line in errors_file]
+                
+        self.assertIn('Imported 3 coupons, 2 rows failed', out.getvalue())
+        self.assertEqual([(error['row'], list(error['errors'])) for error in errors], [(5, ['code']), (6, ['product_wise_details'])])
+        
+        bxgy = BxGyCoupon.objects.get(coupon__code='B2G1')
+        self.assertEqual(list(bxgy.buy_products.values_list('product_id', 'quantity')), [(1, 2)])
+        self.assertEqual(list(bxgy.get_products.values_list('product_id', 'quantity')), [(2, 1)])
+        
+        # bulk_create sends no signals; the importer drops the snapshot itself
+        cart = {'items': [make_item(1, 4, '30.00'), make_item(2, 1, '10.00')]}
+        self.assertEqual(
+            sorted(coupon['code'] for coupon in get_applicable_coupons(cart)), ['B2G1', 'CART10', 'PROD20']
+        )
+        
+    def test_endpoint_imports_json_lines(self):
+        create_cart_wise_coupon('TAKEN', '0.00', '5.00')
+        rows = [
+            {'type': 'cart-wise', 'code': 'NEW', 'name': 'New', 'cart_wise_details': {'threshold': '0', 'discount_value': '5'}},
+            {'type': 'cart-wise', 'code': 'TAKEN', 'name': 'Taken'},
+            {'type': 'bxgy', 'code': 'MIXED', 'name': 'Mixed', 'cart_wise_details': {'threshold': '0', 'discount_value': '5'}},
+        ]
+        body = '\n'.join(json.dumps(row) for row in rows) + '\n{"type": \n\n[]\n'
+        
+        response = self.client.post('/api/coupons/bulk-import/', body, content_type='application/x-ndjson')
+        
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual((report['created'], report['failed']), (1, 4))
+        self.assertEqual([error['row'] for error in report['errors']], [2, 3, 4, 6])
+        self.assertEqual(report['errors'][0]['errors'], {'code': ['coupon with this code already exists.']})
+        self.assertTrue(Coupon.objects.filter(code='NEW', cart_wise_details__discount_value=5).exists())
+        
+    def test_rejected_chunks_only_fail_the_offending_rows(self):
+        create_cart_wise_coupon('CART10', '0.00', '5.00')
+        rows = importer.read_rows(self.CSV.splitlines(keepends=True), 'csv')
+        # As if CART10 was created after the chunk's codes were checked
+        with mock.patch('coupons.importer._taken_codes', side_effect=[set(), {'CART10'}]):
+            report = importer.import_coupons(rows, chunk_size=10)
+            
+        self.assertEqual((report['created'], report['failed']), (2, 3))
+        self.assertEqual(
+            sorted((error['row'], error['code'], list(error['errors'])) for error in report['errors']),
+            [(2, 'CART10', ['code']), (5, 'CART10', ['code']), (6, 'BAD', ['product_wise_details'])]
+        )
+        self.assertEqual(sorted(Coupon.objects.values_list('code', flat=True)), ['B2G1', 'CART10', 'PROD20'])
+        
+    def test_bxgy_products_do_not_need_returned_primary_keys(self):
+        bulk_create = BxGyCoupon.objects.bulk_create
+        
+        def without_primary_keys(objs, *args, **kwargs):
+            created = bulk_create(objs, *args, **kwargs)
+            for details in objs:
+                details.pk = None
+            return created
+        
+        with mock.patch.object(BxGyCoupon.objects, 'bulk_create', side_effect=without_primary_keys):
+            report = importer.import_coupons(importer.read_rows(self.CSV.splitlines(keepends=True), 'csv'))
+        self.assertEqual(report['created'], 3)
+        bxgy = BxGyCoupon.objects.get(coupon__code='B2G1')
+        self.assertEqual(list(bxgy.buy_products.values_list('product_id', 'quantity')), [(1, 2)])
+        
+    def test_endpoint_rejects_unreadable_input(self):
+        response = self.client.post('/api/coupons/bulk-import/', '[]', content_type='application/json')
+        self.assertEqual(response.status_code, 415)
+        
+        response = self.client.post('/api/coupons/bulk-import/', 'type,code,nmae\n', content_type='text/csv')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'detail': 'Unknown CSV columns: nmae'})
+
+
+class CodeGenerationTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        
+    def test_patterns(self):
+        codes = codegen.random_codes('{X}-##-#', 50)
+        self.assertTrue(all(len(code) == 8 and code.startswith('{X}-') and code[6] == '-' for code in codes))
+        self.assertTrue(set(''.join(code[4:6] + code[7] for code in codes)) <= set(codegen.ALPHABET))
+        
+        codegen.check_pattern('SALE-####', 100000)
+        with self.assertRaises(codegen.CodeGenerationError):
+            codegen.check_pattern('SALE-###', 100000)
+        with self.assertRaises(codegen.CodeGenerationError):
+            codegen.check_pattern('#' * 51, 1)
+            
+    def test_codes_are_deduplicated_against_each_other_and_existing_codes(self):
+        create_cart_wise_coupon('X-AAAA', '0.00', '5.00')
+        with mock.patch.object(codegen, 'random_codes', side_effect=[['X-AAAA', 'X-BBBB', 'X-BBBB'], ['X-CCCC']]):
+            self.assertEqual(sorted(codegen._unique_codes('X-####', 2)), ['X-BBBB', 'X-CCCC'])
+            
+    @override_settings(COUPON_CODEGEN_CHUNK_SIZE=3)
+    def test_endpoint_streams_progress_and_clones_details(self):
+        template = create_product_wise_coupon('TEN', '10.00', coupon_options={'is_stackable': True}, category='books')
+        
+        response = self.client.post(
+            f'/api/coupons/{template.id}/generate-codes/', {'count': 7, 'pattern': 'TEN-######'},
+            content_type='application/json'
+        )
+        
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([line['created'] for line in lines], [3, 6, 7])
+        codes = [code for line in lines for code in line['codes']]
+        self.assertEqual(len(set(codes)), 7)
+        
+        clones = Coupon.objects.filter(code__in=codes)
+        self.assertEqual(clones.filter(is_stackable=True, product_wise_details__category='books').count(), 7)
+        # The clones apply like the template once the snapshot is rebuilt
+        cart = {'items': [make_item(1, 1, '50.00', category='books')]}
+        self.assertEqual(len(get_applicable_coupons(cart)), 8)
+        
+        response = self.client.post(
+            f'/api/coupons/{template.id}/generate-codes/', {'count': 7, 'pattern': 'TEN-#'},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('pattern', response.json())
+        
+    def test_command_clones_bxgy_products(self):
+        create_bxgy_coupon('B2G1', {1: 2, 3: 1}, {2: 1})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'codes.txt')
+            out = StringIO()
+            call_command('generate_codes', 'B2G1', '--count', '5', '--chunk-size', '2', '--output', path, stdout=out)
+            with open(path) as codes_file:
+                codes = codes_file.read().split()
+                
+        self.assertIn('Created 4/5 coupons', out.getvalue())
+        self.assertEqual(len(codes), 5)
+        self.assertTrue(all(code.startswith('B2G1-') for code in codes))
+        self.assertEqual(BxGyCouponBuyProduct.objects.filter(bxgy_coupon__coupon__code__in=codes).count(), 10)
+        self.assertEqual(BxGyCouponGetProduct.objects.filter(bxgy_coupon__coupon__code__in=codes).count(), 5)
+
+
+class CouponExportTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        for n in range(5):
+            create_bxgy_coupon(f'B{n}', {1: 2, 3: n + 1}, {2: 1}, repetition_limit=n + 1)
+        create_cart_wise_coupon('CART,10', '100.00', '10.00', expires_at=timezone.now() + timedelta(days=1))
+        create_product_wise_coupon('BOOKS', '15.00', 'fixed', category='books')
+        
+    def export(self, query='', **headers):
+        response = self.client.get(f'/api/coupons/export/{query}', **headers)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content).decode()
+    
+    @override_settings(COUPON_EXPORT_CHUNK_SIZE=2)
+    def test_ndjson_matches_the_api_in_key_order(self):
+        with CaptureQueriesContext(connection) as queries:
+            response, content = self.export()
+        # One query per chunk of 2 coupons, plus two BxGy product prefetches at most
+        chunk_queries = [query for query in queries if 'FROM "coupons_coupon"' in query['sql']]
+        self.assertEqual(len(chunk_queries), 4)
+        self.assertLessEqual(len(queries), 4 * 3)
+        
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([line['id'] for line in lines], sorted(str(coupon.id) for coupon in Coupon.objects.all()))
+        detail = self.client.get(f"/api/coupons/{lines[0]['id']}/").json()
+        self.assertEqual(lines[0], detail)
+        
+    def test_csv_can_be_imported_back(self):
+        response, content = self.export(HTTP_ACCEPT='text/csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(self.export('?format=csv')[1], content)
+        
+        ndjson = self.export()[1]
+        Coupon.objects.all().delete()
+        response = self.client.post('/api/coupons/bulk-import/', content, content_type='text/csv')
+        self.assertEqual(response.json()['created'], 7)
+        
+        def without_ids(content):
+            coupons = [json.loads(line) for line in content.splitlines()]
+            for coupon in coupons:
+                for field in ('id', 'created_at', 'updated_at'):
+                    coupon.pop(field)
+            return sorted(coupons, key=lambda coupon: coupon['code'])
+        
+        self.assertEqual(without_ids(self.export()[1]), without_ids(ndjson))
+
+
+class CouponListTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        for n in range(4):
+            create_bxgy_coupon(f'B{n}', {1: 2}, {2: 1})
+            create_cart_wise_coupon(f'CART{n}', '100.00', '10.00')
+            create_product_wise_coupon(f'BOOKS{n}', '15.00', category='books')
+            
+    def test_list_and_retrieve_load_details_without_n_plus_one(self):
+        # Count, coupons with their details, buy and get products
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/coupons/?page=2&page_size=3')
+        self.assertEqual(response.json()['count'], 12)
+        
+        bxgy = Coupon.objects.get(code='B0')
+        with self.assertNumQueries(3):
+            detail = self.client.get(f'/api/coupons/{bxgy.id}/').json()
+        self.assertEqual(detail['bxgy_details']['buy_products'], [{'product_id': 1, 'quantity': 2}])
+        
+    def test_cursor_pages_cost_the_same_and_cover_every_coupon(self):
+        url = '/api/coupons/?pagination=cursor&page_size=3'
+        codes = []
+        while url:
+            # No count; coupons with their details, buy and get products
+            with self.assertNumQueries(3):
+                page = self.client.get(url).json()
+            self.assertNotIn('count', page)
+            codes.extend(coupon['code'] for coupon in page['results'])
+            url = page['next']
+            
+        expected = Coupon.objects.order_by('-created_at', '-id').values_list('code', flat=True)
+        self.assertEqual(codes, list(expected))
+        
+    def test_page_numbers_stay_the_default(self):
+        page = self.client.get('/api/coupons/').json()
+        self.assertEqual(page['count'], 12)
+        self.assertEqual(len(page['results']), 10)
+        self.assertIn('page=2', page['next'])
+
+
+class RedemptionTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        self.coupon = create_cart_wise_coupon('LIMITED', '0.00', '10.00')
+        self.cart = {'items': [{'product_id': 1, 'quantity': 1, 'price': '100.00'}]}
+        
+    def redeem(self, body=None, path='/api/apply-coupon/'):
+        return self.client.post(
+            f'{path}{self.coupon.id}/?commit=true', {**self.cart, **(body or {})}, content_type='application/json'
+        )
+    
+    def test_shard_capacities_add_up_to_the_limit(self):
+        for limit in (0, 1, 7, 8, 9, 1001):
+            self.assertEqual(sum(redemptions.shard_capacity(limit, shard, 8) for shard in range(8)), limit)
+            
+    def test_total_limit(self):
+        Coupon.objects.filter(pk=self.coupon.pk).update(max_redemptions=3)
+        for n in range(3):
+            response = self.redeem()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['total_discount'], '10.00')
+            
+        response = self.redeem()
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(), {'error': 'The coupon has no redemptions left.'})
+        self.assertEqual(redemptions.redemption_count(self.coupon), 3)
+        self.assertEqual(Redemption.objects.filter(coupon=self.coupon).count(), 3)
+        
+        # Applying without committing is not limited
+        response = self.client.post(f'/api/apply-coupon/{self.coupon.id}/', self.cart, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('redemption_id', response.json())
+        
+    def test_per_user_limit(self):
+        Coupon.objects.filter(pk=self.coupon.pk).update(max_redemptions=3, max_redemptions_per_user=1)
+        self.assertEqual(self.redeem().status_code, 400)
+        
+        response = self.redeem({'user_id': 'alice'})
+        self.assertEqual(response.status_code, 200)
+        redemption = Redemption.objects.get(pk=response.json()['redemption_id'])
+        self.assertEqual((redemption.user_id, redemption.discount), ('alice', Decimal('10.00')))
+        
+        response = self.redeem({'user_id': 'alice'}, path='/api/async/apply-coupon/')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(), {'error': 'The coupon has no redemptions left for this user.'})
+        # The rejected redemption was not counted against the total limit
+        self.assertEqual(redemptions.redemption_count(self.coupon), 1)
+        self.assertEqual(self.redeem({'user_id': 'bob'}, path='/api/async/apply-coupon/').status_code, 200)
+        
+    def test_shard_count_is_fixed_on_the_first_redemption(self):
+        Coupon.objects.filter(pk=self.coupon.pk).update(max_redemptions=4)
+        with override_settings(COUPON_REDEMPTION_SHARDS=2):
+            self.assertEqual(self.redeem().status_code, 200)
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.redemption_shards, 2)
+        
+        # Neither strands capacity nor goes past the limit
+        with override_settings(COUPON_REDEMPTION_SHARDS=8):
+            statuses = [self.redeem().status_code for _ in range(4)]
+        self.assertEqual(statuses, [200, 200, 200, 409])
+        self.assertEqual(RedemptionCounter.objects.filter(coupon=self.coupon).count(), 2)
+        self.assertEqual(redemptions.redemption_count(self.coupon), 4)
+        
+    def test_inactive_or_expired_coupons_are_not_redeemed(self):
+        discounted_cart = {'total_discount': Decimal('10.00')}
+        # Changed after the snapshot the cart was evaluated against was built
+        Coupon.objects.filter(pk=self.coupon.pk).update(is_active=False)
+        with self.assertRaisesMessage(redemptions.RedemptionError, 'The coupon is no longer active.'):
+            redemptions.redeem(self.coupon.id, discounted_cart)
+        Coupon.objects.filter(pk=self.coupon.pk).update(is_active=True, expires_at=timezone.now() - timedelta(seconds=1))
+        with self.assertRaisesMessage(redemptions.RedemptionError, 'The coupon has expired.'):
+            redemptions.reserve(self.coupon.id, discounted_cart)
+        self.assertFalse(Redemption.objects.exists())
+        
+    def test_unlimited_coupons_are_recorded_without_counters(self):
+        # A savepoint, the limits, the redemption and the release
+        with self.assertNumQueries(4):
+            redemption = redemptions.redeem(self.coupon.id, {'total_discount': Decimal('10.00')})
+        self.assertIsNone(redemption.shard)
+        self.assertFalse(RedemptionCounter.objects.exists())
+
+
+class RedemptionStressTests(TransactionTestCase):
+    def test_concurrent_redemptions_never_exceed_the_limits(self):
+        invalidate_snapshot()
+        coupon = create_cart_wise_coupon('FLASH', '0.00', '10.00', max_redemptions=40, max_redemptions_per_user=3)
+        users = [f'user-{n}' for n in range(30)]
+        outcomes = []
+        
+        def checkout(n):
+            try:
+                while True:
+                    try:
+                        redemptions.redeem(coupon.id, {'total_discount': Decimal('10.00')}, users[n % len(users)])
+                        outcomes.append('redeemed')
+                    except redemptions.RedemptionLimitReached:
+                        outcomes.append('rejected')
+                    except OperationalError:
+                        # SQLite refuses concurrent writers instead of waiting; the
+                        # transaction was rolled back, so it is tried again
+                        time.sleep(random.random() / 200)
+                        continue
+                    return
+            finally:
+                connection.close()
+                
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(checkout, range(100)))
+            
+        self.assertEqual(outcomes.count('redeemed'), 40)
+        self.assertEqual(Redemption.objects.filter(coupon=coupon).count(), 40)
+        self.assertEqual(redemptions.redemption_count(coupon), 40)
+        for user_id, count in UserRedemptionCounter.objects.values_list('user_id', 'count'):
+            self.assertLessEqual(count, 3)
+            self.assertEqual(Redemption.objects.filter(coupon=coupon, user_id=user_id).count(), count)
+
+
+class ReservationTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        self.coupon = create_cart_wise_coupon('HOLD', '0.00', '10.00', max_redemptions=2, max_redemptions_per_user=1)
+        self.cart = {'items': [{'product_id': 1, 'quantity': 1, 'price': '100.00'}]}
+        
+    def reserve(self, user_id, path='/api/apply-coupon/'):
+        return self.client.post(
+            f'{path}{self.coupon.id}/?reserve=true', {**self.cart, 'user_id': user_id}, content_type='application/json'
+        )
+    
+    def assertCounts(self, total, **users):
+        self.assertEqual(redemptions.redemption_count(self.coupon), total)
+        self.assertEqual(
+            dict(UserRedemptionCounter.objects.filter(coupon=self.coupon, count__gt=0).values_list('user_id', 'count')),
+            users
+        )
+        
+    def test_reserve_confirm_and_release(self):
+        response = self.reserve('alice')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['total_discount'], '10.00')
+        self.assertIn('reserved_until', response.json())
+        alice = response.json()['redemption_id']
+        bob = self.reserve('bob', path='/api/async/apply-coupon/').json()['redemption_id']
+        
+        # Both uses are held, so the coupon cannot be oversold while they pay
+        self.assertEqual(self.reserve('carol').status_code, 409)
+        self.assertCounts(2, alice=1, bob=1)
+        
+        response = self.client.post(f'/api/redemptions/{alice}/confirm/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json()['status'], response.json()['expires_at']), ('confirmed', None))
+        self.assertEqual(self.client.post(f'/api/redemptions/{alice}/release/').status_code, 409)
+        
+        with self.assertNumQueries(6):
+            response = self.client.post(f'/api/redemptions/{bob}/release/')
+        self.assertEqual(response.json()['status'], 'released')
+        self.assertCounts(1, alice=1)
+        self.assertEqual(self.client.post(f'/api/redemptions/{bob}/confirm/').status_code, 409)
+        
+        self.assertEqual(self.reserve('carol').status_code, 200)
+        self.assertEqual(self.client.get(f'/api/redemptions/{alice}/').json()['status'], 'confirmed')
+        self.assertEqual(self.client.post(f'/api/redemptions/{uuid.uuid4()}/confirm/').status_code, 404)
+        
+    def test_reservations_are_given_back_once(self):
+        reservation = redemptions.reserve(self.coupon.id, {'total_discount': Decimal('10.00')}, 'alice')
+        stale = Redemption.objects.get(pk=reservation.pk)
+        redemptions.release(reservation.id)
+        
+        # Read as reserved before the release, as a sweep racing it without row locks would
+        with transaction.atomic():
+            self.assertEqual(redemptions.reclaim([stale], Redemption.EXPIRED), 0)
+        self.assertCounts(0)
+        self.assertEqual(Redemption.objects.get(pk=reservation.pk).status, 'released')
+        
+        # A release racing an expiry reports the expiry
+        reservation = redemptions.reserve(self.coupon.id, {'total_discount': Decimal('10.00')}, 'alice')
+        with mock.patch('coupons.redemptions.Redemption.objects.select_for_update') as select_for_update:
+            select_for_update.return_value.get.return_value = Redemption.objects.get(pk=reservation.pk)
+            Redemption.objects.filter(pk=reservation.pk).update(status=Redemption.EXPIRED)
+            with self.assertRaisesMessage(redemptions.ReservationError, 'The reservation is expired.'):
+                redemptions.release(reservation.id)
+        self.assertCounts(1, alice=1)
+        
+    def test_confirming_is_one_update(self):
+        reservation = redemptions.reserve(self.coupon.id, {'total_discount': Decimal('10.00')}, 'alice')
+        # A savepoint, the update, the confirmed redemption and the release
+        with self.assertNumQueries(4):
+            redemptions.confirm(reservation.id)
+            
+    def test_expired_reservations_are_swept_in_batches(self):
+        discounted_cart = {'total_discount': Decimal('10.00')}
+        later = redemptions.reserve(self.coupon.id, discounted_cart, 'alice', ttl=3600)
+        Coupon.objects.filter(pk=self.coupon.pk).update(max_redemptions=10)
+        expiring = [redemptions.reserve(self.coupon.id, discounted_cart, f'user-{n}', ttl=60) for n in range(5)]
+        self.assertCounts(6, alice=1, **{f'user-{n}': 1 for n in range(5)})
+        
+        # An expired reservation cannot be confirmed, even before the sweep
+        with self.assertRaises(redemptions.ReservationError):
+            redemptions.confirm(expiring[0].id, now=timezone.now() + timedelta(minutes=2))
+        self.assertCounts(5, alice=1, **{f'user-{n}': 1 for n in range(1, 5)})
+        
+        out = StringIO()
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() + timedelta(minutes=2)):
+            call_command('expire_reservations', '--batch-size', '2', stdout=out)
+        self.assertIn('Released 4 expired reservations', out.getvalue())
+        self.assertCounts(1, alice=1)
+        self.assertEqual(
+            sorted(Redemption.objects.values_list('status', flat=True)),
+            ['expired'] * 5 + ['reserved']
+        )
+        self.assertEqual(redemptions.sweep_expired(), 0)
+        self.assertEqual(redemptions.confirm(later.id).status, 'confirmed')
+
+
+@override_settings(COUPON_BULK_CHUNK_SIZE=2)
+class BulkOperationTests(TestCase):
+    def setUp(self):
+        invalidate_snapshot()
+        self.summer = [create_cart_wise_coupon(f'SUMMER-{n}', '0.00', '10.00') for n in range(5)]
+        self.bxgy = [create_bxgy_coupon(f'B2G1-{n}', {1: 2, 2: 1}, {3: 1}) for n in range(3)]
+        self.other = create_product_wise_coupon('BOOKS', '15.00', category='books')
+        self.cart = {'items': [make_item(1, 1, '100.00', category='books')]}
+        
+    def bulk(self, body):
+        with mock.patch('coupons.signals.invalidate_snapshot', wraps=invalidate_snapshot) as invalidate:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/api/coupons/bulk/', body, content_type='application/json')
+        self.invalidations = invalidate.call_count
+        self.queries = [query['sql'] for query in queries]
+        return response
+    
+    def test_deactivate_runs_one_update_per_chunk(self):
+        self.assertEqual(len(get_applicable_coupons(self.cart)), 6)
+        response = self.bulk({'filter': {'code_prefix': 'SUMMER-'}, 'operation': 'deactivate'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'operation': 'deactivate', 'affected': 5, 'chunks': 3})
+        self.assertEqual(len([sql for sql in self.queries if sql.startswith('UPDATE "coupons_coupon"')]), 3)
+        self.assertEqual(self.invalidations, 1)
+        
+        self.assertEqual(Coupon.objects.filter(is_active=False).count(), 5)
+        self.assertEqual([coupon['code'] for coupon in get_applicable_coupons(self.cart)], ['BOOKS'])
+        
+        response = self.bulk({'filter': {'code_prefix': 'SUMMER-', 'type': 'cart-wise'}, 'operation': 'activate'})
+        self.assertEqual(response.json()['affected'], 5)
+        self.assertEqual(len(get_applicable_coupons(self.cart)), 6)
+        
+    def test_set_expiry_by_ids_and_creation_time(self):
+        expires_at = timezone.now() + timedelta(days=1)
+        ids = [str(coupon.id) for coupon in self.summer[:3]] + [str(self.other.id)]
+        response = self.bulk({
+            'filter': {'ids': ids, 'created_before': (timezone.now() + timedelta(minutes=1)).isoformat()},
+            'operation': 'set_expiry',
+            'expires_at': expires_at.isoformat(),
+        })
+        self.assertEqual(response.json()['affected'], 4)
+        self.assertEqual(Coupon.objects.filter(expires_at=expires_at).count(), 4)
+        
+        response = self.bulk({
+            'filter': {'ids': ids, 'created_after': (timezone.now() + timedelta(minutes=1)).isoformat()},
+            'operation': 'set_expiry',
+            'expires_at': None,
+        })
+        self.assertEqual(response.json(), {'operation': 'set_expiry', 'affected': 0, 'chunks': 0})
+        self.assertEqual(self.invalidations, 0)
+        
+    def test_delete_cascades_and_invalidates_once(self):
+        response = self.bulk({'filter': {'type': 'bxgy'}, 'operation': 'delete'})
+        self.assertEqual(response.json(), {'operation': 'delete', 'affected': 3, 'chunks': 2})
+        self.assertEqual(self.invalidations, 1)
+        self.assertFalse(BxGyCouponBuyProduct.objects.exists())
+        self.assertEqual(Coupon.objects.count(), 6)
+        
+    def test_invalid_requests(self):
+        response = self.bulk({'filter': {}, 'operation': 'delete'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('filter', response.json())
+        response = self.bulk({'filter': {'type': 'bxgy'}, 'operation': 'set_expiry'})
+        self.assertEqual(response.json(), {'expires_at': ['This field is required for set_expiry.']})
+        self.assertEqual(Coupon.objects.count(), 9)
+
+
+class IdempotencyTests(TransactionTestCase):
+    """Transactional, so the claim refresher thread sees the keys stored by the requests"""
+    
+    def setUp(self):
+        invalidate_snapshot()
+        idempotency.get_store().clear()
+        self.coupon = create_cart_wise_coupon('ONCE', '0.00', '10.00', max_redemptions=5)
+        self.cart = {'items': [{'product_id': 1, 'quantity': 1, 'price': '100.00'}]}
+        
+    def post(self, key, cart=None, path='/api/apply-coupon/', query='?commit=true', coupon=None):
+        return self.client.post(
+            f'{path}{(coupon or self.coupon).id}/{query}', cart or self.cart,
+            content_type='application/json', HTTP_IDEMPOTENCY_KEY=key
+        )
+    
+    def test_retries_replay_the_stored_response(self):
+        with mock.patch('coupons.views.apply_coupon', wraps=apply_coupon) as evaluate:
+            first = self.post('order-1')
+            retry = self.post('order-1')
+        self.assertEqual(evaluate.call_count, 1)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertFalse(first.has_header('Idempotent-Replayed'))
+        self.assertEqual(Redemption.objects.count(), 1)
+        
+        # Async views share the store; equal carts may be written differently
+        retry = self.post('order-1', cart={'items': [{'product_id': 1, 'quantity': 1, 'price': '100.0'}]},
+                          path='/api/async/apply-coupon/')
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(Redemption.objects.count(), 1)
+        
+        self.assertEqual(self.post('order-2').status_code, 200)
+        self.assertEqual(Redemption.objects.count(), 2)
+        
+    def test_reusing_a_key_for_another_request_is_rejected(self):
+        self.post('order-1')
+        other_cart = {'items': [{'product_id': 1, 'quantity': 2, 'price': '100.00'}]}
+        other_coupon = create_cart_wise_coupon('OTHER', '0.00', '5.00')
+        for response in (
+            self.post('order-1', cart=other_cart),
+            self.post('order-1', coupon=other_coupon),
+            self.post('order-1', query=''),
+            self.post('order-1', cart=other_cart, path='/api/async/apply-coupon/'),
+        ):
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(response.json(), {'error': 'The Idempotency-Key was already used for a different request.'})
+        self.assertEqual(Redemption.objects.count(), 1)
+        
+    def test_retries_during_the_first_request_are_rejected(self):
+        retries = []
+        
+        def apply_and_retry(coupon_id, cart):
+            retries.append(self.post('order-1'))
+            return apply_coupon(coupon_id, cart)
+        
+        with mock.patch('coupons.views.apply_coupon', side_effect=apply_and_retry):
+            self.assertEqual(self.post('order-1').status_code, 200)
+        self.assertEqual(retries[0].status_code, 409)
+        
+    # The database cache stores expiry times in whole seconds
+    @override_settings(COUPON_IDEMPOTENCY_CLAIM_TIMEOUT=2)
+    def test_slow_requests_keep_their_claim(self):
+        retries = []
+        
+        def slow_apply(coupon_id, cart):
+            time.sleep(3)
+            retries.append(self.post('order-1'))
+            return apply_coupon(coupon_id, cart)
+        
+        with mock.patch('coupons.views.apply_coupon', side_effect=slow_apply):
+            self.assertEqual(self.post('order-1').status_code, 200)
+        self.assertEqual(retries[0].status_code, 409)
+        self.assertEqual(Redemption.objects.count(), 1)
+        
+    @override_settings(COUPON_IDEMPOTENCY_CLAIM_TIMEOUT=2)
+    def test_slow_async_requests_keep_their_claim(self):
+        store = idempotency.get_store()
+        store_key = idempotency._store_key('order-1')
+        
+        async def slow_respond():
+            await asyncio.sleep(3)
+            return await store.aadd(store_key, 'retry'), 200
+        
+        claimed_by_retry, _, _ = async_to_sync(idempotency.arun)(store, 'order-1', 'fingerprint', slow_respond)
+        self.assertFalse(claimed_by_retry)
+        self.assertEqual(store.get(store_key)['response'], (False, 200))
+        
+    def test_one_thread_refreshes_every_claim(self):
+        store = idempotency.get_store()
+        claims = [idempotency.refresher.hold(store, f'key-{n}', 60) for n in range(10)]
+        threads = [thread for thread in threading.enumerate() if thread.name == 'coupon-idempotency-claims']
+        for claim in claims:
+            self.assertTrue(idempotency.refresher.release(claim).is_set())
+        self.assertEqual(len(threads), 1)
+        self.assertFalse(idempotency.refresher.claims)
+        
+    def test_claims_of_dead_workers_expire(self):
+        # A claim no worker refreshes
+        store = idempotency.get_store()
+        store.add(idempotency._store_key('order-1'), {'fingerprint': 'fingerprint', 'response': None}, 1)
+        with mock.patch('coupons.idempotency.request_fingerprint', return_value='fingerprint'):
+            self.assertEqual(self.post('order-1').status_code, 409)
+            time.sleep(1.1)
+            self.assertEqual(self.post('order-1').status_code, 200)
+        self.assertEqual(Redemption.objects.count(), 1)
+        
+    def test_local_memory_stores_are_refused(self):
+        with override_settings(COUPON_IDEMPOTENCY_CACHE='coupon-results'):
+            with self.assertRaises(ImproperlyConfigured):
+                idempotency.get_store()
+        
+    def test_failed_requests_free_the_key(self):
+        with mock.patch('coupons.views.apply_coupon', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.post('order-1')
+        self.assertEqual(self.post('order-1').status_code, 200)
+        
+    def test_invalid_or_disabled_keys(self):
+        self.assertEqual(self.post('').status_code, 400)
+        self.assertEqual(self.post('k' * 256).status_code, 400)
+        with override_settings(COUPON_IDEMPOTENCY_CACHE=None):
+            self.post('order-1')
+            self.assertFalse(self.post('order-1').has_header('Idempotent-Replayed'))
+        self.assertEqual(Redemption.objects.count(), 2)
+
+
+@override_settings(COUPON_READ_REPLICAS=('replica',), COUPON_REPLICA_MAX_LAG=5)
+class ReplicaRoutingTests(TransactionTestCase):
+    """The test database is the primary; a copy of it in an SQLite file is the replica"""
+    
+    def setUp(self):
+        invalidate_snapshot()
+        routers.reset_health()
+        self.coupon = create_cart_wise_coupon('CART10', '0.00', '10.00')
+        
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'replica.sqlite3')
+        # Fills in the defaults of the replica's settings, like settings.DATABASES
+        connections.settings['replica'] = connections.configure_settings({
+            'default': {}, 'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path}
+        })['replica']
+        self.addCleanup(self.remove_replica)
+        
+        # Replicate the primary, then let the replica fall behind
+        connection.ensure_connection()
+        replica = sqlite3.connect(path)
+        connection.connection.backup(replica)
+        replica.close()
+        Coupon.objects.using('replica').filter(pk=self.coupon.pk).update(name='Replica')
+        self.forget_writes()
+        
+    def remove_replica(self):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        
+    def forget_writes(self):
+        # As if the last write was longer ago than the replica lag
+        routers._write_cache().delete(routers.LAST_WRITE_KEY)
+        
+    def evaluated_name(self):
+        response = self.client.post(
+            '/api/applicable-coupons/', {'items': [make_item(1, 1, '50.00')]}, content_type='application/json'
+        )
+        return response.json()['applicable_coupons'][0]['name']
+    
+    def test_evaluation_and_coupon_reads_go_to_a_replica(self):
+        self.assertEqual(routers.read_alias(), 'replica')
+        self.assertEqual(self.evaluated_name(), 'Replica')
+        self.assertEqual(self.client.get('/api/coupons/').json()['results'][0]['name'], 'Replica')
+        self.assertEqual(self.client.get(f'/api/coupons/{self.coupon.id}/').json()['name'], 'Replica')
+        
+        invalidate_snapshot()
+        self.forget_writes()
+        self.assertEqual(async_to_sync(aget_snapshot)().get(self.coupon.id).name, 'Replica')
+        
+        # Other reads stay on the primary
+        self.assertEqual(Coupon.objects.get(pk=self.coupon.pk).name, 'CART10')
+        
+    def test_reads_after_a_write_stick_to_the_primary(self):
+        self.coupon.name = 'Renamed'
+        self.coupon.save()
+        
+        self.assertEqual(self.evaluated_name(), 'Renamed')
+        self.assertEqual(self.client.get(f'/api/coupons/{self.coupon.id}/').json()['name'], 'Renamed')
+        with override_settings(COUPON_REPLICA_READ_YOUR_WRITES=False):
+            self.assertEqual(self.client.get(f'/api/coupons/{self.coupon.id}/').json()['name'], 'Replica')
+            
+    def test_unhealthy_replicas_are_skipped_until_the_next_check(self):
+        with mock.patch.object(routers, 'replica_lag', return_value=60) as replica_lag:
+            self.assertEqual(self.evaluated_name(), 'CART10')
+            self.assertEqual(self.client.get('/api/coupons/').json()['results'][0]['name'], 'CART10')
+        replica_lag.assert_called_once_with('replica')
+        
+        routers.reset_health()
+        with mock.patch.object(routers, 'replica_lag', side_effect=OperationalError('unreachable')):
+            self.assertEqual(routers.read_alias(), 'default')
+            
+        with override_settings(COUPON_REPLICA_CHECK_INTERVAL=0):
+            self.assertEqual(routers.read_alias(), 'replica')
+            
+    def test_writes_and_transactions_use_the_primary(self):
+        with transaction.atomic():
+            self.assertEqual(routers.read_alias(), 'default')
+            
+        coupon = Coupon.objects.using('replica').get(pk=self.coupon.pk)
+        coupon.is_active = False
+        coupon.save()
+        self.assertFalse(Coupon.objects.using('default').get(pk=self.coupon.pk).is_active)
+        self.assertTrue(Coupon.objects.using('replica').get(pk=self.coupon.pk).is_active)
+        self.assertFalse(routers.ReplicaRouter().allow_migrate('replica', 'coupons'))
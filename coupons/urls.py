@@ -1,12 +1,26 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import CouponViewSet, ApplicableCouponsView, ApplyCouponView
+from .views import (
+    CouponViewSet,
+    RedemptionViewSet,
+    ApplicableCouponsView,
+    BatchApplicableCouponsView,
+    BestCouponsView,
+    ApplyCouponView,
+    AsyncApplicableCouponsView,
+    AsyncApplyCouponView
+)
 
 router = DefaultRouter()
 router.register(r'coupons', CouponViewSet)
+router.register(r'redemptions', RedemptionViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
     path('applicable-coupons/', ApplicableCouponsView.as_view(), name='applicable-coupons'),
+    path('applicable-coupons/batch/', BatchApplicableCouponsView.as_view(), name='applicable-coupons-batch'),
+    path('best-coupons/', BestCouponsView.as_view(), name='best-coupons'),
     path('apply-coupon/<uuid:id>/', ApplyCouponView.as_view(), name='apply-coupon'),
+    path('async/applicable-coupons/', AsyncApplicableCouponsView.as_view(), name='applicable-coupons-async'),
+    path('async/apply-coupon/<uuid:id>/', AsyncApplyCouponView.as_view(), name='apply-coupon-async'),
 ] 
\ No newline at end of file
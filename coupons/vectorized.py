@@ -0,0 +1,317 @@
+"""
+Vectorized evaluation of large coupon catalogs with NumPy.
+
+Cart-wise and product-wise coupons are laid out as columnar arrays (targets,
+thresholds and values in cents, discount type codes, expiry timestamps) and a
+cart is evaluated against a whole table with a handful of array operations.
+BxGy coupons stay on the regular path: their free items are picked greedily,
+which does not vectorize, and the candidate index already keeps them few.
+
+The arithmetic follows the cents engine (see coupon_logics/cents.py), so the
+results are identical to the regular evaluation. NumPy is optional: when it
+is not installed, or the catalog is smaller than COUPON_VECTORIZE_THRESHOLD,
+services.get_applicable_coupons keeps using the Python loop.
+"""
+import math
+import threading
+import weakref
+
+from django.conf import settings
+
+from .coupon_logics import cents
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy is an optional dependency
+    np = None
+
+
+CART_WISE_TYPE_CODES = {'percentage': 0, 'fixed': 1, 'shipping': 2}
+PRODUCT_WISE_TYPE_CODES = {'percentage': 0, 'fixed': 1}
+
+# Keep every intermediate product comfortably inside int64
+INT64_SAFE_LIMIT = 2 ** 62
+
+
+def is_available():
+    """Check if NumPy is installed"""
+    return np is not None
+
+
+def should_vectorize(snapshot):
+    """
+    Check if a snapshot is large enough to be evaluated with NumPy.
+    
+    Args:
+        snapshot: A CouponSnapshot
+        
+    Returns:
+        bool: True if vectorized evaluation should be used
+    """
+    threshold = getattr(settings, 'COUPON_VECTORIZE_THRESHOLD', None)
+    if threshold is None or not is_available():
+        return False
+    return len(snapshot) >= threshold
+
+
+def _round_div(numerators, denominator):
+    """Vectorized cents.round_div for non-negative numerators"""
+    quotients, remainders = np.divmod(numerators, denominator)
+    twice_remainders = remainders * 2
+    round_up = (twice_remainders > denominator) | (
+        (twice_remainders == denominator) & (quotients % 2 == 1)
+    )
+    return quotients + round_up
+
+
+def _expiry_column(rules):
+    return np.array(
+        [math.inf if rule.expires_at is None else rule.expires_at.timestamp() for rule in rules],
+        dtype=np.float64
+    )
+
+
+class CartWiseTable:
+    """Cart-wise coupons as columns of thresholds, values and type codes"""
+    
+    def __init__(self, rules):
+        self.rules = tuple(rule for rule in rules if rule.cart_wise_details is not None)
+        self.thresholds = np.array(
+            [rule.cart_wise_details.threshold_cents for rule in self.rules], dtype=np.int64
+        )
+        self.values = np.array(
+            [rule.cart_wise_details.discount_value_cents for rule in self.rules], dtype=np.int64
+        )
+        self.type_codes = np.array(
+            [CART_WISE_TYPE_CODES.get(rule.cart_wise_details.discount_type, -1) for rule in self.rules],
+            dtype=np.int8
+        )
+        self.expires = _expiry_column(self.rules)
+        self.max_value = int(np.abs(self.values).max()) if self.rules else 0
+        
+    def evaluate(self, total_cents, now_timestamp):
+        """
+        Calculate the discount of every cart-wise coupon for a cart total.
+        
+        Returns:
+            tuple: Row indexes of the applicable coupons and their discounts in cents
+        """
+        eligible = (self.thresholds <= total_cents) & (self.expires >= now_timestamp)
+        discounts = np.zeros(len(self.rules), dtype=np.int64)
+        
+        percentage = eligible & (self.type_codes == CART_WISE_TYPE_CODES['percentage'])
+        discounts[percentage] = _round_div(total_cents * self.values[percentage], cents.PERCENT_SCALE)
+        
+        fixed = eligible & (self.type_codes == CART_WISE_TYPE_CODES['fixed'])
+        discounts[fixed] = np.minimum(self.values[fixed], total_cents)
+        
+        shipping = eligible & (self.type_codes == CART_WISE_TYPE_CODES['shipping'])
+        discounts[shipping] = cents.SHIPPING_COST_CENTS
+        
+        rows = np.flatnonzero(eligible & (discounts > 0))
+        return rows, discounts[rows]
+
+
+class TargetIndex:
+    """Product-wise table rows sorted by one kind of target key"""
+    
+    def __init__(self, keys, rows):
+        order = np.argsort(np.array(keys, dtype=np.int64), kind='stable')
+        self.keys = np.array(keys, dtype=np.int64)[order]
+        self.rows = np.array(rows, dtype=np.int64)[order]
+        
+    def pairs(self, key_lines):
+        """
+        Match cart lines against the index.
+        
+        Args:
+            key_lines: Mapping of target key to the cart line indexes having it
+            
+        Returns:
+            tuple: Arrays of matching table rows and cart lines
+        """
+        if not key_lines or not len(self.keys):
+            return [], []
+        
+        cart_keys = np.fromiter(key_lines.keys(), dtype=np.int64, count=len(key_lines))
+        starts = np.searchsorted(self.keys, cart_keys, side='left')
+        ends = np.searchsorted(self.keys, cart_keys, side='right')
+        
+        row_parts = []
+        line_parts = []
+        for key, start, end in zip(key_lines, starts.tolist(), ends.tolist()):
+            if start == end:
+                continue
+            rows = self.rows[start:end]
+            lines = np.array(key_lines[key], dtype=np.int64)
+            row_parts.append(np.repeat(rows, len(lines)))
+            line_parts.append(np.tile(lines, len(rows)))
+        return row_parts, line_parts
+
+
+class ProductWiseTable:
+    """Product-wise coupons as columns of targets, values and type codes"""
+    
+    def __init__(self, rules):
+        self.rules = tuple(rule for rule in rules if rule.product_wise_details is not None)
+        self.values = np.array(
+            [rule.product_wise_details.discount_value_cents for rule in self.rules], dtype=np.int64
+        )
+        self.type_codes = np.array(
+            [PRODUCT_WISE_TYPE_CODES.get(rule.product_wise_details.discount_type, 1) for rule in self.rules],
+            dtype=np.int8
+        )
+        self.expires = _expiry_column(self.rules)
+        self.max_value = int(np.abs(self.values).max()) if self.rules else 0
+        
+        # Categories and brands are strings; give each one an integer code
+        self.category_codes = {}
+        self.brand_codes = {}
+        targets = {'product': ([], []), 'category': ([], []), 'brand': ([], [])}
+        
+        for row, rule in enumerate(self.rules):
+            details = rule.product_wise_details
+            # Mirrors product_wise.matching_lines: empty targets never match
+            if details.product_id:
+                targets['product'][0].append(details.product_id)
+                targets['product'][1].append(row)
+            if details.category:
+                code = self.category_codes.setdefault(details.category, len(self.category_codes))
+                targets['category'][0].append(code)
+                targets['category'][1].append(row)
+            if details.brand:
+                code = self.brand_codes.setdefault(details.brand, len(self.brand_codes))
+                targets['brand'][0].append(code)
+                targets['brand'][1].append(row)
+                
+        self.targets = {kind: TargetIndex(keys, rows) for kind, (keys, rows) in targets.items()}
+        
+    def _encode(self, key_lines, codes):
+        return {codes[key]: lines for key, lines in key_lines.items() if key in codes}
+    
+    def evaluate(self, context, now_timestamp):
+        """
+        Calculate the discount of every product-wise coupon matching the cart.
+        
+        Returns:
+            tuple: Row indexes of the applicable coupons and their discounts in cents
+        """
+        row_parts = []
+        line_parts = []
+        for kind, key_lines in (
+            ('product', context.product_lines),
+            ('category', self._encode(context.category_lines, self.category_codes)),
+            ('brand', self._encode(context.brand_lines, self.brand_codes)),
+        ):
+            rows, lines = self.targets[kind].pairs(key_lines)
+            row_parts.extend(rows)
+            line_parts.extend(lines)
+            
+        if not row_parts:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        
+        # A line matching a coupon on several targets is only discounted once
+        line_count = len(context.items)
+        pair_codes = np.unique(np.concatenate(row_parts) * line_count + np.concatenate(line_parts))
+        rows = pair_codes // line_count
+        lines = pair_codes % line_count
+        
+        alive = self.expires[rows] >= now_timestamp
+        rows = rows[alive]
+        lines = lines[alive]
+        
+        prices = np.array(context.cents().prices, dtype=np.int64)[lines]
+        quantities = np.array([item['quantity'] for item in context.items], dtype=np.int64)[lines]
+        values = self.values[rows]
+        
+        # Exact per-item discounts scaled by PERCENT_SCALE, as in the cents engine
+        numerators = np.where(
+            self.type_codes[rows] == PRODUCT_WISE_TYPE_CODES['percentage'],
+            prices * values * quantities,
+            np.minimum(values, prices) * quantities * cents.PERCENT_SCALE
+        )
+        
+        sums = np.zeros(len(self.rules), dtype=np.int64)
+        np.add.at(sums, rows, numerators)
+        
+        matched = np.unique(rows)
+        discounts = _round_div(sums[matched], cents.PERCENT_SCALE)
+        positive = discounts > 0
+        return matched[positive], discounts[positive]
+
+
+class VectorTables:
+    """The columnar tables of a snapshot"""
+    
+    def __init__(self, snapshot):
+        self.cart_wise = CartWiseTable(rule for rule in snapshot.rules if rule.type == 'cart-wise')
+        self.product_wise = ProductWiseTable(rule for rule in snapshot.rules if rule.type == 'product-wise')
+        # Largest multiplier applied to a cart amount (fixed discounts scale by PERCENT_SCALE)
+        self.max_value = max(self.cart_wise.max_value, self.product_wise.max_value, cents.PERCENT_SCALE)
+
+
+_tables = weakref.WeakKeyDictionary()
+_tables_lock = threading.Lock()
+
+
+def get_tables(snapshot):
+    """Return the columnar tables of a snapshot, building them on first use"""
+    tables = _tables.get(snapshot)
+    if tables is None:
+        with _tables_lock:
+            tables = _tables.get(snapshot)
+            if tables is None:
+                tables = VectorTables(snapshot)
+                _tables[snapshot] = tables
+    return tables
+
+
+def get_applicable_coupons(snapshot, context, now):
+    """
+    Get all applicable coupons for a cart using the columnar tables.
+    
+    Args:
+        snapshot: A CouponSnapshot
+        context: A CartContext for the cart
+        now: The time used to skip expired coupons
+        
+    Returns:
+        list: Applicable coupons with their discount amounts, highest first,
+            or None if the cart is too large for int64 arithmetic
+    """
+    tables = get_tables(snapshot)
+    total_cents = context.cents().total
+    if total_cents * tables.max_value >= INT64_SAFE_LIMIT:
+        return None
+    
+    now_timestamp = now.timestamp()
+    found = []
+    
+    for table, (rows, discounts) in (
+        (tables.cart_wise, tables.cart_wise.evaluate(total_cents, now_timestamp)),
+        (tables.product_wise, tables.product_wise.evaluate(context, now_timestamp)),
+    ):
+        for row, discount in zip(rows.tolist(), discounts.tolist()):
+            found.append((table.rules[row], discount))
+            
+    # BxGy coupons are evaluated one by one on the cents engine
+    for rule in snapshot.bxgy_candidates(context):
+        if rule.is_expired(now):
+            continue
+        discount = cents.calculate_discount(rule, context)
+        if discount is not None and discount > 0:
+            found.append((rule, discount))
+            
+    # Highest discount first; ties keep snapshot order like the regular path
+    found.sort(key=lambda match: (-match[1], match[0].seq))
+    
+    return [
+        {
+            'coupon_id': rule.id,
+            'type': rule.type,
+            'name': rule.name,
+            'code': rule.code,
+            'discount': cents.from_cents(discount)
+        }
+        for rule, discount in found
+    ]
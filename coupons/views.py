@@ -1,20 +1,46 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
-from rest_framework import viewsets, status
+from django.views import View
+from rest_framework import mixins, viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import UnsupportedMediaType
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from drf_yasg.utils import swagger_auto_schema
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.renderers import JSONRenderer
+from drf_yasg.utils import no_body, swagger_auto_schema
 from drf_yasg import openapi
 
-from .models import Coupon
+from . import bulk, codegen, exporter, fastpath, idempotency, importer, metrics, redemptions, routers
+from .models import Coupon, Redemption
+from .pagination import CouponPagination
 from .serializers import (
     CouponSerializer, 
+    BulkOperationSerializer,
+    CodeGenerationSerializer,
     CartSerializer, 
+    CartBatchSerializer,
     DiscountedCartSerializer,
+    RedemptionRequestSerializer,
+    RedeemedCartSerializer,
+    RedemptionSerializer,
+    ReservedCartSerializer,
     ApplicableCouponsResponseSerializer,
-    ApplicableCouponSerializer
+    ApplicableCouponSerializer,
+    BatchApplicableCouponsResponseSerializer,
+    BestCouponsResponseSerializer
+)
+from .services import get_applicable_coupons_batch
+from .result_cache import (
+    get_applicable_coupons,
+    apply_coupon,
+    aget_applicable_coupons,
+    aapply_coupon
 )
-from .services import get_applicable_coupons, apply_coupon
+from .stacking import find_best_combination
 
 
 class CouponViewSet(viewsets.ModelViewSet):
@@ -23,6 +49,181 @@ class CouponViewSet(viewsets.ModelViewSet):
     """
     queryset = Coupon.objects.all()
     serializer_class = CouponSerializer
+    pagination_class = CouponPagination
+    
+    def get_queryset(self):
+        """Load the details and BxGy products with the coupons, newest first"""
+        return super().get_queryset().with_details().order_by('-created_at', '-id')
+    
+    def list(self, request, *args, **kwargs):
+        """List the coupons, from a read replica when one is configured"""
+        with routers.replica_reads(sticky=routers.read_your_writes()):
+            return super().list(request, *args, **kwargs)
+        
+    def retrieve(self, request, *args, **kwargs):
+        """Get a coupon, from a read replica when one is configured"""
+        with routers.replica_reads(sticky=routers.read_your_writes()):
+            return super().retrieve(request, *args, **kwargs)
+    
+    @swagger_auto_schema(
+        request_body=openapi.Schema(type=openapi.TYPE_STRING, format=openapi.FORMAT_BINARY),
+        consumes=['text/csv', 'application/x-ndjson'],
+        responses={
+            200: 'Import report: created and failed counts, and the errors of each failed row',
+            400: 'The input cannot be read',
+            415: 'Unsupported media type',
+        }
+    )
+    @action(detail=False, methods=['post'], url_path='bulk-import')
+    def bulk_import(self, request):
+        """
+        Import coupons from a CSV (text/csv) or JSON Lines (application/x-ndjson) body.
+        
+        The body is parsed as it is read; see coupons/importer.py for the row formats.
+        """
+        format = importer.format_for_content_type(request.content_type)
+        if format is None:
+            raise UnsupportedMediaType(request.content_type)
+        
+        stream = request.stream
+        lines = importer.decode_lines(stream, request.encoding or 'utf-8') if stream is not None else []
+        try:
+            report = importer.import_coupons(importer.read_rows(lines, format))
+        except importer.CouponImportError as exc:
+            return Response({'detail': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response(report)
+    
+    @swagger_auto_schema(
+        responses={200: 'One coupon per NDJSON line, or one per CSV row with the bulk import columns'}
+    )
+    @action(detail=False, methods=['get'], renderer_classes=exporter.RENDERERS)
+    def export(self, request):
+        """
+        Export all coupons as NDJSON (default) or CSV (`?format=csv` or `Accept: text/csv`).
+        
+        Coupons are streamed in primary key order, a chunk at a time.
+        """
+        renderer = request.accepted_renderer
+        response = StreamingHttpResponse(
+            exporter.stream(self.filter_queryset(self.get_queryset()), renderer.format),
+            content_type=renderer.media_type
+        )
+        response['Content-Disposition'] = f'attachment; filename="coupons.{renderer.format}"'
+        return response
+    
+    @swagger_auto_schema(
+        request_body=BulkOperationSerializer,
+        responses={
+            200: 'The operation, and the number of affected coupons and chunks',
+            400: 'Bad Request',
+        }
+    )
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Activate, deactivate, set the expiry of or delete every coupon matching a filter.
+        
+        Coupons are changed a chunk at a time, with one statement per chunk.
+        """
+        serializer = BulkOperationSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        data = serializer.validated_data
+        report = bulk.run(
+            bulk.filter_coupons(**data['filter']), data['operation'], expires_at=data.get('expires_at')
+        )
+        return Response(report)
+    
+    @swagger_auto_schema(
+        request_body=CodeGenerationSerializer,
+        responses={
+            200: 'NDJSON stream with one line per created chunk: {"created": ..., "count": ..., "codes": [...]}',
+            400: 'Bad Request',
+            404: 'Template coupon not found',
+        }
+    )
+    @action(detail=True, methods=['post'], url_path='generate-codes')
+    def generate_codes(self, request, pk=None):
+        """
+        Create copies of this coupon with unique random codes.
+        
+        Progress is streamed as one NDJSON line per chunk of created coupons,
+        carrying their codes.
+        """
+        template = self.get_object()
+        serializer = CodeGenerationSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        count = serializer.validated_data['count']
+        pattern = serializer.validated_data.get('pattern') or codegen.default_pattern(template)
+        try:
+            codegen.check_pattern(pattern, count)
+        except codegen.CodeGenerationError as exc:
+            return Response({'pattern': [str(exc)]}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return StreamingHttpResponse(
+            self.stream_progress(codegen.generate_coupons(template, count, pattern), count),
+            content_type='application/x-ndjson'
+        )
+    
+    def stream_progress(self, chunks, count):
+        created = 0
+        try:
+            for codes in chunks:
+                created += len(codes)
+                yield json.dumps({'created': created, 'count': count, 'codes': codes}) + '\n'
+        except codegen.CodeGenerationError as exc:
+            yield json.dumps({'created': created, 'count': count, 'error': str(exc)}) + '\n'
+
+
+class RedemptionViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """
+    ViewSet to read redemptions and confirm or release reservations.
+    """
+    queryset = Redemption.objects.all()
+    serializer_class = RedemptionSerializer
+    
+    def change_reservation(self, change, pk):
+        try:
+            redemption = change(pk)
+        except Redemption.DoesNotExist:
+            return Response({'error': 'Reservation not found'}, status=status.HTTP_404_NOT_FOUND)
+        except redemptions.ReservationError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_409_CONFLICT)
+        return Response(self.get_serializer(redemption).data)
+    
+    @swagger_auto_schema(
+        request_body=no_body,
+        responses={
+            200: RedemptionSerializer,
+            404: 'Reservation not found',
+            409: 'The reservation expired or was released',
+        }
+    )
+    @action(detail=True, methods=['post'])
+    def confirm(self, request, pk=None):
+        """
+        Confirm a reservation, making it a redemption.
+        """
+        return self.change_reservation(redemptions.confirm, pk)
+    
+    @swagger_auto_schema(
+        request_body=no_body,
+        responses={
+            200: RedemptionSerializer,
+            404: 'Reservation not found',
+            409: 'The reservation was already confirmed or released',
+        }
+    )
+    @action(detail=True, methods=['post'])
+    def release(self, request, pk=None):
+        """
+        Release a reservation, giving the use back to the coupon's limits.
+        """
+        return self.change_reservation(redemptions.release, pk)
 
 
 class ApplicableCouponsView(APIView):
@@ -40,21 +241,143 @@ class ApplicableCouponsView(APIView):
         """
         Get all applicable coupons for the given cart.
         """
-        serializer = CartSerializer(data=request.data)
-        if not serializer.is_valid():
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        cart, errors = fastpath.validate(CartSerializer, request.data)
+        if errors is not None:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
         
-        cart = serializer.validated_data
         applicable_coupons = get_applicable_coupons(cart)
         
         response_data = {
             'applicable_coupons': applicable_coupons
         }
         
-        response_serializer = ApplicableCouponsResponseSerializer(data=response_data)
-        response_serializer.is_valid()  # We can assume it's valid since we constructed it
+        return Response(fastpath.encode(ApplicableCouponsResponseSerializer, response_data))
+
+
+class BatchApplicableCouponsView(APIView):
+    """
+    View to get the applicable coupons for many carts in one request.
+    """
+    @swagger_auto_schema(
+        request_body=CartBatchSerializer,
+        manual_parameters=[
+            openapi.Parameter(
+                'stream', openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN,
+                description='Stream one NDJSON line per cart instead of a single JSON document'
+            ),
+        ],
+        responses={
+            200: BatchApplicableCouponsResponseSerializer,
+            400: 'Bad Request',
+        }
+    )
+    def post(self, request, format=None):
+        """
+        Get the applicable coupons for each cart in the batch, in request order.
+        """
+        batch, errors = fastpath.validate(CartBatchSerializer, request.data)
+        if errors is not None:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        carts = batch['carts']
+        results = get_applicable_coupons_batch(carts)
+        
+        if request.query_params.get('stream', '').lower() in ('1', 'true'):
+            return StreamingHttpResponse(
+                self.stream_results(results),
+                content_type='application/x-ndjson'
+            )
+        
+        response_data = {
+            'results': [
+                {'applicable_coupons': applicable_coupons}
+                for applicable_coupons in results
+            ]
+        }
+        
+        return Response(fastpath.encode(BatchApplicableCouponsResponseSerializer, response_data))
+    
+    def stream_results(self, results):
+        """
+        Render each cart's result as one NDJSON line as soon as it is computed.
+        """
+        for index, applicable_coupons in enumerate(results):
+            response_data = fastpath.encode(
+                ApplicableCouponsResponseSerializer, {'applicable_coupons': applicable_coupons}
+            )
+            
+            line = {'index': index, **response_data}
+            yield json.dumps(line, cls=JSONEncoder) + '\n'
+
+
+class BestCouponsView(APIView):
+    """
+    View to find the combination of coupons giving the largest discount.
+    """
+    @swagger_auto_schema(
+        request_body=CartSerializer,
+        responses={
+            200: BestCouponsResponseSerializer,
+            400: 'Bad Request',
+        }
+    )
+    def post(self, request, format=None):
+        """
+        Get the best combination of stackable coupons for the given cart.
+        """
+        cart, errors = fastpath.validate(CartSerializer, request.data)
+        if errors is not None:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        best_combination = find_best_combination(cart)
         
-        return Response(response_serializer.data)
+        return Response(fastpath.encode(BestCouponsResponseSerializer, best_combination))
+
+
+def redemption_mode(query_params):
+    """
+    Return how an apply-coupon request asks for the coupon to be redeemed.
+    
+    Returns:
+        str: 'reserve', 'commit', or None to only apply the coupon
+    """
+    for mode in ('reserve', 'commit'):
+        if query_params.get(mode, '').lower() in ('1', 'true'):
+            return mode
+    return None
+
+
+def redeem_response(coupon_id, discounted_cart, data, mode):
+    """
+    Redeem or reserve an applied coupon for the user in the request data.
+    
+    Returns:
+        tuple: The response data and status code
+    """
+    request_data, errors = fastpath.validate(RedemptionRequestSerializer, data)
+    if errors is not None:
+        return errors, status.HTTP_400_BAD_REQUEST
+    
+    user_id = request_data.get('user_id')
+    try:
+        if mode == 'reserve':
+            redemption = redemptions.reserve(coupon_id, discounted_cart, user_id)
+        else:
+            redemption = redemptions.redeem(coupon_id, discounted_cart, user_id)
+    except Coupon.DoesNotExist:
+        return {'error': 'Coupon not found or not applicable to the cart'}, status.HTTP_404_NOT_FOUND
+    except redemptions.RedemptionLimitReached as exc:
+        return {'error': str(exc)}, status.HTTP_409_CONFLICT
+    except redemptions.RedemptionError as exc:
+        return {'error': str(exc)}, status.HTTP_400_BAD_REQUEST
+    
+    if mode == 'reserve':
+        return fastpath.encode(ReservedCartSerializer, {
+            **discounted_cart, 'redemption_id': redemption.id, 'reserved_until': redemption.expires_at
+        }), status.HTTP_200_OK
+    return fastpath.encode(
+        RedeemedCartSerializer, {**discounted_cart, 'redemption_id': redemption.id}
+    ), status.HTTP_200_OK
 
 
 class ApplyCouponView(APIView):
@@ -63,30 +386,227 @@ class ApplyCouponView(APIView):
     """
     @swagger_auto_schema(
         request_body=CartSerializer,
+        manual_parameters=[
+            openapi.Parameter(
+                'commit', openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN,
+                description='Redeem the coupon, counting it against its limits; '
+                            'the body may carry a "user_id" for per-user limits'
+            ),
+            openapi.Parameter(
+                'reserve', openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN,
+                description='Hold a redemption of the coupon until it is confirmed or released '
+                            'at /redemptions/{redemption_id}/, or expires'
+            ),
+            openapi.Parameter(
+                idempotency.HEADER, openapi.IN_HEADER, type=openapi.TYPE_STRING,
+                description='Replay the stored response of an earlier request with the same key '
+                            'instead of applying or redeeming the coupon again'
+            ),
+        ],
         responses={
             200: DiscountedCartSerializer,
             400: 'Bad Request',
             404: 'Coupon not found or not applicable',
+            409: 'The coupon has no redemptions left, in total or for the user, '
+                 'or a request with the same Idempotency-Key is in progress',
+            422: 'The Idempotency-Key was used for a different request',
         }
     )
     def post(self, request, id, format=None):
         """
         Apply a specific coupon to the cart.
         """
-        serializer = CartSerializer(data=request.data)
-        if not serializer.is_valid():
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        cart, errors = fastpath.validate(CartSerializer, request.data)
+        if errors is not None:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        mode = redemption_mode(request.query_params)
+        key = request.headers.get(idempotency.HEADER)
+        store = idempotency.get_store() if key is not None else None
+        if store is None:
+            data, response_status = self.apply(id, cart, request.data, mode)
+            return Response(data, status=response_status)
         
-        cart = serializer.validated_data
-        discounted_cart = apply_coupon(id, cart)
+        fingerprint = idempotency.request_fingerprint(id, cart, request.data, mode)
+        try:
+            data, response_status, replayed = idempotency.run(
+                store, key, fingerprint, lambda: self.apply(id, cart, request.data, mode)
+            )
+        except idempotency.IdempotencyError as exc:
+            return Response({'error': str(exc)}, status=exc.status_code)
+        
+        response = Response(data, status=response_status)
+        if replayed:
+            response[idempotency.REPLAYED_HEADER] = 'true'
+        return response
+    
+    def apply(self, coupon_id, cart, data, mode):
+        """
+        Apply, and redeem or reserve, a coupon.
+        
+        Returns:
+            tuple: The response data and status code
+        """
+        discounted_cart = apply_coupon(coupon_id, cart)
         
         if discounted_cart is None:
-            return Response(
-                {'error': 'Coupon not found or not applicable to the cart'},
-                status=status.HTTP_404_NOT_FOUND
+            return {'error': 'Coupon not found or not applicable to the cart'}, status.HTTP_404_NOT_FOUND
+        
+        if mode is not None:
+            return redeem_response(coupon_id, discounted_cart, data, mode)
+        
+        return fastpath.encode(DiscountedCartSerializer, discounted_cart), status.HTTP_200_OK
+
+
+class AsyncJSONView(View):
+    """
+    Base class for native async views answering like the DRF views.
+    
+    DRF views are synchronous, so under ASGI each of their requests occupies a
+    thread. These views parse and render JSON themselves and produce the same
+    response bodies and error messages as the DRF views they mirror.
+    """
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # Like DRF views, authentication is not session based
+        view.csrf_exempt = True
+        return view
+    
+    def parse_json(self, request):
+        """
+        Parse the JSON request body.
+        
+        Returns:
+            tuple: The parsed data and None, or None and an error response
+        """
+        # An empty body is an empty object, whatever its content type
+        if not request.body:
+            return {}, None
+        if request.content_type != 'application/json':
+            media_type = request.META.get('CONTENT_TYPE', '')
+            return None, self.render(
+                {'detail': f'Unsupported media type "{media_type}" in request.'},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+            )
+        try:
+            return json.loads(request.body.decode(request.encoding or 'utf-8')), None
+        except ValueError as exc:
+            return None, self.render(
+                {'detail': f'JSON parse error - {exc}'},
+                status=status.HTTP_400_BAD_REQUEST
             )
         
-        response_serializer = DiscountedCartSerializer(data=discounted_cart)
-        response_serializer.is_valid()  # We can assume it's valid since we constructed it
+    def parse_cart(self, request):
+        """
+        Parse and validate the cart in the request body.
+        
+        Returns:
+            tuple: The validated cart and None, or None and an error response
+        """
+        data, error_response = self.parse_json(request)
+        if error_response is not None:
+            return None, error_response
+        return self.validate_cart(data)
+        
+    def validate_cart(self, data):
+        """
+        Validate a parsed cart.
+        
+        Returns:
+            tuple: The validated cart and None, or None and an error response
+        """
+        cart, errors = fastpath.validate(CartSerializer, data)
+        if errors is not None:
+            return None, self.render(errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        return cart, None
+    
+    def render(self, data, status=status.HTTP_200_OK):
+        return HttpResponse(JSONRenderer().render(data), content_type='application/json', status=status)
+
+
+class AsyncApplicableCouponsView(AsyncJSONView):
+    """
+    Async view to get all applicable coupons for a cart.
+    """
+    async def post(self, request):
+        """
+        Get all applicable coupons for the given cart.
+        """
+        cart, error_response = self.parse_cart(request)
+        if error_response is not None:
+            return error_response
+        
+        applicable_coupons = await aget_applicable_coupons(cart)
+        
+        return self.render(fastpath.encode(
+            ApplicableCouponsResponseSerializer, {'applicable_coupons': applicable_coupons}
+        ))
+
+
+class AsyncApplyCouponView(AsyncJSONView):
+    """
+    Async view to apply a specific coupon to a cart.
+    """
+    async def post(self, request, id):
+        """
+        Apply a specific coupon to the cart.
+        """
+        data, error_response = self.parse_json(request)
+        if error_response is not None:
+            return error_response
+        cart, error_response = self.validate_cart(data)
+        if error_response is not None:
+            return error_response
+        
+        mode = redemption_mode(request.GET)
+        key = request.headers.get(idempotency.HEADER)
+        store = idempotency.get_store() if key is not None else None
+        if store is None:
+            response_data, response_status = await self.apply(id, cart, data, mode)
+            return self.render(response_data, status=response_status)
+        
+        fingerprint = idempotency.request_fingerprint(id, cart, data, mode)
+        try:
+            response_data, response_status, replayed = await idempotency.arun(
+                store, key, fingerprint, lambda: self.apply(id, cart, data, mode)
+            )
+        except idempotency.IdempotencyError as exc:
+            return self.render({'error': str(exc)}, status=exc.status_code)
+        
+        response = self.render(response_data, status=response_status)
+        if replayed:
+            response[idempotency.REPLAYED_HEADER] = 'true'
+        return response
+    
+    async def apply(self, coupon_id, cart, data, mode):
+        """
+        Apply, and redeem or reserve, a coupon.
+        
+        Returns:
+            tuple: The response data and status code
+        """
+        discounted_cart = await aapply_coupon(coupon_id, cart)
+        
+        if discounted_cart is None:
+            return {'error': 'Coupon not found or not applicable to the cart'}, status.HTTP_404_NOT_FOUND
         
-        return Response(response_serializer.data)
+        if mode is not None:
+            return await sync_to_async(redeem_response)(coupon_id, discounted_cart, data, mode)
+        
+        return fastpath.encode(DiscountedCartSerializer, discounted_cart), status.HTTP_200_OK
+
+
+class MetricsView(View):
+    """
+    View exposing the metrics of every worker process in the Prometheus text format.
+    """
+    def get(self, request):
+        """
+        Render the merged metrics.
+        """
+        return HttpResponse(
+            metrics.registry.render(),
+            content_type='text/plain; version=0.0.4; charset=utf-8'
+        )